@@ -25,6 +25,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
 from . import unet
+from .normalization import normalize_01, normalize_std
 import wandb 
 from timm.scheduler import TanhLRScheduler
 
@@ -54,6 +55,37 @@ class MoDLReconstructor(pl.LightningModule):
     def forward(self, x):
 
         return self.model(x)
+
+    def reconstruct(self, batch):
+        '''
+        Runs MoDL on the undersampled input of batch. With an undersampled DC operator, batch also holds the angle offset
+        of each sample (ReconstructionDataset with return_angle_offset): samples are grouped by offset and every group
+        is solved with the operator of its acquired angles.
+        Params:
+            - batch (tuple): Dataloader batch
+        '''
+        unfiltered_us_rec = batch[0]
+
+        if (self.model.undersampled_operator == False) or (len(batch) < 4):
+
+            return self.model(unfiltered_us_rec)
+
+        angle_offsets = torch.as_tensor(batch[3], device = unfiltered_us_rec.device)
+        modl_rec = {}
+
+        for angle_offset in torch.unique(angle_offsets).tolist():
+
+            group = angle_offsets == angle_offset
+            self.model.set_angle_offset(angle_offset)
+
+            for key, image in self.model(unfiltered_us_rec[group]).items():
+
+                if key not in modl_rec:
+                    modl_rec[key] = image.new_zeros((unfiltered_us_rec.shape[0],)+image.shape[1:])
+                
+                modl_rec[key] = modl_rec[key].index_put((group,), image)
+
+        return modl_rec
     
     def training_step(self, batch, batch_idx):
         '''
@@ -63,9 +95,9 @@ class MoDLReconstructor(pl.LightningModule):
             - 'fs' stands for fully sampled reconstruction
         '''
 
-        unfiltered_us_rec, filtered_us_rec, filtered_fs_rec = batch
+        unfiltered_us_rec, filtered_us_rec, filtered_fs_rec = batch[:3]
 
-        modl_rec = self.model(unfiltered_us_rec)
+        modl_rec = self.reconstruct(batch)
 
         if (self.track_train == True) and (batch_idx%50 == 0):
 
@@ -120,9 +152,9 @@ class MoDLReconstructor(pl.LightningModule):
             - 'fs' stands for fully sampled reconstruction
         '''
 
-        unfiltered_us_rec, filtered_us_rec, filtered_fs_rec = batch
+        unfiltered_us_rec, filtered_us_rec, filtered_fs_rec = batch[:3]
         
-        modl_rec = self.model(unfiltered_us_rec)
+        modl_rec = self.reconstruct(batch)
 
         if (self.track_val == True) and ((self.current_epoch == 0) or (self.current_epoch == self.max_epochs-1)) and (batch_idx == 0):
 
@@ -166,9 +198,9 @@ class MoDLReconstructor(pl.LightningModule):
             - 'fs' stands for fully sampled reconstruction
         '''
 
-        unfiltered_us_rec, filtered_us_rec, filtered_fs_rec = batch
+        unfiltered_us_rec, filtered_us_rec, filtered_fs_rec = batch[:3]
         
-        modl_rec = self.model(unfiltered_us_rec)
+        modl_rec = self.reconstruct(batch)
 
         if (self.track_test == True) and (batch_idx == 0):
 
@@ -313,7 +345,7 @@ class MoDLReconstructor(pl.LightningModule):
         Logs images from training.
         '''
 
-        unfiltered_us_rec, filtered_us_rec, filtered_fs_rec = batch
+        unfiltered_us_rec, filtered_us_rec, filtered_fs_rec = batch[:3]
 
         image_tensor = [unfiltered_us_rec[0,...], filtered_us_rec[0,...], filtered_fs_rec[0,...], model_reconstruction[0, ...]]
 
@@ -343,13 +375,7 @@ class MoDLReconstructor(pl.LightningModule):
         - images (torch.Tensor): Tensor of 1-channel images
         '''
         
-        image_norm = torch.zeros_like(images)
-
-        for i, image in enumerate(images):
-            
-            image_norm[i,...] = ((image - image.min())/(image.max()-image.min()))
-
-        return image_norm      
+        return normalize_01(images)
 
     @staticmethod
     def normalize_image_std(images):
@@ -359,13 +385,7 @@ class MoDLReconstructor(pl.LightningModule):
         - images (torch.Tensor): Tensor of 1-channel images
         '''
         
-        image_norm = torch.zeros_like(images)
-
-        for i, image in enumerate(images):
-            
-            image_norm[i,...] = ((image - image.mean())/(image.std()))
-
-        return image_norm       
+        return normalize_std(images)
 
 class UNetReconstructor(pl.LightningModule):
     '''
@@ -661,18 +681,16 @@ class UNetReconstructor(pl.LightningModule):
     @staticmethod
     def normalize_image_01(images):
         '''
-        Normalizes tensor of images 1-channel images between 0 and 1.
+        Centers each 1-channel image on its mean and scales it by its range, as trained U-Net models expect (the
+        result is not bounded to [0, 1]).
         Params:
         - images (torch.Tensor): Tensor of 1-channel images
         '''
-        
-        image_norm = torch.zeros_like(images)
-
-        for i, image in enumerate(images):
-            
-            image_norm[i,...] = ((image - image.mean())/(image.max()-image.min()))
+        flat_images = images.reshape(images.shape[0], -1)
+        shape = (-1,)+(1,)*(images.dim()-1)
+        image_range = flat_images.amax(dim = -1)-flat_images.amin(dim = -1)
 
-        return image_norm        
+        return (images-flat_images.mean(dim = -1).reshape(shape))/image_range.reshape(shape)
     
     @staticmethod
     def normalize_image_std(images):
@@ -682,10 +700,4 @@ class UNetReconstructor(pl.LightningModule):
         - images (torch.Tensor): Tensor of 1-channel images
         '''
         
-        image_norm = torch.zeros_like(images)
-
-        for i, image in enumerate(images):
-            
-            image_norm[i,...] = ((image - image.mean())/(image.std()))
-
-        return image_norm       
+        return normalize_std(images)
@@ -0,0 +1,73 @@
+"""
+Batched normalisation operations shared by the model, the training systems and the datasets.
+
+Every image of the batch is normalised with its own statistics. The spatial (and channel) dimensions are flattened
+and reduced at once for the whole batch, instead of looping over images in Python. On CPU, torch.aminmax and
+torch.std_mean are several times slower than separate amin/amax and a centered sum of squares, so those are used.
+
+Operations available:
+    * normalize_01: min-max normalisation between 0 and 1.
+    * normalize_std: z-score normalisation (zero mean, unit standard deviation).
+    * normalize_images: z-score followed by min-max, as used between MoDL iterations.
+
+author: obanmarcos
+"""
+
+import torch
+
+def _flatten(images, start_dim):
+    '''
+    Returns a view of images where each sample (dimensions before start_dim) is flattened to its last dimension.
+    '''
+    return images.reshape(*images.shape[:start_dim], -1)
+
+def normalize_01(images, start_dim: int = 1, inplace: bool = False):
+    '''
+    Normalizes each image between 0 and 1. Annotated and reduced with keepdim, so ToMoDLGraph can script, trace and
+    export it to ONNX.
+    Params:
+        - images (torch.Tensor): Tensor of images, shape (B, ...)
+        - start_dim (int): First dimension reduced. 1 normalises each sample of a batch, 0 the whole tensor as one image
+        - inplace (bool): If True, overwrites images (only when no gradient is needed through them)
+    '''
+    dims = [dim for dim in range(start_dim, images.dim())]
+    minimum = images.amin(dim = dims, keepdim = True)
+    scale = 1/(images.amax(dim = dims, keepdim = True)-minimum)
+
+    if inplace == True:
+        return images.sub_(minimum).mul_(scale)
+
+    return (images-minimum)*scale
+
+def normalize_std(images, start_dim = 1, inplace = False):
+    '''
+    Standardizes each image to zero mean and unit (unbiased) standard deviation.
+    Params:
+        - images (torch.Tensor): Tensor of images, shape (B, ...)
+        - start_dim (int): First dimension reduced. 1 normalises each sample of a batch, 0 the whole tensor as one image
+        - inplace (bool): If True, overwrites images (only when no gradient is needed through them)
+    '''
+    shape = images.shape[:start_dim]+(1,)*(images.dim()-start_dim)
+    mean = _flatten(images, start_dim).mean(dim = -1).reshape(shape)
+    centered_images = images.sub_(mean) if inplace == True else images-mean
+
+    flat_images = _flatten(centered_images, start_dim)
+    variance = (flat_images*flat_images).sum(dim = -1)/(flat_images.shape[-1]-1)
+    scale = torch.rsqrt(variance).reshape(shape)
+
+    if inplace == True:
+        return centered_images.mul_(scale)
+
+    return centered_images*scale
+
+def normalize_images(images, start_dim: int = 1, inplace: bool = False):
+    '''
+    Normalizes each image between 0 and 1 after standardizing it.
+    Min-max normalisation is invariant to the positive affine map of the z-score, so this is computed as a single
+    min-max pass, with the same result as standardizing first.
+    Params:
+        - images (torch.Tensor): Tensor of 1-channel images, shape (B, 1, H, W)
+        - start_dim (int): First dimension reduced
+        - inplace (bool): If True, overwrites images
+    '''
+    return normalize_01(images, start_dim = start_dim, inplace = inplace)
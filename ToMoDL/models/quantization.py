@@ -0,0 +1,123 @@
+"""
+Post-training static INT8 quantisation of the MoDL ResNet denoiser (dw).
+
+Only the denoiser is quantised: its conv + batch norm (+ ReLU) layers are fused and run in INT8, while the residual
+connection, the normalisations and the CG data-consistency step of ToMoDL stay in float32. Activation ranges are
+calibrated by running the whole unrolled network on real data, so every unrolled iteration contributes its inputs.
+
+Workflow:
+    * quantize_denoiser: calibrates and converts the denoiser of a trained ToMoDL model.
+    * save_quantized_denoiser / load_quantized_denoiser: store the quantised denoiser as TorchScript, so it can be
+    loaded back into any ToMoDL model with the same settings.
+
+author: obanmarcos
+"""
+
+import copy
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+class QuantizedDenoiser(nn.Module):
+    """
+    Quantisable version of the dw denoiser, sharing its weights until conversion.
+    """
+    def __init__(self, denoiser):
+        '''
+        Builds fused conv/batch norm/ReLU layers from a dw denoiser in inference mode.
+        Params:
+            - denoiser (modl.dw): Trained denoiser
+        '''
+        super(QuantizedDenoiser, self).__init__()
+
+        self.quant = quantization.QuantStub()
+        self.dequant = quantization.DeQuantStub()
+
+        layers = []
+        fused_names = []
+
+        for i, layer in enumerate(denoiser.nw.values()):
+
+            block = [layer.conv]
+
+            if layer.use_batch_norm:
+                block.append(layer.batch_norm)
+
+            if layer.is_last_layer != True:
+                block.append(nn.ReLU())
+
+            layers.append(nn.Sequential(*block))
+            fused_names.append([str(i)+'.'+str(j) for j in range(len(block))])
+
+        self.layers = nn.Sequential(*layers).eval()
+
+        for names in fused_names:
+            if len(names) > 1:
+                quantization.fuse_modules(self.layers, names, inplace = True)
+
+    def forward(self, x):
+        """
+        Forward pass, quantising the input and adding the residual in float
+        Params:
+            - x (torch.Tensor): Image batch to be processed
+        """
+        return self.dequant(self.layers(self.quant(x)))+x
+
+def quantize_denoiser(model, calibration_dataloader, calibration_batches = 32, backend = 'fbgemm'):
+    '''
+    Calibrates and converts the denoiser of a ToMoDL model to INT8. The input model is not modified.
+    Params:
+        - model (modl.ToMoDL): Trained model with shared denoiser weights
+        - calibration_dataloader (DataLoader): Yields (unfiltered_us_rec, filtered_us_rec, filtered_fs_rec) batches,
+        as ReconstructionDataset
+        - calibration_batches (int): Number of batches used to calibrate activation ranges
+        - backend (string): Quantised engine, 'fbgemm' (x86) or 'qnnpack' (ARM)
+    Returns:
+        - quantized_model (modl.ToMoDL): Copy of model with an INT8 denoiser
+    '''
+    if isinstance(model.dw, nn.ModuleList):
+        raise ValueError('quantize_denoiser needs a single denoiser shared by every iteration (use_shared_weights = True), got {} per-iteration denoisers'.format(len(model.dw)))
+
+    torch.backends.quantized.engine = backend
+
+    quantized_model = copy.deepcopy(model).cpu().eval()
+    denoiser = QuantizedDenoiser(quantized_model.dw)
+    denoiser.qconfig = quantization.get_default_qconfig(backend)
+    quantization.prepare(denoiser, inplace = True)
+
+    # Calibration runs the full network, so the observers see the inputs of every unrolled iteration
+    quantized_model.dw = denoiser
+
+    with torch.no_grad():
+        for batch_idx, (unfiltered_us_rec, _, _) in enumerate(calibration_dataloader):
+
+            if batch_idx == calibration_batches:
+                break
+
+            quantized_model(unfiltered_us_rec.cpu())
+
+    quantized_model.dw = quantization.convert(denoiser.eval())
+
+    return quantized_model
+
+def save_quantized_denoiser(quantized_model, path):
+    '''
+    Saves the INT8 denoiser of a quantised ToMoDL model as TorchScript.
+    Params:
+        - quantized_model (modl.ToMoDL): Model returned by quantize_denoiser
+        - path (string): Output path
+    '''
+    torch.jit.save(torch.jit.script(quantized_model.dw), path)
+
+def load_quantized_denoiser(model, path, backend = 'fbgemm'):
+    '''
+    Replaces the denoiser of a ToMoDL model by a saved INT8 denoiser. The model runs on CPU.
+    Params:
+        - model (modl.ToMoDL): Model built with the same settings as the quantised one
+        - path (string): Path of the saved denoiser
+        - backend (string): Quantised engine the denoiser was calibrated for
+    '''
+    torch.backends.quantized.engine = backend
+    model.dw = torch.jit.load(path, map_location = 'cpu')
+
+    return model.cpu().eval()
@@ -48,6 +48,8 @@ modl_dict = {'use_torch_radon': False,
             'acceleration_factor': acceleration_factor,
             'image_size': 100,
             'lambda': 0.025,
+            # Inference only: each DC solve starts from the previous one
+            'cg_warm_start': True,
             'use_shared_weights': True,
             'denoiser_method': 'resnet',
             'resnet_options': resnet_options_dict,
@@ -139,19 +141,15 @@ dataset_dict = {'root_folder' : dataset_list[0],
 #%%
 test_dataset = dlutils.ReconstructionDataset(**dataset_dict)    
 
-test_dataloader = DataLoader(test_dataset, 
-                            batch_size = 1,
-                            shuffle = False,
-                            num_workers = 0)
+enum = 0
 
-vol_tomodl = []
-vol_fbp = []
+# Inference only: batch normalisation folded, no gradients
+model_tomodl.model.freeze()
 
-for enum, (us_unfil_im, us_fil_im, fs_fil_im) in enumerate(test_dataloader):
-    
-    im_tomodl= model_tomodl(us_unfil_im.to(device))['dc'+str(model_tomodl.model.K)][0,0,...].detach().cpu().numpy()
-    im_fbp = us_fil_im[0,0,...].detach().cpu().numpy()
-    im_truth = fs_fil_im[0,0,...].detach().cpu().numpy()
+# Slabs of 16 slices go through the unrolled network at once, straight into the output volume
+vol_tomodl = model_tomodl.model.reconstruct_volume(backprojections = test_dataset.unfiltered_us_recs[:, 0], batch_size = 16)
+
+for im_tomodl, im_fbp, im_truth in zip(vol_tomodl, test_dataset.filtered_us_recs[:,0,...].numpy(), test_dataset.filtered_fs_recs[:,0,...].numpy()):
 
     scale_percent = 400 # percent of original size
     width = int(im_tomodl.shape[1] * scale_percent / 100)
@@ -166,5 +164,4 @@ for enum, (us_unfil_im, us_fil_im, fs_fil_im) in enumerate(test_dataloader):
     print(cv2.imwrite(f'/home/obanmarcos/Balseiro/DeepOPT/Volumes/X20_fbp/a_{enum}.jpg', 255.0*im_fbp))
     print(cv2.imwrite(f'/home/obanmarcos/Balseiro/DeepOPT/Volumes/X20_fbp_GT/a_truth_{enum}.jpg', 255.0*im_truth))
     
-
-
+    enum += 1
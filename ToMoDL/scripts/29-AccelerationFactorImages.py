@@ -68,7 +68,8 @@ def load_dicts(acceleration_factor, use_default_model_dict = True, use_default_d
                     'denoiser_method': 'resnet',
                     'resnet_options': resnet_options_dict,
                     'in_channels': 1,
-                    'out_channels': 1}
+                    'out_channels': 1,
+                    'keep_intermediates': True}
 
         # Training parameters
         loss_dict = {'loss_name': 'psnr',
@@ -0,0 +1,107 @@
+'''
+Benchmarks batched normalisation operations against the per-image loops they replace.
+
+author: obanmarcos
+'''
+
+import os, sys
+import time
+import argparse
+import torch
+import numpy as np
+from config import * 
+
+sys.path.append(where_am_i())
+
+from models.normalization import normalize_01, normalize_std, normalize_images
+
+def normalize_images_loop(images):
+    '''
+    Per-image loop previously used between MoDL iterations.
+    '''
+    image_norm = torch.zeros_like(images)
+
+    for i, image in enumerate(images):
+
+        image = (image-image.mean())/image.std()
+        image_norm[i,...] = ((image - image.min())/(image.max()-image.min()))
+
+    return image_norm
+
+def normalize_01_loop(images):
+    '''
+    Per-image loop previously used by the training systems.
+    '''
+    image_norm = torch.zeros_like(images)
+
+    for i, image in enumerate(images):
+        
+        image_norm[i,...] = ((image - image.min())/(image.max()-image.min()))
+
+    return image_norm
+
+def normalize_std_loop(images):
+    '''
+    Per-image loop previously used by the training systems.
+    '''
+    image_norm = torch.zeros_like(images)
+
+    for i, image in enumerate(images):
+        
+        image_norm[i,...] = ((image - image.mean())/(image.std()))
+
+    return image_norm
+
+def time_function(function, images, repetitions):
+    '''
+    Returns mean time in ms of function over repetitions, after one warm-up call.
+    '''
+    function(images)
+
+    if images.is_cuda:
+        torch.cuda.synchronize()
+
+    start = time.perf_counter()
+
+    for _ in range(repetitions):
+        function(images)
+
+    if images.is_cuda:
+        torch.cuda.synchronize()
+
+    return (time.perf_counter()-start)/repetitions*1e3
+
+def benchmark(args_options):
+
+    device = torch.device(args_options['device'])
+    functions = {'normalize_images': (normalize_images_loop, normalize_images),
+                'normalize_01': (normalize_01_loop, normalize_01),
+                'normalize_std': (normalize_std_loop, normalize_std)}
+
+    print('{:>16} {:>6} {:>10} {:>10} {:>8} {:>10}'.format('operation', 'batch', 'loop [ms]', 'batch [ms]', 'speedup', 'max diff'))
+
+    for batch_size in args_options['batch_sizes']:
+
+        images = torch.rand(batch_size, 1, args_options['image_size'], args_options['image_size'], device = device)
+
+        for name, (loop_function, batched_function) in functions.items():
+
+            loop_time = time_function(loop_function, images, args_options['repetitions'])
+            batched_time = time_function(batched_function, images, args_options['repetitions'])
+            difference = (loop_function(images)-batched_function(images)).abs().max().item()
+
+            print('{:>16} {:>6} {:>10.3f} {:>10.3f} {:>8.1f} {:>10.1e}'.format(name, batch_size, loop_time, batched_time, loop_time/batched_time, difference))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark batched normalisation operations')
+
+    parser.add_argument('--batch_sizes', nargs = '+', type = int, default = [1, 4, 8, 16, 32, 64])
+    parser.add_argument('--image_size', type = int, default = 100)
+    parser.add_argument('--repetitions', type = int, default = 50)
+    parser.add_argument('--device', type = str, default = 'cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    args = parser.parse_args()
+    args_options = vars(args)
+
+    benchmark(args_options)
@@ -0,0 +1,100 @@
+'''
+Benchmarks the compile-friendly ToMoDL inference graph (TorchScript and torch.compile) against eager mode,
+for the 100 px, K = 8 configuration used by the napari plugin.
+
+author: obanmarcos
+'''
+
+import os, sys
+import time
+import argparse
+import torch
+import numpy as np
+from config import * 
+
+sys.path.append(where_am_i())
+
+from models.modl import ToMoDL, compile_tomodl, normalize_images
+
+def time_function(function, images, repetitions):
+    '''
+    Returns mean time in ms of function over repetitions, after one warm-up call.
+    '''
+    with torch.no_grad():
+        
+        function(images)
+
+        start = time.perf_counter()
+
+        for _ in range(repetitions):
+            function(images)
+
+    return (time.perf_counter()-start)/repetitions*1e3
+
+def benchmark(args_options):
+
+    resnet_options_dict = {'number_layers': 8,
+                            'kernel_size':3,
+                            'features':64,
+                            'in_channels':1,
+                            'out_channels':1,
+                            'stride':1, 
+                            'use_batch_norm': True,
+                            'init_method': 'xavier'}
+
+    tomodl_dictionary = {'use_torch_radon': False,
+                        'metric': 'psnr',
+                        'K_iterations' : 8,
+                        'number_projections_total' : args_options['number_projections'],
+                        'acceleration_factor': 32,
+                        'image_size': 100,
+                        'lambda': 0.025,
+                        'radon_backend': 'sparse',
+                        'normal_operator': args_options['normal_operator'],
+                        'dc_method': args_options['dc_method'],
+                        'cg_iterations': args_options['cg_iterations'],
+                        'use_shared_weights': True,
+                        'denoiser_method': 'resnet',
+                        'resnet_options': resnet_options_dict,
+                        'in_channels': 1,
+                        'out_channels': 1}
+    
+    model = ToMoDL(tomodl_dictionary).eval()
+    images = normalize_images(torch.rand(args_options['batch_size'], 1, 100, 100))
+
+    functions = {'eager': lambda x: model(x)['dc8']}
+
+    for method in args_options['methods']:
+
+        start = time.perf_counter()
+        compiled_graph = compile_tomodl(model, method)
+        
+        with torch.no_grad():
+            difference = (compiled_graph(images)[0]-model(images)['dc8']).abs().max().item()
+        
+        print('{}: built and first run in {:.1f} s, max difference with eager {:.1e}'.format(method, time.perf_counter()-start, difference))
+        functions[method] = compiled_graph
+
+    eager_time = time_function(functions['eager'], images, args_options['repetitions'])
+
+    for name, function in functions.items():
+
+        function_time = eager_time if name == 'eager' else time_function(function, images, args_options['repetitions'])
+        print('{:>8}: {:8.1f} ms per batch, speedup {:.2f}'.format(name, function_time, eager_time/function_time))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark compiled ToMoDL inference')
+
+    parser.add_argument('--methods', nargs = '+', type = str, default = ['eager', 'script', 'compile'])
+    parser.add_argument('--batch_size', type = int, default = 1)
+    parser.add_argument('--number_projections', type = int, default = 720)
+    parser.add_argument('--normal_operator', type = str, default = 'toeplitz')
+    parser.add_argument('--dc_method', type = str, default = 'cg')
+    parser.add_argument('--cg_iterations', type = int, default = 10)
+    parser.add_argument('--repetitions', type = int, default = 10)
+
+    args = parser.parse_args()
+    args_options = vars(args)
+
+    benchmark(args_options)
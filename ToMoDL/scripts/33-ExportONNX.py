@@ -0,0 +1,74 @@
+'''
+Exports a trained ToMoDL Lightning checkpoint to ONNX, for CPU inference with onnxruntime.
+
+Example:
+    python 33-ExportONNX.py --checkpoint datasets/x20/140114_5dpf_body_20/model.ckpt --output tomodl_x20.onnx
+
+author: obanmarcos
+'''
+
+import os, sys
+import argparse
+import torch
+import numpy as np
+from config import * 
+
+sys.path.append(where_am_i())
+
+from models.modl import load_tomodl_checkpoint, export_tomodl_onnx
+
+def export(args_options):
+
+    # DC operator settings of the exported graph. The Toeplitz normal operator is the exportable one
+    kw_dictionary = {'normal_operator': 'toeplitz',
+                    'dc_method': args_options['dc_method'],
+                    'cg_iterations': args_options['cg_iterations'],
+                    'cg_warm_start': args_options['cg_warm_start']}
+    
+    if args_options['number_projections'] is not None:
+        kw_dictionary['number_projections_total'] = args_options['number_projections']
+
+    if args_options['angle_offset'] is not None:
+        kw_dictionary['undersampled_operator'] = True
+        kw_dictionary['angle_offset'] = args_options['angle_offset']
+
+    model = load_tomodl_checkpoint(args_options['checkpoint'], kw_dictionary).eval()
+    metadata = export_tomodl_onnx(model, args_options['output'], opset_version = args_options['opset_version'])
+
+    print('Exported {} to {}'.format(args_options['checkpoint'], args_options['output']))
+    
+    for key, value in metadata.items():
+        if key != 'angles':
+            print('  {}: {}'.format(key, value))
+
+    if args_options['check'] == True:
+
+        import onnxruntime as ort
+
+        session = ort.InferenceSession(args_options['output'], providers = ['CPUExecutionProvider'])
+        images = torch.rand(2, 1, metadata['image_size'], metadata['image_size'])
+
+        with torch.no_grad():
+            torch_output = model(images)['dc'+str(model.K)].numpy()
+        
+        onnx_output = session.run(None, {'x': images.numpy()})[0]
+        print('Max difference between PyTorch and onnxruntime: {:.2e}'.format(np.abs(torch_output-onnx_output).max()))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export ToMoDL checkpoint to ONNX')
+
+    parser.add_argument('--checkpoint', type = str, required = True, help = 'Lightning checkpoint (model.ckpt)')
+    parser.add_argument('--output', type = str, default = 'tomodl.onnx')
+    parser.add_argument('--number_projections', type = int, default = None, help = 'Number of projections, defaults to the checkpoint one')
+    parser.add_argument('--angle_offset', type = int, default = None, help = 'If given, builds the operator only at the acquired angles')
+    parser.add_argument('--dc_method', type = str, default = 'cg', choices = ['cg', 'pcg', 'fourier'])
+    parser.add_argument('--cg_iterations', type = int, default = 10)
+    parser.add_argument('--cg_warm_start', action = 'store_true')
+    parser.add_argument('--opset_version', type = int, default = 17)
+    parser.add_argument('--check', action = 'store_true', help = 'Compares onnxruntime output with PyTorch')
+
+    args = parser.parse_args()
+    args_options = vars(args)
+
+    export(args_options)
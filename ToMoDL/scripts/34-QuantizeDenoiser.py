@@ -0,0 +1,104 @@
+'''
+Post-training INT8 quantisation of the ToMoDL denoiser: calibrates on ReconstructionDataset folders, evaluates
+PSNR/SSIM against the float model on held-out folders and saves the quantised denoiser.
+
+Example:
+    python 34-QuantizeDenoiser.py --checkpoint model.ckpt --calibration_folders datasets/x20/A datasets/x20/B --test_folders datasets/x20/C
+
+author: obanmarcos
+'''
+
+import os, sys
+import time
+import argparse
+import torch
+import numpy as np
+from config import * 
+
+sys.path.append(where_am_i())
+
+from torch.utils.data import DataLoader, ConcatDataset
+from pytorch_msssim import SSIM
+from utilities import dataloading_utilities as dlutils
+from models.modl import load_tomodl_checkpoint
+from models.normalization import normalize_std
+from models.quantization import quantize_denoiser, save_quantized_denoiser
+
+def create_dataloader(folders, acceleration_factor, batch_size, shuffle):
+    '''
+    Concatenates ReconstructionDataset of every folder in a dataloader.
+    '''
+    dataset = ConcatDataset([dlutils.ReconstructionDataset(folder, acceleration_factor) for folder in folders])
+
+    return DataLoader(dataset, batch_size = batch_size, shuffle = shuffle, num_workers = 0)
+
+def evaluate(model, dataloader, max_batches = None):
+    '''
+    Returns mean PSNR and SSIM of model reconstructions against fully sampled FBP, as logged by MoDLReconstructor,
+    and mean time per batch of the denoiser.
+    '''
+    ssim = SSIM(data_range = 1, size_average = True, channel = 1)
+    psnr_values, ssim_values, denoiser_times = [], [], []
+    
+    with torch.no_grad():
+        for batch_idx, (unfiltered_us_rec, _, filtered_fs_rec) in enumerate(dataloader):
+
+            if batch_idx == max_batches:
+                break
+            
+            # Denoiser alone, without data consistency
+            start = time.perf_counter()
+            model.dw(unfiltered_us_rec)
+            denoiser_times.append(time.perf_counter()-start)
+
+            reconstruction = model(unfiltered_us_rec)['dc'+str(model.K)]
+            ssim_values.append(ssim(reconstruction, filtered_fs_rec).item())
+
+            reconstruction = normalize_std(reconstruction)
+            filtered_fs_rec = normalize_std(filtered_fs_rec)
+            mse = torch.mean((reconstruction-filtered_fs_rec)**2)
+            psnr_values.append((10*torch.log10((filtered_fs_rec.max()-filtered_fs_rec.min())**2/mse)).item())
+
+    return np.mean(psnr_values), np.mean(ssim_values), np.mean(denoiser_times)
+
+def quantize(args_options):
+
+    # The operator is only used in float, Toeplitz keeps the evaluation fast on CPU
+    model = load_tomodl_checkpoint(args_options['checkpoint'], {'normal_operator': 'toeplitz'}).cpu().eval()
+
+    calibration_dataloader = create_dataloader(args_options['calibration_folders'], args_options['acceleration_factor'], args_options['batch_size'], True)
+    test_dataloader = create_dataloader(args_options['test_folders'], args_options['acceleration_factor'], args_options['batch_size'], False)
+
+    start = time.perf_counter()
+    quantized_model = quantize_denoiser(model, calibration_dataloader, args_options['calibration_batches'], args_options['backend'])
+    print('Calibrated on {} batches in {:.1f} s'.format(args_options['calibration_batches'], time.perf_counter()-start))
+
+    float_psnr, float_ssim, float_time = evaluate(model, test_dataloader, args_options['test_batches'])
+    int8_psnr, int8_ssim, int8_time = evaluate(quantized_model, test_dataloader, args_options['test_batches'])
+
+    print('{:>8} {:>8} {:>8} {:>16}'.format('model', 'PSNR', 'SSIM', 'denoiser [ms]'))
+    print('{:>8} {:8.3f} {:8.4f} {:16.1f}'.format('float32', float_psnr, float_ssim, float_time*1e3))
+    print('{:>8} {:8.3f} {:8.4f} {:16.1f}'.format('int8', int8_psnr, int8_ssim, int8_time*1e3))
+    print('PSNR change {:+.3f} dB, SSIM change {:+.4f}, denoiser speedup {:.2f}'.format(int8_psnr-float_psnr, int8_ssim-float_ssim, float_time/int8_time))
+
+    save_quantized_denoiser(quantized_model, args_options['output'])
+    print('Quantised denoiser saved at {}'.format(args_options['output']))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='INT8 post-training quantisation of the ToMoDL denoiser')
+
+    parser.add_argument('--checkpoint', type = str, required = True, help = 'Lightning checkpoint (model.ckpt)')
+    parser.add_argument('--calibration_folders', nargs = '+', type = str, required = True)
+    parser.add_argument('--test_folders', nargs = '+', type = str, required = True, help = 'Held-out fold')
+    parser.add_argument('--acceleration_factor', type = int, default = 20)
+    parser.add_argument('--batch_size', type = int, default = 8)
+    parser.add_argument('--calibration_batches', type = int, default = 32)
+    parser.add_argument('--test_batches', type = int, default = None)
+    parser.add_argument('--backend', type = str, default = 'fbgemm', choices = ['fbgemm', 'qnnpack'])
+    parser.add_argument('--output', type = str, default = 'tomodl_dw_int8.pt')
+
+    args = parser.parse_args()
+    args_options = vars(args)
+
+    quantize(args_options)
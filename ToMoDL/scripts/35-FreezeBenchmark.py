@@ -0,0 +1,123 @@
+'''
+Benchmarks per-slice CPU latency of the MoDL denoiser, the whole ToMoDL network and the U-Net before and after the
+inference freeze step (batch normalisation folding, in-place ReLU and channels-last convolutions).
+
+author: obanmarcos
+'''
+
+import os, sys
+import copy
+import time
+import argparse
+import torch
+import numpy as np
+from config import * 
+
+sys.path.append(where_am_i())
+
+from models.modl import ToMoDL
+from models.unet import unet
+from models.normalization import normalize_images
+
+def time_function(function, images, repetitions):
+    '''
+    Returns mean time in ms of function over repetitions, after one warm-up call.
+    '''
+    with torch.no_grad():
+        
+        function(images)
+
+        start = time.perf_counter()
+
+        for _ in range(repetitions):
+            function(images)
+
+    return (time.perf_counter()-start)/repetitions*1e3
+
+def randomize_batch_norm(model):
+    '''
+    Sets random batch normalisation statistics and affine parameters, as in a trained model, so folding is not trivial.
+    '''
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.1, 0.1)
+                module.running_var.uniform_(0.5, 2)
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.uniform_(-0.1, 0.1)
+
+    return model
+
+def compare(name, model, images, repetitions, output = lambda y: y):
+    '''
+    Prints latency of model in evaluation mode against its frozen copies (with and without channels-last format).
+    '''
+    model = randomize_batch_norm(model).eval()
+    function = lambda x: output(model(x))
+    eval_time = time_function(function, images, repetitions)
+    print('{:>8} {:>14}: {:8.1f} ms per slice'.format(name, 'eval', eval_time/images.shape[0]))
+
+    for channels_last in [False, True]:
+
+        frozen_model = copy.deepcopy(model).freeze(channels_last)
+        frozen_function = lambda x: output(frozen_model(x))
+
+        with torch.no_grad():
+            difference = (frozen_function(images)-function(images)).abs().max().item()
+        
+        frozen_time = time_function(frozen_function, images, repetitions)
+        print('{:>8} {:>14}: {:8.1f} ms per slice, speedup {:.2f}, max difference {:.1e}'.format(name, 'frozen'+(' (NHWC)' if channels_last else ''), frozen_time/images.shape[0], eval_time/frozen_time, difference))
+
+def benchmark(args_options):
+
+    resnet_options_dict = {'number_layers': 8,
+                            'kernel_size':3,
+                            'features':64,
+                            'in_channels':1,
+                            'out_channels':1,
+                            'stride':1, 
+                            'use_batch_norm': True,
+                            'init_method': 'xavier'}
+
+    tomodl_dictionary = {'use_torch_radon': False,
+                        'metric': 'psnr',
+                        'K_iterations' : 8,
+                        'number_projections_total' : args_options['number_projections'],
+                        'acceleration_factor': 32,
+                        'image_size': 100,
+                        'lambda': 0.025,
+                        'normal_operator': 'toeplitz',
+                        'use_shared_weights': True,
+                        'denoiser_method': 'resnet',
+                        'resnet_options': resnet_options_dict,
+                        'in_channels': 1,
+                        'out_channels': 1}
+
+    unet_dictionary = {'n_channels': 1,
+                        'n_classes': 1,
+                        'bilinear': True,
+                        'batch_norm': True,
+                        'batch_norm_inconv': True,
+                        'residual': True,
+                        'up_conv': True}
+    
+    images = normalize_images(torch.rand(args_options['batch_size'], 1, 100, 100))
+    
+    model = ToMoDL(tomodl_dictionary)
+    
+    compare('dw', model.dw, images, args_options['repetitions'])
+    compare('ToMoDL', model, images, args_options['repetitions'], output = lambda out: out['dc8'])
+    compare('U-Net', unet(unet_dictionary), images, args_options['repetitions'])
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark inference freeze of the ToMoDL denoiser and U-Net')
+
+    parser.add_argument('--batch_size', type = int, default = 1)
+    parser.add_argument('--number_projections', type = int, default = 720)
+    parser.add_argument('--repetitions', type = int, default = 10)
+
+    args = parser.parse_args()
+    args_options = vars(args)
+
+    benchmark(args_options)
@@ -0,0 +1,100 @@
+'''
+Benchmarks bfloat16 inference of the ToMoDL denoiser on CPU (DC step in float32) against float32 inference:
+throughput of the denoiser and of the whole network, and PSNR/SSIM change against the fully sampled FBP.
+
+Example:
+    python 36-Bfloat16Benchmark.py --checkpoint datasets/x20/140114_5dpf_body_20/model.ckpt --folders datasets/x20/140114_5dpf_body_20
+
+author: obanmarcos
+'''
+
+import os, sys
+import time
+import argparse
+import torch
+import numpy as np
+from config import * 
+
+sys.path.append(where_am_i())
+
+from torch.utils.data import DataLoader, ConcatDataset
+from pytorch_msssim import SSIM
+from utilities import dataloading_utilities as dlutils
+from models.modl import load_tomodl_checkpoint
+from models.normalization import normalize_std
+
+def evaluate(model, dataloader, max_batches = None):
+    '''
+    Returns mean PSNR and SSIM of model reconstructions against fully sampled FBP, as logged by MoDLReconstructor,
+    and throughput in slices per second of the denoiser and of the whole network.
+    '''
+    ssim = SSIM(data_range = 1, size_average = True, channel = 1)
+    psnr_values, ssim_values = [], []
+    number_slices, denoiser_time, model_time = 0, 0, 0
+    
+    with torch.no_grad():
+        for batch_idx, (unfiltered_us_rec, _, filtered_fs_rec) in enumerate(dataloader):
+
+            if batch_idx == max_batches:
+                break
+            
+            start = time.perf_counter()
+            model.denoise(unfiltered_us_rec)
+            denoiser_time += time.perf_counter()-start
+
+            start = time.perf_counter()
+            reconstruction = model(unfiltered_us_rec)['dc'+str(model.K)]
+            model_time += time.perf_counter()-start
+            number_slices += unfiltered_us_rec.shape[0]
+
+            ssim_values.append(ssim(reconstruction, filtered_fs_rec).item())
+
+            reconstruction = normalize_std(reconstruction)
+            filtered_fs_rec = normalize_std(filtered_fs_rec)
+            mse = torch.mean((reconstruction-filtered_fs_rec)**2)
+            psnr_values.append((10*torch.log10((filtered_fs_rec.max()-filtered_fs_rec.min())**2/mse)).item())
+
+    return np.mean(psnr_values), np.mean(ssim_values), number_slices/denoiser_time, number_slices/model_time
+
+def benchmark(args_options):
+
+    model = load_tomodl_checkpoint(args_options['checkpoint'], {'normal_operator': 'toeplitz'}).freeze()
+    
+    dataset = ConcatDataset([dlutils.ReconstructionDataset(folder, args_options['acceleration_factor']) for folder in args_options['folders']])
+    dataloader = DataLoader(dataset, batch_size = args_options['batch_size'], shuffle = False, num_workers = 0)
+
+    # Warm-up of both precisions
+    with torch.no_grad():
+        for precision in ['float32', 'bfloat16']:
+            model.denoiser_precision = precision
+            model(next(iter(dataloader))[0])
+
+    results = {}
+
+    for precision in ['float32', 'bfloat16']:
+
+        model.denoiser_precision = precision
+        results[precision] = evaluate(model, dataloader, args_options['batches'])
+
+    print('{:>9} {:>8} {:>8} {:>18} {:>16}'.format('precision', 'PSNR', 'SSIM', 'denoiser [sl/s]', 'ToMoDL [sl/s]'))
+    
+    for precision, (psnr, ssim, denoiser_throughput, model_throughput) in results.items():
+        print('{:>9} {:8.3f} {:8.4f} {:18.1f} {:16.2f}'.format(precision, psnr, ssim, denoiser_throughput, model_throughput))
+
+    float_results, bfloat_results = results['float32'], results['bfloat16']
+    print('PSNR change {:+.3f} dB, SSIM change {:+.4f}, denoiser speedup {:.2f}, ToMoDL speedup {:.2f}'.format(bfloat_results[0]-float_results[0], bfloat_results[1]-float_results[1], bfloat_results[2]/float_results[2], bfloat_results[3]/float_results[3]))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark bfloat16 denoiser inference of ToMoDL')
+
+    parser.add_argument('--checkpoint', type = str, required = True, help = 'Lightning checkpoint (model.ckpt)')
+    parser.add_argument('--folders', nargs = '+', type = str, required = True)
+    parser.add_argument('--acceleration_factor', type = int, default = 20)
+    parser.add_argument('--batch_size', type = int, default = 8)
+    parser.add_argument('--batches', type = int, default = 8)
+
+    args = parser.parse_args()
+    args_options = vars(args)
+
+    benchmark(args_options)
@@ -209,6 +209,8 @@ class TrainerSystem():
         self.model_system_dict = kwdict
         self.model_system_dict['max_epochs'] = self.lightning_trainer_dict['max_epochs']
         self.loss_method = kwdict['loss_dict']['loss_name']
+        # Datasets return each sample's angle offset when MoDL builds its DC operator at the acquired angles only
+        self.undersampled_operator = (self.model_system_method == 'modl') and kwdict['kw_dictionary_modl'].get('undersampled_operator', False)
 
     def print_check_datasets(self):
 
@@ -307,7 +309,8 @@ class TrainerSystem():
             
             dataset_dict = {'root_folder' : folder, 
                             'acceleration_factor' : self.acceleration_factor,
-                            'transform' : self.data_transform}
+                            'transform' : self.data_transform,
+                            'return_angle_offset': self.undersampled_operator}
 
             train_val_datasets.append(dlutils.ReconstructionDataset(**dataset_dict))
         
@@ -338,7 +341,8 @@ class TrainerSystem():
             
             dataset_dict = {'root_folder' : folder, 
                                 'acceleration_factor' : self.acceleration_factor,
-                                'transform' : self.data_transform}
+                                'transform' : self.data_transform,
+                                'return_angle_offset': self.undersampled_operator}
 
             test_datasets.append(dlutils.ReconstructionDataset(**dataset_dict))
         
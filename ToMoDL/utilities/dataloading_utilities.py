@@ -19,7 +19,10 @@ from tqdm import tqdm
 try:
     from torch_radon import Radon
 except ModuleNotFoundError:
-    from skimage.transform import radon
+    from models.radon import Radon
+from models.radon import SparseRadon, undersampled_indexes
+from models.normalization import normalize_01
+from skimage.transform import iradon
 import pickle
 from pathlib import Path
 import torch
@@ -81,6 +84,7 @@ class DatasetProcessor:
     self.number_projections_total = kw_dictionary['number_projections_total']
     self.number_projections_undersampled = kw_dictionary['number_projections_undersampled']
     self.acceleration_factor = kw_dictionary['acceleration_factor']
+    self.radon_backend = kw_dictionary.get('radon_backend', 'default')
 
     self._create_radon()
 
@@ -303,6 +307,10 @@ class DatasetProcessor:
     # Masking dataset has to be on its own
     print('Masking with {} method'.format(self.sampling_method))
     undersampled_sinograms = self.subsample_sinogram(full_sinogram, self.sampling_method)
+
+    # Seed projection of the undersampling, read back by ReconstructionDataset for the undersampled MoDL operator
+    with open(reconstructed_dataset_folder+'angle_offset.txt', 'w') as f:
+      f.write(str(self.angle_offset))
     
     # Grab random slices and roll axis so to sample slices
     undersampled_sinograms = torch.FloatTensor(np.rollaxis(undersampled_sinograms, 2)).to(device)
@@ -432,10 +440,11 @@ class DatasetProcessor:
       
       undersampled_sinogram = np.copy(sinogram)
       rand_angle = np.random.randint(0, self.number_projections_total)
+      # Written with the dataset, so the undersampled MoDL operator can be built at the same angles (ToMoDL.set_angle_offset)
+      self.angle_offset = rand_angle
 
       # Zeros Masking
-      zeros_idx = np.linspace(0, self.number_projections_total, self.number_projections_undersampled, endpoint = False).astype(int)
-      zeros_idx = (zeros_idx+rand_angle)%self.number_projections_total
+      zeros_idx = undersampled_indexes(self.number_projections_total, self.number_projections_undersampled, rand_angle)
       zeros_mask = np.full(self.number_projections_total, True, dtype = bool)
       zeros_mask[zeros_idx] = False
       undersampled_sinogram[zeros_mask, :, :] = 0
@@ -455,12 +464,15 @@ class DatasetProcessor:
   
   def _create_radon(self):
     '''
-    Creates Torch-Radon method for the desired sampling and image size of the dataloader
+    Creates Torch-Radon method for the desired sampling and image size of the dataloader. Falls back to the torch-native operator on CPU.
     '''
     # Grab number of angles
     self.angles = np.linspace(0, 2*np.pi, self.number_projections_total, endpoint = False)
     
-    self.radon = Radon(self.img_resize, self.angles, clip_to_circle = False, det_count = self.det_count)
+    if self.radon_backend == 'sparse':
+      self.radon = SparseRadon(self.img_resize, self.angles, clip_to_circle = False, det_count = self.det_count)
+    else:
+      self.radon = Radon(self.img_resize, self.angles, clip_to_circle = False, det_count = self.det_count)
 
 # Multi-dataset to dataloader
 class ZebraDataloader:
@@ -714,15 +726,24 @@ class ZebraDataloader:
 
 class ReconstructionDataset(Dataset):
   
-  def __init__(self, root_folder, acceleration_factor, transform = None):
+  def __init__(self, root_folder, acceleration_factor, transform = None, return_angle_offset = False):
     '''
     Params:
       - root_folder (string): root folder contains code for dataset + sample
       - acceleration_factor (int): acceleration factor 
+      - return_angle_offset (bool): If True, items also return the seed projection of the undersampling (0 for datasets
+      written without it), for the undersampled MoDL operator
     '''
     self.root_folder = root_folder+'/'
     self.acceleration_factor = str(acceleration_factor)
     self.transform = transform
+    self.return_angle_offset = return_angle_offset
+
+    self.angle_offset = 0
+
+    if os.path.isfile(self.root_folder+'angle_offset.txt'):
+      with open(self.root_folder+'angle_offset.txt') as f:
+        self.angle_offset = int(f.read())
 
     self.fs_filt_folder = 'fs_filtered/'
     self.us_filt_folder = 'us_{}_filtered/'.format(self.acceleration_factor)
@@ -736,6 +757,12 @@ class ReconstructionDataset(Dataset):
     self.filtered_us_recs = torch.stack([torch.load(self.root_folder+self.us_filt_folder+str(index)+'.pt') for index in range(self.filtered_us_recs_len)], 0)
     self.filtered_fs_recs = torch.stack([torch.load(self.root_folder+self.fs_filt_folder+str(index)+'.pt') for index in range(self.filtered_fs_recs_len)], 0)
 
+    # Normalised once for the whole stack, instead of on every access. torch.stack copies the loaded slices, so the
+    # in-place update never reaches tensors owned by anyone else
+    normalize_01(self.unfiltered_us_recs, inplace = True)
+    normalize_01(self.filtered_us_recs, inplace = True)
+    normalize_01(self.filtered_fs_recs, inplace = True)
+
   def __len__(self):
 
       return self.filtered_us_recs_len
@@ -744,15 +771,19 @@ class ReconstructionDataset(Dataset):
     '''
     Retrieves undersampled unfiltered reconstruction (unfiltered_us_rec), undersampled filtered reconstruction (filtered_us_rec) and fully sampled filtered reconstruction (filtered_fs_rec), used as Input, FBP benchmark and Output respectively. 
     '''
-    unfiltered_us_rec = self.normalize_image(self.unfiltered_us_recs[index, ...])
-    filtered_us_rec = self.normalize_image(self.filtered_us_recs[index, ...])
-    filtered_fs_rec = self.normalize_image(self.filtered_fs_recs[index, ...])
+    # Copies, so in-place changes by transforms or training code cannot alter the stacks shared by every access
+    unfiltered_us_rec = self.unfiltered_us_recs[index, ...].clone()
+    filtered_us_rec = self.filtered_us_recs[index, ...].clone()
+    filtered_fs_rec = self.filtered_fs_recs[index, ...].clone()
+
+    if self.return_angle_offset == True:
+      return (unfiltered_us_rec, filtered_us_rec, filtered_fs_rec, self.angle_offset)
 
     return (unfiltered_us_rec, filtered_us_rec, filtered_fs_rec)
 
   @staticmethod
   def normalize_image(image):
     '''
-    Normalizes image to 
+    Normalizes image to [0, 1]
     '''
-    return (((image - image.min())/(image.max()-image.min())))
+    return normalize_01(image, start_dim = 0)
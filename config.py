@@ -19,6 +19,19 @@ resnet_options_dict = {'number_layers': 8,
 
 # Model parameters
 modl_dict = {'use_torch_radon': False,
+            'radon_backend': 'default',
+            'normal_operator': 'radon',
+            'cg_iterations': 10,
+            'cg_tolerance': 1e-5,
+            'cg_backward': 'unrolled',
+            'dc_method': 'cg',
+            'cg_warm_start': False,
+            'undersampled_operator': False,
+            'angle_offset': 0,
+            'keep_intermediates': False,
+            'use_checkpointing': False,
+            'early_exit_tolerance': None,
+            'denoiser_precision': 'float32',
             'number_layers': 8,
             'K_iterations' : 8,
             'number_projections_total' : 720,
@@ -29,6 +29,7 @@ class Rec_modes(Enum):
     UNET_GPU = 3
     MODL_GPU = 4
     MODL_CPU = 5
+    MODL_ONNX = 6
 
 class Order_Modes(Enum):
     Vertical = 0
@@ -129,12 +130,32 @@ class ReconstructionWidget(QWidget):
                              layout = slayout,
                              write_function = self.set_opt_processor)
         
+        self.bfloat16box = Settings('bfloat16 denoiser (MoDL)',
+                            dtype=bool,
+                            initial = False, 
+                            layout=slayout, 
+                            write_function = self.set_opt_processor) 
+        
         self.fullvolume = Settings('Reconstruct full volume',
                                   dtype=bool,
                                   initial = False, 
                                   layout=slayout, 
                                   write_function = self.set_opt_processor) 
 
+        self.outofcorebox = Settings('Out-of-core (zarr output)',
+                                  dtype=bool,
+                                  initial = False, 
+                                  layout=slayout, 
+                                  write_function = self.set_opt_processor) 
+
+        self.chunkbox = Settings('Slices per chunk',
+                                  dtype=int, 
+                                  vmin=1,
+                                  vmax=4096,
+                                  initial=64, 
+                                  layout=slayout, 
+                                  write_function = self.set_opt_processor)
+
         self.slices = Settings('Slice to reconstruct',
                                   dtype=int, 
                                   initial=0, 
@@ -152,6 +173,10 @@ class ReconstructionWidget(QWidget):
         calculate_btn.clicked.connect(self.stack_reconstruction)
         slayout.addWidget(calculate_btn)
 
+        cancel_btn = QPushButton('Cancel')
+        cancel_btn.clicked.connect(self.cancel_reconstruction)
+        slayout.addWidget(cancel_btn)
+
     def show_image(self, image_values, fullname, **kwargs):
         
         if 'scale' in kwargs.keys():    
@@ -185,128 +210,105 @@ class ReconstructionWidget(QWidget):
         
     def stack_reconstruction(self):
         
+        imname = 'stack_' + self.imageRaw_name
+        self.cancel_requested = False
+        
+        self.h.order_mode = self.orderbox.val
+        self.h.resize_bool = self.reshapebox.val
+        self.h.resize_val = self.resizebox.val
+        self.h.chunk_size = self.chunkbox.val
+
+        if self.fullvolume.val == True:
+            
+            # Output layer created up front and filled in place as slabs are reconstructed. Lazy layers (dask, zarr) and 
+            # out-of-core mode write to a zarr store, read from disk by the viewer
+            detector_count, _, number_slices = self.h.orient(self.get_sinos()).shape
+            image_size = self.h.reconstruction_size(detector_count)
+            volume = None
+            
+            if self.outofcorebox.val == True or not isinstance(self.get_sinos(), np.ndarray):
+                try:
+                    volume = self.h.create_output_store(imname, (number_slices, image_size, image_size))
+                    self.viewer.status = 'Writing {} to {}'.format(imname, os.path.join(self.h.output_folder, imname+'.zarr'))
+                except ImportError as error:
+                    warnings.warn('{}. Reconstructing to memory instead'.format(error))
+            
+            if volume is None:
+                volume = np.zeros((number_slices, image_size, image_size), dtype = np.float32)
+            
+            self.show_image(volume, fullname=imname, hold = True)
+            self.viewer.layers[imname].contrast_limits = [0, 255]
+
         def update_opt_image(stack):
             
-            imname = 'stack_' + self.imageRaw_name
-            self.show_image(stack, fullname=imname)
-                
-            print('Stack reconstruction completed')
+            # Volumes are already in the output layer
+            if stack is not None:
+                self.show_image(stack, fullname=imname)
             
-        
-        @thread_worker(connect={'returned':update_opt_image})
+            if self.cancel_requested == True:
+                print('Stack reconstruction cancelled')
+            else:
+                print('Stack reconstruction completed')
+            
+        def update_status(progress):
+            
+            slices_done, number_slices, elapsed_time = progress
+            throughput = slices_done/elapsed_time
+            self.viewer.status = 'Reconstructed {}/{} slices, {:.1f} slices/s, {:.0f} s left'.format(slices_done, number_slices, throughput, (number_slices-slices_done)/throughput)
+            self.viewer.layers[imname].refresh()
+
+        @thread_worker(connect={'returned':update_opt_image, 'yielded':update_status})
         def _reconstruct():
             '''
             ToDO: Link projections
             '''
+            time_in = time()
 
-            
-            if self.orderbox.val == 0:
-                sinos = np.moveaxis(np.float32(self.get_sinos()), 1, 2)
-                self.h.theta, self.h.Q, self.h.Z = sinos.shape
-            elif self.orderbox.val == 1:
+            if self.fullvolume.val == True:
                 
-                sinos = np.moveaxis(np.float32(self.get_sinos()), 0, 1)
-                self.h.Q, self.h.theta, self.h.Z = sinos.shape
+                shift = self.alignbox.val if self.manualalignbox.val == True else 0
+                chunks = self.h.reconstruct_chunks(self.get_sinos(), volume, shift = shift, register = self.registerbox.val, normalize = True)
 
-            if self.reshapebox.val == True:
-                
-                optVolume = np.zeros([
-                    self.resizebox.val, self.resizebox.val, self.h.Z], np.float32)
-                sinos = self.h.resize(sinos)
-                
-            else:
+                for slices_done in chunks:
+                    
+                    yield slices_done, number_slices, time()-time_in
+                    
+                    if self.cancel_requested == True:
+                        # Drops pending tasks and releases the shared memory of the slab in progress
+                        chunks.close()
+                        break
                 
-                optVolume = np.zeros([
-                    int(np.ceil(self.h.Q/np.sqrt(2))), int(np.ceil(self.h.Q/np.sqrt(2))), self.h.Z], np.float32)
+                print('Tiempo de cómputo total: {} s'.format(round(time()-time_in, 3)))
+                return None
 
-            time_in = time()
+            zidx = self.slices.val
             
-            if self.fullvolume.val == True:
-                slices = np.arange(self.h.Z)
+            if self.registerbox.val == True:
+                # Rotation axis estimated from opposing projections on a few slices, cached for this volume. Same shifts as 
+                # the full volume reconstruction
+                shift = self.h.estimate_layer_axis_shifts(self.get_sinos())[zidx]
+            elif self.manualalignbox.val == True:
+                shift = self.alignbox.val
             else:
-                slices = [self.slices.val]
-            
-            if self.fullvolume.val == True:
-
-                for zidx in tqdm.tqdm(slices):
-                    
-                    if self.registerbox.val == True:
-                        
-                        # sinos[:,:,zidx] = cv2.normalize(sinos[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                        if self.orderbox.val == 0:
-                            optVolume[:,:, zidx] = self.h.correct_and_reconstruct(sinos[:,:,zidx].T)
-                        elif self.orderbox.val == 1:
-                            optVolume[:,:, zidx] = self.h.correct_and_reconstruct(sinos[:,:,zidx])
-                        optVolume[:,:,zidx] = cv2.normalize(optVolume[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                    
-                    elif self.manualalignbox.val == True:
-
-                        # sinos[:,:,zidx] = cv2.normalize(sinos[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-
-                        if self.orderbox.val == 0:
-                            optVolume[:,:, zidx] = self.h.reconstruct(ndi.shift(sinos[:,:,zidx], (0, self.alignbox.val), mode = 'nearest').T)
-                        elif self.orderbox.val == 1:
-                            optVolume[:,:, zidx] = self.h.reconstruct(ndi.shift(sinos[:,:,zidx], (self.alignbox.val, 0), mode = 'nearest'))
-
-                        optVolume[:,:,zidx] = cv2.normalize(optVolume[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-
-                    else:
-                        
-                        # sinos[:,:,zidx] = cv2.normalize(sinos[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                        if self.orderbox.val == 0:
-                            
-                            optVolume[:,:, zidx] = self.h.reconstruct(sinos[:,:,zidx].T)
-
-                        elif self.orderbox.val == 1:
-                            
-                            optVolume[:,:, zidx] = self.h.reconstruct(sinos[:,:,zidx])
-                        
-                        optVolume[:,:,zidx] = cv2.normalize(optVolume[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                        print(zidx, optVolume[:,:,zidx].mean(), "hola")
+                shift = 0
             
-            else:
-
-                for zidx in tqdm.tqdm(slices):
-                    
-                    if self.registerbox.val == True:
-                        
-                        # sinos[:,:,zidx] = cv2.normalize(sinos[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                        if self.orderbox.val == 0:
-                            slicevol = self.h.correct_and_reconstruct(sinos[:,:,zidx].T)
-                        elif self.orderbox.val == 1:
-                            slicevol = self.h.correct_and_reconstruct(sinos[:,:,zidx])
-                        slicevol = cv2.normalize(slicevol, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                    
-                    elif self.manualalignbox.val == True:
-
-                        # sinos[:,:,zidx] = cv2.normalize(sinos[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-
-                        if self.orderbox.val == 0:
-                            slicevol = self.h.reconstruct(ndi.shift(sinos[:,:,zidx], (0, self.alignbox.val), mode = 'nearest').T)
-                        elif self.orderbox.val == 1:
-                            slicevol = self.h.reconstruct(ndi.shift(sinos[:,:,zidx], (self.alignbox.val, 0), mode = 'nearest'))
+            # Only the selected slice is read from the layer, as a (det, angles) sinogram (resampled if reshapebox is set)
+            sinogram = self.h.read_slab(self.get_sinos(), zidx, zidx+1)[:, :, 0]
+            slicevol = self.h.reconstruct(ndi.shift(sinogram, (shift, 0), mode = 'nearest'))
+            slicevol = cv2.normalize(slicevol, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
 
-                        slicevol = cv2.normalize(slicevol, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-
-                    else:
-                        
-                        # sinos[:,:,zidx] = cv2.normalize(sinos[:,:,zidx], None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-                        if self.orderbox.val == 0:
-                            
-                            slicevol = self.h.reconstruct(sinos[:,:,zidx].T)
-
-                        elif self.orderbox.val == 1:
-                            
-                            slicevol = self.h.reconstruct(sinos[:,:,zidx])
-                        
-                        slicevol = cv2.normalize(slicevol, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
-
-                    
             print('Tiempo de cómputo total: {} s'.format(round(time()-time_in, 3)))
-            return np.rollaxis(optVolume, -1) if self.fullvolume.val == True else slicevol
+            return slicevol
 
         _reconstruct()
     
+    def cancel_reconstruction(self):
+        '''
+        Stops the running stack reconstruction after the current slab task. Slices already reconstructed stay in the
+        output layer.
+        '''
+        self.cancel_requested = True
+    
     def get_sinos(self):
         try:
             
@@ -328,6 +330,8 @@ class ReconstructionWidget(QWidget):
             self.h.order_mode = self.orderbox.val
             self.h.clip_to_circle = self.clipcirclebox.val
             self.h.use_filter = self.filterbox.val
+            self.h.denoiser_precision = 'bfloat16' if self.bfloat16box.val else 'float32'
+            self.h.chunk_size = self.chunkbox.val
             
             self.h.set_reconstruction_process()
 
@@ -0,0 +1,269 @@
+'''
+Testing OPTProcessor sinogram preprocessing
+'''
+import os
+
+import cv2
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+from skimage.transform import iradon, radon
+
+from napari_tomodl.processors import OPTProcessor as opt
+from napari_tomodl.processors.OPTProcessor import OPTProcessor, Order_Modes, Rec_Modes, estimate_axis_shift
+
+def phantom_sinogram(size = 64, number_angles = 200):
+    '''
+    Sinogram (det, angles) over 360 degrees of a few random disks.
+    '''
+    rng = np.random.default_rng(0)
+    image = np.zeros((size, size))
+    yy, xx = np.mgrid[:size, :size]-size/2
+
+    for _ in range(6):
+        cx, cy = rng.uniform(-15, 15, 2)
+        image += ((xx-cx)**2+(yy-cy)**2 < rng.uniform(3, 8)**2)*rng.uniform(0.5, 1)
+
+    return radon(image, np.linspace(0, 360, number_angles, endpoint = False), circle = False)
+
+@pytest.mark.parametrize('offset', [-7.3, -2.5, 0, 1.25, 4.6])
+def test_estimate_axis_shift(offset):
+    '''
+    Checks the shift that centres a sinogram whose rotation axis is offset by a known amount.
+    '''
+    sinogram = ndi.shift(phantom_sinogram(), (offset, 0), mode = 'nearest')
+
+    # Measured error below 0.08 px
+    assert estimate_axis_shift(sinogram) == pytest.approx(-offset, abs = 0.15)
+
+def test_estimate_axis_shifts_follow_linear_drift():
+    '''
+    Checks the per-slice shifts fitted over z for an axis drifting linearly along the volume.
+    '''
+    sinogram = phantom_sinogram()
+    offsets = np.linspace(-3, 2, 20)
+    sinograms = np.stack([ndi.shift(sinogram, (offset, 0), mode = 'nearest') for offset in offsets], axis = -1)
+
+    shifts = OPTProcessor().estimate_axis_shifts(sinograms)
+
+    assert shifts.shape == (20,)
+    np.testing.assert_allclose(shifts, -offsets, atol = 0.15)
+
+class RecordingLayer:
+    '''
+    Layer data that records the slices read from it, as a lazy array would load them.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.reads = []
+
+    def transpose(self, *axes):
+        return self.data.transpose(*axes)
+
+    def __getitem__(self, index):
+        self.reads.append(index)
+        return self.data[index]
+
+@pytest.mark.parametrize('order_mode', [Order_Modes.Vertical.value, Order_Modes.Horizontal.value])
+def test_read_slab_loads_only_its_slices(order_mode):
+    '''
+    Checks that read_slab resizes the requested slices as resize does on the whole layer, reading only those slices.
+    '''
+    processor = OPTProcessor()
+    processor.order_mode = order_mode
+    processor.resize_val = 20
+    data = np.random.default_rng(0).random((30, 8, 25) if order_mode == Order_Modes.Vertical.value else (30, 25, 8))
+    layer = RecordingLayer(data)
+
+    slab = processor.read_slab(layer, 3, 5)
+
+    z_axis = 1 if order_mode == Order_Modes.Vertical.value else 2
+    assert len(layer.reads) == 1 and layer.reads[0][z_axis] == slice(3, 5)
+    np.testing.assert_array_equal(slab, processor.resize(data)[:, :, 3:5])
+
+@pytest.mark.parametrize('order_mode', [Order_Modes.Vertical.value, Order_Modes.Horizontal.value])
+@pytest.mark.parametrize('resize_bool', [True, False])
+def test_resize_matches_per_slice_cv2(order_mode, resize_bool):
+    '''
+    Checks the single-copy resize against the previous pipeline: float32 copy, reorientation and one cv2.resize per slice.
+    '''
+    rng = np.random.default_rng(0)
+    number_angles, detector_count, number_slices = 90, 77, 6
+    processor = OPTProcessor()
+    processor.order_mode = order_mode
+    processor.resize_bool = resize_bool
+    processor.resize_val = 40
+    resized_count = int(np.ceil(processor.resize_val*np.sqrt(2)))
+
+    if order_mode == Order_Modes.Vertical.value:
+        layer = rng.integers(0, 2**16, (number_angles, number_slices, detector_count), dtype = np.uint16)
+        # (angles, det, Z), resized along det, then (det, angles, Z)
+        sinograms = np.moveaxis(np.float32(layer), 1, 2)
+        reference = np.stack([cv2.resize(sinograms[:, :, idx], (resized_count, number_angles), interpolation = cv2.INTER_NEAREST) for idx in range(number_slices)], axis = -1) if resize_bool else sinograms
+        reference = np.moveaxis(reference, 0, 1)
+    else:
+        layer = rng.integers(0, 2**16, (number_angles, detector_count, number_slices), dtype = np.uint16)
+        # (det, angles, Z), resized along det
+        sinograms = np.moveaxis(np.float32(layer), 0, 1)
+        reference = np.stack([cv2.resize(sinograms[:, :, idx], (number_angles, resized_count), interpolation = cv2.INTER_NEAREST) for idx in range(number_slices)], axis = -1) if resize_bool else sinograms
+
+    resized = processor.resize(layer)
+
+    assert resized.dtype == np.float32 and resized.flags['C_CONTIGUOUS']
+    assert (processor.Q, processor.theta, processor.Z) == (detector_count, number_angles, number_slices)
+    np.testing.assert_array_equal(resized, reference)
+
+def test_reconstruct_chunks_reuses_process_pool(tmp_path, monkeypatch):
+    '''
+    Checks the out-of-core FBP reconstruction against iradon slice by slice, with a single process pool for every slab 
+    and the store written to output_folder.
+    '''
+    pytest.importorskip('zarr')
+    processor = OPTProcessor()
+    processor.rec_process = Rec_Modes.FBP_CPU.value
+    processor.order_mode = Order_Modes.Horizontal.value
+    processor.resize_bool = False
+    processor.chunk_size = 3
+    processor.output_folder = str(tmp_path)
+    pools = []
+    create_process_pool = processor.create_process_pool
+    monkeypatch.setattr(processor, 'create_process_pool', lambda: pools.append(create_process_pool()) or pools[-1])
+
+    # (angles, det, Z) layer of 7 slices
+    sinograms = np.stack([phantom_sinogram(32, 60)*(idx+1) for idx in range(7)], axis = -1)
+    layer = np.ascontiguousarray(np.moveaxis(sinograms, 0, 1))
+    image_size = processor.reconstruction_size(sinograms.shape[0])
+    out = processor.create_output_store('stack', (7, image_size, image_size))
+
+    assert list(processor.reconstruct_chunks(layer, out))[-1] == 7
+    assert len(pools) == 1 and (tmp_path/'stack.zarr').exists()
+
+    angles = np.linspace(0, 360, 60, endpoint = False)
+    reference = np.stack([iradon(sinograms[:, :, idx], angles, circle = False, filter_name = None) for idx in range(7)])
+    np.testing.assert_allclose(out[:], reference, rtol = 1e-4, atol = 1e-4)
+
+    monkeypatch.setattr(opt, 'zarr', None)
+
+    with pytest.raises(ImportError, match = 'zarr'):
+        processor.create_output_store('stack', (7, image_size, image_size))
+
+def fbp_processor():
+    '''
+    FBP_CPU processor for (angles, det, Z) layers, without resizing.
+    '''
+    processor = OPTProcessor()
+    processor.rec_process = Rec_Modes.FBP_CPU.value
+    processor.order_mode = Order_Modes.Horizontal.value
+    processor.resize_bool = False
+
+    return processor
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason = 'Shared memory blocks are listed in /dev/shm')
+def test_closing_parallel_stack_releases_shared_memory():
+    '''
+    Checks that closing the stack generator after the first task, as cancelling in the widget does, unlinks its shared 
+    memory blocks.
+    '''
+    processor = fbp_processor()
+    sinos = np.ascontiguousarray(np.repeat(np.float32(phantom_sinogram(32, 60))[..., None], 64, axis = -1))
+    processor.resize(np.moveaxis(sinos, 0, 1))
+    out = np.zeros((processor.reconstruction_size(sinos.shape[0]),)*2+(64,), dtype = np.float32)
+    blocks = set(os.listdir('/dev/shm'))
+
+    stack = processor.reconstruct_stack(sinos, range(64), out)
+    assert next(stack) > 0
+    stack.close()
+
+    assert set(os.listdir('/dev/shm')) <= blocks
+
+def test_reconstruct_chunks_registers_whole_volume(monkeypatch):
+    '''
+    Checks that every slab is reconstructed with the shifts of a single line fitted over the whole volume.
+    '''
+    processor = fbp_processor()
+    processor.chunk_size = 4
+    offsets = np.linspace(-3, 2, 10)
+    sinogram = phantom_sinogram()
+    layer = np.stack([ndi.shift(sinogram, (offset, 0), mode = 'nearest') for offset in offsets], axis = -1).transpose(1, 0, 2)
+    out = np.zeros((10,)+(processor.reconstruction_size(sinogram.shape[0]),)*2, dtype = np.float32)
+    slab_shifts = []
+    reconstruct_stack = processor.reconstruct_stack
+
+    def record_shifts(sinos, slices, slab, shift = 0, **kwargs):
+        slab_shifts.append(np.array(shift))
+        return reconstruct_stack(sinos, slices, slab, shift = shift, **kwargs)
+
+    monkeypatch.setattr(processor, 'reconstruct_stack', record_shifts)
+
+    list(processor.reconstruct_chunks(layer, out, register = True))
+    shifts = np.concatenate(slab_shifts)
+
+    assert len(slab_shifts) == 3
+    np.testing.assert_allclose(shifts, -offsets, atol = 0.15)
+    np.testing.assert_allclose(np.diff(shifts, 2), 0, atol = 1e-4)
+
+def test_onnx_mode_names_missing_extra(monkeypatch):
+    '''
+    Checks that MoDL ONNX reconstruction without onnxruntime raises an ImportError naming the extra to install.
+    '''
+    monkeypatch.setattr(opt, 'ort', None)
+    processor = OPTProcessor()
+    processor.rec_process = Rec_Modes.MODL_ONNX.value
+    processor.theta = 60
+
+    with pytest.raises(ImportError, match = r'napari-tomodl\[onnx\]'):
+        processor.set_iradon_function()
+
+def test_model_registry_evicts_least_recently_used(monkeypatch):
+    '''
+    Checks that a registered model is built once, that a fifth key evicts the least recently used model and that 
+    requesting a model refreshes it.
+    '''
+    monkeypatch.setattr(opt, 'model_registry', opt.OrderedDict())
+    builds = []
+
+    def build_model(key):
+        builds.append(key)
+        return 'model {}'.format(key)
+
+    for key in range(4):
+        assert opt.get_registered_model(key, lambda: build_model(key)) == 'model {}'.format(key)
+
+    assert opt.get_registered_model(0, lambda: build_model(0)) == 'model 0'
+    assert builds == [0, 1, 2, 3]
+
+    # 0 was just used, so 1 is the least recently used
+    opt.get_registered_model(4, lambda: build_model(4))
+
+    assert list(opt.model_registry) == [2, 3, 0, 4]
+
+    opt.get_registered_model(1, lambda: build_model(1))
+
+    assert builds == [0, 1, 2, 3, 4, 1]
+    assert list(opt.model_registry) == [3, 0, 4, 1]
+
+@pytest.mark.skipif(not os.path.isfile(os.path.join(os.path.dirname(opt.__file__), 'model.ckpt')), reason = 'Needs the bundled model.ckpt')
+def test_batched_stack_matches_single_slices():
+    '''
+    Checks the batched slab path of reconstruct_stack (MoDL on CPU) against reconstructing each shifted slice with 
+    reconstruct, with per-slice shifts and a batch size that leaves a smaller last slab.
+    '''
+    processor = OPTProcessor()
+    processor.rec_process = Rec_Modes.MODL_CPU.value
+    processor.set_reconstruction_process()
+    processor.order_mode = Order_Modes.Horizontal.value
+    sinogram = phantom_sinogram(64, 72)
+    # (angles, det, Z) layer
+    layer = np.ascontiguousarray(np.stack([sinogram*(1+0.1*idx) for idx in range(5)], axis = -1).transpose(1, 0, 2))
+    sinos = processor.resize(layer)
+    shifts = np.float32([0, 1.5, -2, 0.5, 3])
+    out = np.zeros((processor.resize_val, processor.resize_val, 5), dtype = np.float32)
+
+    assert list(processor.reconstruct_stack(sinos, range(5), out, shift = shifts, batch_size = 2)) == [2, 4, 5]
+    assert processor.iradon_batch_function is not None
+
+    reference = np.stack([np.squeeze(processor.reconstruct(ndi.shift(sinos[:, :, zidx], (shifts[zidx], 0), mode = 'nearest'))) for zidx in range(5)], axis = -1)
+
+    # Measured below 1e-6
+    np.testing.assert_allclose(out, reference, atol = 1e-4)
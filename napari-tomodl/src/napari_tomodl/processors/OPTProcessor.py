@@ -7,21 +7,38 @@ from skimage.transform import iradon as iradon_scikit
 
 
 import torch
-from .modl import ToMoDL
+from .modl import ToMoDL, load_tomodl_checkpoint, export_tomodl_onnx
+from .radon import cache_folder
 from .unet import UNet
 try:
     from torch_radon import Radon as radon_thrad
     use_cuda = True
 
 except:
+    from .radon import Radon as radon_thrad
     use_cuda = False
-    print('Torch-Radon not available!')
+    print('Torch-Radon not available! Using torch-native Radon operator')
 
 
 from .alternating import TwIST, TVdenoise, TVnorm
 
+try:
+    import onnxruntime as ort
+except ModuleNotFoundError:
+    ort = None
+
+try:
+    import zarr
+except ModuleNotFoundError:
+    zarr = None
+
 
 import numpy as np
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from multiprocessing import shared_memory
 from napari.layers import Image
 import scipy.ndimage as ndi
 import os
@@ -47,11 +64,168 @@ class Rec_Modes(Enum):
     UNET_GPU = 3
     MODL_GPU = 4
     MODL_CPU = 5
+    MODL_ONNX = 6
 
 class Order_Modes(Enum):
     Vertical = 0
     Horizontal = 1
 
+# torch.inference_mode is available from PyTorch 1.9, older versions only disable gradients
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+# Ready-to-run models shared by every OPTProcessor of the session, keyed by (mode, number of angles, resize_val, device)
+model_registry = OrderedDict()
+# Least recently used models are evicted beyond this number
+max_registered_models = 4
+
+def get_registered_model(key, build_model):
+    '''
+    Returns the model registered under key, building it with build_model only on the first request.
+    Params:
+        - key (tuple): (mode, number of angles, resize_val, device)
+        - build_model (callable): Returns the model ready for inference
+    '''
+    if key in model_registry:
+        model_registry.move_to_end(key)
+    else:
+        model_registry[key] = build_model()
+
+        while len(model_registry) > max_registered_models:
+            model_registry.popitem(last = False)
+
+    return model_registry[key]
+
+def checkpoint_hash(checkpoint_path):
+    '''
+    Returns a short SHA-1 digest of a checkpoint file, naming cached exports of its weights.
+    Params:
+        - checkpoint_path (string): Checkpoint file
+    '''
+    file_hash = hashlib.sha1()
+
+    with open(checkpoint_path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()[:16]
+
+def build_twist_function(angles, clip_to_circle):
+    '''
+    Returns the TwIST reconstruction of a sinogram (det, angles) with TV regularisation, as used by TWIST_CPU.
+    Params:
+        - angles (np.ndarray): Projection angles in degrees
+        - clip_to_circle (bool): Reconstruct only the circle inscribed in the image
+    '''
+    Psi = lambda x,th: TVdenoise(x,2/th, 3)
+    #  set the penalty function, to compute the objective
+    Phi = lambda x: TVnorm(x)
+
+    twist_dictionary = {'LAMBDA': 1e-4, 
+                        'TOLERANCEA':1e-4,
+                        'STOPCRITERION':1, 
+                        'VERBOSE':1,
+                        'INITIALIZATION':0,
+                        'MAXITERA':10000, 
+                        'GPU':0,
+                        'PSI': Psi,
+                        'PHI': Phi,
+
+                        }
+    
+    A = lambda x: radon_scikit(x, angles, circle = clip_to_circle)
+    AT = lambda sino: iradon_scikit(sino, angles, circle = clip_to_circle)
+    
+    return lambda sino: TwIST(sino, A, AT, 0.01, twist_dictionary, true_img = AT(sino))[0]
+
+def estimate_axis_shift(sinogram):
+    '''
+    Estimates the rotation axis offset of a sinogram by cross-correlating opposing projections. Over a full turn, the 
+    projection at θ+180° is the mirror image of the one at θ about the rotation axis, so the lag maximising the 
+    correlation of each projection with its flipped opposite is twice the axis offset. Correlations of all the pairs 
+    are summed in the Fourier domain and the peak is refined with a parabolic fit.
+    Params:
+        - sinogram (np.ndarray): Sinogram of shape (det, angles), with angles evenly spaced over 360 degrees
+    Returns:
+        - Shift along the detector axis, in pixels, that centres the rotation axis with ndi.shift(sinogram, (shift, 0))
+    '''
+    detector_count, number_angles = sinogram.shape
+    half_turn = number_angles//2
+
+    projections = sinogram[:, :half_turn].T
+    opposite_projections = sinogram[::-1, half_turn:2*half_turn].T
+    projections = projections-projections.mean(axis = 1, keepdims = True)
+    opposite_projections = opposite_projections-opposite_projections.mean(axis = 1, keepdims = True)
+
+    # Zero padding to twice the detector size gives the linear (not circular) correlation
+    spectrum = (np.conj(np.fft.rfft(projections, n = 2*detector_count))*np.fft.rfft(opposite_projections, n = 2*detector_count)).sum(axis = 0)
+    correlation = np.fft.fftshift(np.fft.irfft(spectrum, n = 2*detector_count))
+
+    peak = int(np.argmax(correlation))
+    lag = peak-detector_count
+
+    if 0 < peak < 2*detector_count-1:
+
+        left, centre, right = correlation[peak-1:peak+2]
+        curvature = left-2*centre+right
+        
+        if curvature != 0:
+            lag += 0.5*(left-right)/curvature
+
+    # The lag moves the axis to the centre of the detector span, iradon_scikit rotates about pixel det//2
+    return (lag+2*(detector_count//2)-detector_count+1)/2
+
+def normalize_slices(volume):
+    '''
+    Normalises each slice of a volume of shape (N, N, Z) between 0 and 255 in place, as cv2.normalize with NORM_MINMAX.
+    '''
+    minimum = volume.min(axis = (0, 1))
+    scale = volume.max(axis = (0, 1))-minimum
+    volume -= minimum
+    volume *= 255/np.where(scale > 0, scale, 1)
+
+    return volume
+
+def reconstruct_shared_slices(arguments):
+    '''
+    Process pool task of OPTProcessor.reconstruct_stack: reconstructs slices of a sinogram volume held in shared memory
+    with FBP or TwIST, and writes them into the output volume, also in shared memory.
+    Params:
+        - arguments (tuple): (sinograms memory name, sinograms shape, output memory name, output shape, slices, settings),
+        where settings holds rec_process, angles, clip_to_circle, use_filter and shifts (one per slice of the volume)
+    Returns:
+        - Number of slices reconstructed
+    '''
+    sinos_name, sinos_shape, out_name, out_shape, slices, settings = arguments
+
+    sinos_memory = shared_memory.SharedMemory(name = sinos_name)
+    out_memory = shared_memory.SharedMemory(name = out_name)
+    sinos = np.ndarray(sinos_shape, dtype = np.float32, buffer = sinos_memory.buf)
+    out = np.ndarray(out_shape, dtype = np.float32, buffer = out_memory.buf)
+
+    if settings['rec_process'] == Rec_Modes.TWIST_CPU.value:
+        iradon_function = build_twist_function(settings['angles'], settings['clip_to_circle'])
+    else:
+        iradon_function = lambda sino: iradon_scikit(sino, 
+                                                     settings['angles'], 
+                                                     circle = settings['clip_to_circle'],
+                                                     filter_name= None if settings['use_filter'] == False else 'ramp')
+
+    for zidx in slices:
+        
+        sinogram = sinos[:, :, zidx]
+
+        if settings['shifts'][zidx] != 0:
+            sinogram = ndi.shift(sinogram, (settings['shifts'][zidx], 0), mode = 'nearest')
+
+        out[:, :, zidx] = iradon_function(sinogram)
+
+    # Views must be released before closing the shared blocks
+    del sinos, out
+    sinos_memory.close()
+    out_memory.close()
+
+    return len(slices)
+
 def my_filtering_function(pair):
     unwanted_key = 'num_batches'
     key, value = pair
@@ -72,12 +246,25 @@ class OPTProcessor:
         self.order_mode = Order_Modes.Vertical.value
         self.clip_to_circle = False
         self.use_filter = False
+        # Radon backend of the CPU MoDL operator: 'default' computes projections on the fly. 'sparse' opts in to a system
+        # matrix built once per geometry (about 15 s) and kept in memory and on disk, roughly 400 MB for 100 px and 720
+        # angles, growing with number_angles*resolution**2
+        self.radon_backend = 'default'
+        # MoDL denoiser precision, 'float32' or 'bfloat16' (faster on CPUs with bfloat16 support, DC stays in float32)
+        self.denoiser_precision = 'float32'
 
         self.resize_bool = True
         self.register_bool = True
         self.max_shift = 200
         self.shift_step = 10
         self.center_shift = 0
+        # Rotation axis shifts estimated for the last sinogram volume, see estimate_axis_shifts
+        self.axis_shifts = None
+        self.axis_shifts_key = None
+        # Number of slices read, reconstructed and written at once by reconstruct_chunks
+        self.chunk_size = 64
+        # Folder of the zarr stores written by create_output_store
+        self.output_folder = os.path.join(cache_folder, 'reconstructions')
 
         self.set_reconstruction_process()
     
@@ -148,50 +335,192 @@ class OPTProcessor:
 
         return self.correct_and_reconstruct(sinogram)
 
+    def estimate_axis_shifts(self, sinos: np.ndarray, number_slices = 5):
+        '''
+        Estimates the rotation axis shift of every slice of a sinogram volume from the sinograms alone. The shift is 
+        estimated with estimate_axis_shift on the most informative slice (highest intensity variance) of number_slices 
+        bands along z, and a line fitted to those shifts is evaluated on every slice, as DatasetProcessor.correct_rotation_axis 
+        interpolates between its top and bottom slices. Shifts are cached for the volume, so registering again is free.
+        Params:
+            - sinos (np.ndarray): Sinogram volume of shape (det, angles, Z), angles evenly spaced over 360 degrees
+            - number_slices (int): Number of slices the shift is estimated on
+        Returns:
+            - Shifts of shape (Z,), in pixels, to apply with ndi.shift(sinos[:, :, z], (shift, 0))
+        '''
+        return self.fit_axis_shifts(sinos, np.arange(sinos.shape[2]), sinos.shape[2], number_slices)
+
+    def estimate_layer_axis_shifts(self, sinogram_volume, number_slices = 5, candidates = 4):
+        '''
+        Estimates the rotation axis shift of every slice of the layer data as estimate_axis_shifts does, reading and 
+        resizing only number_slices*candidates slices evenly spread along z, so lazy layers are not loaded whole. The 
+        most informative slice of each band is chosen among its candidates.
+        Params:
+            - sinogram_volume (array-like): Layer data, numpy, dask or zarr array, in the layout expected by resize
+            - number_slices (int): Number of slices the shift is estimated on
+            - candidates (int): Number of slices read per band
+        Returns:
+            - Shifts of shape (Z,), in pixels
+        '''
+        number_total = self.orient(sinogram_volume).shape[2]
+        indexes = np.unique(np.linspace(0, number_total-1, number_slices*candidates).round().astype(int))
+        sinos = np.concatenate([self.read_slab(sinogram_volume, zidx, zidx+1) for zidx in indexes], axis = 2)
+
+        return self.fit_axis_shifts(sinos, indexes, number_total, number_slices)
+
+    def fit_axis_shifts(self, sinos: np.ndarray, indexes, number_total, number_slices):
+        '''
+        Line fit of estimate_axis_shifts and estimate_layer_axis_shifts. sinos holds the slices at z positions indexes 
+        of a volume of number_total slices, and the fitted shifts are cached for them.
+        '''
+        slice_std = sinos.std(axis = (0, 1))
+        key = (number_total, indexes.tobytes(), sinos.shape, slice_std.tobytes())
+
+        if self.axis_shifts_key == key:
+            return self.axis_shifts
+
+        bands = np.array_split(np.arange(sinos.shape[2]), min(number_slices, sinos.shape[2]))
+        chosen = np.array([band[np.argmax(slice_std[band])] for band in bands])
+        shifts = np.array([estimate_axis_shift(sinos[:, :, idx]) for idx in chosen])
+
+        line = np.polyfit(indexes[chosen], shifts, deg = min(1, len(chosen)-1))
+        self.axis_shifts = np.polyval(line, np.arange(number_total)).astype(np.float32)
+        self.axis_shifts_key = key
+
+        return self.axis_shifts
+
     def resize(self, sinogram_volume: np.ndarray):
         '''
-        Resizes sinogram prior to reconstruction.
+        Prepares the sinogram volume for reconstruction with a single copy. The layer data is reoriented through a strided 
+        view, converted to float32 and written as (det, angles, Z), so each slice is passed as is to reconstruct. If 
+        resize_bool is set, the detector axis is resampled to ceil(sqrt(2)*resize_val) bins with nearest neighbour 
+        interpolation, as cv2.resize with INTER_NEAREST.
         Args:
-            -sinogram_volume (np.ndarray): array to resize in any mode specified.
+            -sinogram_volume (np.ndarray): layer data, with shape (angles, Z, det) in Vertical mode and (angles, det, Z) in
+            Horizontal mode.
+        Returns:
+            - Sinogram volume of shape (det, angles, Z)
         '''
+        sinogram_view = self.orient(sinogram_volume)
+        self.Q, self.theta, self.Z = sinogram_view.shape
+
+        if self.resize_bool == False:
+            
+            return np.ascontiguousarray(sinogram_view, dtype = np.float32)
+
+        detector_count = int(np.ceil(self.resize_val*np.sqrt(2)))
+        # Source bin of each resampled bin, as computed by cv2 INTER_NEAREST
+        detector_indexes = np.minimum(np.arange(detector_count)*self.Q//detector_count, self.Q-1)
+        sinogram_resize = np.empty((detector_count, self.theta, self.Z), dtype = np.float32)
         
+        # Each bin is a (angles, Z) plane, copied and converted at once for all the slices
+        for idx, detector_idx in enumerate(detector_indexes):
+            sinogram_resize[idx] = sinogram_view[detector_idx]
+
+        return sinogram_resize
+    
+    def read_slab(self, sinogram_volume, start, stop):
+        '''
+        Reads slices start to stop of the layer data and resizes them. Only those slices are loaded, computed on demand 
+        for dask arrays.
+        Params:
+            - sinogram_volume (array-like): Layer data, numpy, dask or zarr array, in the layout expected by resize
+            - start, stop (int): Range of slices along z
+        Returns:
+            - Sinograms of shape (det, angles, stop-start)
+        '''
+        index = [slice(None)]*3
+        index[1 if self.order_mode == Order_Modes.Vertical.value else 2] = slice(start, stop)
+
+        return self.resize(np.asarray(sinogram_volume[tuple(index)]))
+
+    def orient(self, sinogram_volume):
+        '''
+        Returns the layer data as a (det, angles, Z) strided view for the current order mode, without copying. Works as 
+        well on lazy arrays, such as dask arrays.
+        '''
         if self.order_mode == Order_Modes.Vertical.value:
-            self.theta, self.Q, self.Z = sinogram_volume.shape
-        if self.order_mode == Order_Modes.Horizontal.value:
-            self.Q, self.theta, self.Z = sinogram_volume.shape
+            return sinogram_volume.transpose(2, 0, 1)
+        elif self.order_mode == Order_Modes.Horizontal.value:
+            return sinogram_volume.transpose(1, 0, 2)
 
+    def reconstruction_size(self, detector_count):
+        '''
+        Side of the reconstructed slices, in pixels, for sinograms with detector_count bins before resizing. Without 
+        resizing, this is the output size of iradon_scikit.
+        '''
         if self.resize_bool == True:
-            
-            if self.order_mode == Order_Modes.Vertical.value:
-                
-                sinogram_resize = np.zeros((self.theta, int(np.ceil(self.resize_val*np.sqrt(2))),
-                                        self.Z),
-                                        dtype = np.float32)
-                
-            if self.order_mode == Order_Modes.Horizontal.value:
-                
-                sinogram_resize = np.zeros((int(np.ceil(self.resize_val*np.sqrt(2))), self.theta,
-                                        self.Z),
-                                        dtype = np.float32)
-                
-            for idx in tqdm.tqdm(range(self.Z)):
-                
-                if self.order_mode == Order_Modes.Vertical.value:
+            return self.resize_val
+        
+        return detector_count if self.clip_to_circle == True else int(np.floor(np.sqrt(detector_count**2/2)))
 
-                    sinogram_resize[:,:,idx] = cv2.resize(sinogram_volume[:,:,idx], 
-                                                      (int(np.ceil(self.resize_val*np.sqrt(2))), self.theta),
-                                                      interpolation = cv2.INTER_NEAREST)
-                    
+    def create_output_store(self, name, shape):
+        '''
+        Creates a zarr array on disk, chunked along z by chunk_size, to write reconstructions larger than memory. Stores 
+        are kept in output_folder, and overwritten when a volume with the same name is written.
+        Params:
+            - name (string): Name of the store, usually the name of the output layer
+            - shape (tuple): (Z, N, N) shape of the reconstructed volume
+        '''
+        if zarr is None:
+            raise ImportError('Out-of-core reconstruction needs zarr, install it with pip install napari-tomodl[outofcore]')
+        
+        store_path = os.path.join(self.output_folder, name+'.zarr')
+        os.makedirs(self.output_folder, exist_ok = True)
+        print('Writing reconstruction to {}'.format(store_path))
 
-                elif self.order_mode == Order_Modes.Horizontal.value:
-                    
-                    sinogram_resize[:,:,idx] = cv2.resize(sinogram_volume[:,:,idx], 
-                                                      (self.theta, int(np.ceil(self.resize_val*np.sqrt(2)))),
-                                                      interpolation = cv2.INTER_NEAREST)
+        return zarr.open_array(store = store_path, mode = 'w', shape = shape, chunks = (self.chunk_size,)+tuple(shape[1:]), dtype = np.float32)
+
+    def reconstruct_chunks(self, sinogram_volume, out, shift = 0, register = False, normalize = False):
+        '''
+        Out-of-core reconstruction of a whole volume, yielding the number of slices done. Slabs of chunk_size slices are 
+        read from the layer data (computed on demand for dask arrays), resized, reconstructed with reconstruct_stack and 
+        written to out, so memory use is bounded by the slab size rather than by the volume size. The count yielded after 
+        writing a slab is its last slice, so a viewer showing out can refresh it as slabs arrive.
+        Params:
+            - sinogram_volume (array-like): Layer data, numpy, dask or zarr array, in the layout expected by resize
+            - out (array-like): Output of shape (Z, N, N), such as the zarr array returned by create_output_store
+            - shift (float or np.ndarray): Rotation axis shift along the detector axis, in pixels. Either one shift for the 
+            whole volume or one per slice
+            - register (bool): Estimates the rotation axis shifts instead, once for the whole volume before the first slab, 
+            with estimate_layer_axis_shifts
+            - normalize (bool): Normalises each slice between 0 and 255 before writing it
+        '''
+        detector_count, number_angles, number_slices = self.orient(sinogram_volume).shape
+        image_size = self.reconstruction_size(detector_count)
+
+        if register == True:
+            shift = self.estimate_layer_axis_shifts(sinogram_volume)
+
+        shifts = np.broadcast_to(np.float32(shift), (number_slices,))
+
+        # Processes of FBP_CPU and TWIST_CPU are started once and kept for every slab
+        self.theta = number_angles
+        self.set_iradon_function()
+        executor = self.create_process_pool() if self.iradon_batch_function is None else None
+
+        try:
+            for start in range(0, number_slices, self.chunk_size):
+
+                stop = min(start+self.chunk_size, number_slices)
+                sinos = self.read_slab(sinogram_volume, start, stop)
+                slab = np.zeros((image_size, image_size, stop-start), dtype = np.float32)
+
+                for slices_done in self.reconstruct_stack(sinos, range(stop-start), slab, shift = shifts[start:stop], executor = executor):
                     
+                    if start+slices_done < stop:
+                        yield start+slices_done
+
+                if normalize == True:
+                    normalize_slices(slab)
+
+                out[start:stop] = np.moveaxis(slab, -1, 0)
+                # Slices before stop are in out from here on
+                yield stop
+        
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-        return sinogram_resize
-    
     def reconstruct(self, sinogram: np.ndarray):
         '''
         Reconstruct with specific method
@@ -200,6 +529,19 @@ class OPTProcessor:
             * Optimize GPU usage with tensors
 
         '''
+        self.set_iradon_function()
+        
+        reconstruction = self.iradon_function(sinogram) 
+
+        return reconstruction
+
+    def set_iradon_function(self):
+        '''
+        Sets the slice reconstruction function of the current method (iradon_function) and, for learned methods and 
+        FBP_GPU, the slab reconstruction function (iradon_batch_function). Models are taken from the model registry.
+        '''
+        self.iradon_batch_function = None
+
         ## Es un enriedo, pero inicializa los generadores de ángulos. Poco claro
         if self.init_volume_rec == False:
             
@@ -230,6 +572,9 @@ class OPTProcessor:
             else:
                 self.iradon_function = lambda sino: self.iradon_functor.backprojection(self.iradon_functor.filter_sinogram(torch.Tensor(sino.T).to(device))).cpu().numpy()
 
+            filter_sinogram = (lambda sinos: sinos) if self.use_filter == False else self.iradon_functor.filter_sinogram
+            self.iradon_batch_function = lambda sinos: self.iradon_functor.backprojection(filter_sinogram(torch.Tensor(sinos.transpose(0, 2, 1)).to(device))).cpu().numpy()
+
         elif self.rec_process == Rec_Modes.FBP_CPU.value:
             
             self.iradon_function = lambda sino: iradon_scikit(sino, 
@@ -251,30 +596,25 @@ class OPTProcessor:
             self.tomodl_dictionary = {'use_torch_radon': True,
                                     'metric': 'psnr',
                                     'K_iterations' : 8,
-                                    'number_projections_total' : sinogram.shape[0],
+                                    'number_projections_total' : self.theta,
                                     'acceleration_factor': 10,
                                     'image_size': 100,
                                     'lambda': 0.01,
+                                    # Inference only: each DC solve starts from the previous one
+                                    'cg_warm_start': True,
                                     'use_shared_weights': True,
                                     'denoiser_method': 'resnet',
                                     'resnet_options': resnet_options_dict,
                                     'in_channels': 1,
                                     'out_channels': 1}
                             
-            self.iradon_functor = ToMoDL(self.tomodl_dictionary)
-            
-            __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-            artifact_path = os.path.join(__location__, 'model.ckpt')
-            tomodl_checkpoint = torch.load(artifact_path, map_location = torch.device("cuda:0"))
-
-            tomodl_checkpoint['state_dict'] = {k.replace("model.", ""): v for (k,v) in tomodl_checkpoint['state_dict'].items()}
-
-            self.iradon_functor.load_state_dict(dict(filter(my_filtering_function, tomodl_checkpoint['state_dict'].items())))
+            self.iradon_functor = self.load_modl(self.tomodl_dictionary, torch.device("cuda:0"))
             self.iradon_function = lambda sino: self.iradon_functor(
                                                     torch.Tensor(
                                                         iradon_scikit(sino, 
                                                                       self.angles, 
                                                                       circle = self.clip_to_circle, filter_name = None)).to(device).unsqueeze(0).unsqueeze(1))['dc'+str(self.tomodl_dictionary['K_iterations'])].detach().cpu().numpy()
+            self.iradon_batch_function = lambda sinos: self.iradon_functor(torch.from_numpy(self.backproject_batch(sinos)).to(device))['dc'+str(self.tomodl_dictionary['K_iterations'])].detach().cpu().numpy()[:, 0]
 
         elif self.rec_process == Rec_Modes.MODL_CPU.value:
             
@@ -290,63 +630,229 @@ class OPTProcessor:
             self.tomodl_dictionary = {'use_torch_radon': True,
                                     'metric': 'psnr',
                                     'K_iterations' : 8,
-                                    'number_projections_total' : sinogram.shape[0],
+                                    'number_projections_total' : self.theta,
                                     'acceleration_factor': 32,
                                     'image_size': 100,
                                     'lambda': 0.025,
+                                    # Inference only: each DC solve starts from the previous one
+                                    'cg_warm_start': True,
+                                    'radon_backend': self.radon_backend,
                                     'use_shared_weights': True,
                                     'denoiser_method': 'resnet',
                                     'resnet_options': resnet_options_dict,
                                     'in_channels': 1,
                                     'out_channels': 1}
                             
-            self.iradon_functor = ToMoDL(self.tomodl_dictionary)
-            
-            __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-            artifact_path = os.path.join(__location__, 'model.ckpt')
-            tomodl_checkpoint = torch.load(artifact_path, map_location = torch.device("cpu"))
-
-            tomodl_checkpoint['state_dict'] = {k.replace("model.", ""): v for (k,v) in tomodl_checkpoint['state_dict'].items()}
-
-            self.iradon_functor.load_state_dict(dict(filter(my_filtering_function, tomodl_checkpoint['state_dict'].items())))
+            self.iradon_functor = self.load_modl(self.tomodl_dictionary, torch.device("cpu"))
             self.iradon_function = lambda sino: self.iradon_functor(
                                                     torch.Tensor(
                                                         iradon_scikit(sino, 
                                                                       self.angles, 
                                                                       circle = self.clip_to_circle, filter_name = None)).to(device).unsqueeze(0).unsqueeze(1))['dc'+str(self.tomodl_dictionary['K_iterations'])].detach().cpu().numpy()
+            self.iradon_batch_function = lambda sinos: self.iradon_functor(torch.from_numpy(self.backproject_batch(sinos)).to(device))['dc'+str(self.tomodl_dictionary['K_iterations'])].detach().cpu().numpy()[:, 0]
+
+        elif self.rec_process == Rec_Modes.MODL_ONNX.value:
+            
+            if ort is None:
+                raise ImportError('MoDL ONNX reconstruction needs onnxruntime, install it with pip install napari-tomodl[onnx]')
+            
+            session = self.load_onnx_session(self.theta)
+            self.iradon_function = lambda sino: session.run(None, {'x': np.float32(iradon_scikit(sino, 
+                                                                                                 self.angles, 
+                                                                                                 circle = self.clip_to_circle, filter_name = None))[None, None]})[0]
+            self.iradon_batch_function = lambda sinos: session.run(None, {'x': self.backproject_batch(sinos)})[0][:, 0]
 
         elif self.rec_process == Rec_Modes.TWIST_CPU.value:
 
-            Psi = lambda x,th: TVdenoise(x,2/th, 3)
-            #  set the penalty function, to compute the objective
-            Phi = lambda x: TVnorm(x)
-
-            twist_dictionary = {'LAMBDA': 1e-4, 
-                                'TOLERANCEA':1e-4,
-                                'STOPCRITERION':1, 
-                                'VERBOSE':1,
-                                'INITIALIZATION':0,
-                                'MAXITERA':10000, 
-                                'GPU':0,
-                                'PSI': Psi,
-                                'PHI': Phi,
-
-                                }
-            
-            A = lambda x: radon_scikit(x, self.angles, circle = self.clip_to_circle)
-            AT = lambda sino: iradon_scikit(sino, self.angles, circle = self.clip_to_circle)
-            self.iradon_function = lambda sino: TwIST(sino, A, AT, 0.01, twist_dictionary, true_img = AT(sino))[0]
+            self.iradon_function = build_twist_function(self.angles, self.clip_to_circle)
             
         elif self.rec_process == Rec_Modes.UNET_GPU.value:    
 
-            self.iradon_functor = UNet(n_channels = 1, n_classes= 1, residual = True, up_conv = True, batch_norm = True, batch_norm_inconv = True).to(device)
+            build_unet = lambda: UNet(n_channels = 1, n_classes= 1, residual = True, up_conv = True, batch_norm = True, batch_norm_inconv = True).to(device).freeze()
+            self.iradon_functor = get_registered_model((self.rec_process, self.theta, self.resize_val, str(device)), build_unet)
             AT_tensor = lambda sino: torch.Tensor(iradon_scikit(sino, self.angles, circle = self.clip_to_circle, filter_name = None)).to(device).unsqueeze(0).unsqueeze(1)
             
             self.iradon_function = lambda sino: self.iradon_functor(AT_tensor(sino)).detach().cpu().numpy()
+            self.iradon_batch_function = lambda sinos: self.iradon_functor(torch.from_numpy(self.backproject_batch(sinos)).to(device)).detach().cpu().numpy()[:, 0]
 
+        # Reconstruction only: torch-based methods record no autograd graph and skip version counting
+        self.iradon_function = inference_mode()(self.iradon_function)
+
+        if self.iradon_batch_function is not None:
+            self.iradon_batch_function = inference_mode()(self.iradon_batch_function)
+
+    def backproject_batch(self, sinograms: np.ndarray):
+        '''
+        Unfiltered backprojections of a slab of sinograms, as computed for a single slice by the learned methods.
+        Params:
+            - sinograms (np.ndarray): Sinograms of shape (B, det, angles)
+        Returns:
+            - Backprojections as a float32 array of shape (B, 1, N, N)
+        '''
+        return np.float32([iradon_scikit(sino, self.angles, circle = self.clip_to_circle, filter_name = None) for sino in sinograms])[:, None]
+
+    def reconstruct_stack(self, sinos: np.ndarray, slices, out: np.ndarray, shift = 0, batch_size = 16, executor = None):
+        '''
+        Reconstructs slices of a sinogram volume into out, yielding the number of slices done after each slab or task.
+        FBP_CPU and TWIST_CPU slices are distributed over a process pool (one process per core), which reads the sinograms 
+        and writes the reconstructions through shared memory. Learned methods and FBP_GPU reconstruct slabs of batch_size 
+        slices with a single batched call.
+        Params:
+            - sinos (np.ndarray): Sinogram volume of shape (det, angles, Z), so each slice is passed as to reconstruct
+            - slices (array-like): Indexes of the slices to reconstruct
+            - out (np.ndarray): Output volume of shape (N, N, Z), filled in place
+            - shift (float or np.ndarray): Rotation axis shift applied along the detector axis before reconstruction, in 
+            pixels. Either one shift for the whole volume or one per slice, as returned by estimate_axis_shifts
+            - batch_size (int): Number of slices per slab
+            - executor (ProcessPoolExecutor): Process pool from create_process_pool, reused across calls. If None, a pool
+            is started for this call
+        '''
+        self.set_iradon_function()
+        slices = list(slices)
+        shifts = np.broadcast_to(np.float32(shift), sinos.shape[2:])
+
+        if self.iradon_batch_function is None:
+
+            yield from self.reconstruct_stack_parallel(sinos, slices, out, shifts, executor = executor)
+            return
+
+        for start in range(0, len(slices), batch_size):
+
+            slab = slices[start:start+batch_size]
+            sinograms = np.float32([sinos[:, :, zidx] if shifts[zidx] == 0 else ndi.shift(sinos[:, :, zidx], (shifts[zidx], 0), mode = 'nearest') for zidx in slab])
+            
+            out[:, :, slab] = np.moveaxis(self.iradon_batch_function(sinograms), 0, -1)
+            
+            yield start+len(slab)
+
+    def create_process_pool(self):
+        '''
+        Process pool of reconstruct_stack_parallel, with one process per core. Processes are started with forkserver 
+        (spawn where it is not available) instead of being forked from the viewer, which runs Qt and torch threads.
+        '''
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+        return ProcessPoolExecutor(max_workers = os.cpu_count(), mp_context = multiprocessing.get_context(start_method))
+
+    def reconstruct_stack_parallel(self, sinos: np.ndarray, slices, out: np.ndarray, shifts, executor = None):
+        '''
+        Reconstructs slices with FBP or TwIST on a process pool, see reconstruct_stack. The sinogram volume and the output 
+        are copied once to shared memory, and each task reconstructs a chunk of slices. The pool is executor if given, 
+        otherwise one is started with create_process_pool and shut down on return.
+        '''
+        number_workers = os.cpu_count()
+        # A few chunks per process, so processes finishing early take more work
+        chunk_size = int(np.ceil(len(slices)/(4*number_workers)))
+        settings = {'rec_process': self.rec_process,
+                    'angles': self.angles,
+                    'clip_to_circle': self.clip_to_circle,
+                    'use_filter': self.use_filter,
+                    'shifts': np.asarray(shifts)}
+
+        sinos_memory = shared_memory.SharedMemory(create = True, size = sinos.size*np.dtype(np.float32).itemsize)
+        out_memory = shared_memory.SharedMemory(create = True, size = out.size*np.dtype(np.float32).itemsize)
+
+        shared_sinos = shared_out = None
+
+        try:
+            shared_sinos = np.ndarray(sinos.shape, dtype = np.float32, buffer = sinos_memory.buf)
+            shared_out = np.ndarray(out.shape, dtype = np.float32, buffer = out_memory.buf)
+            shared_sinos[:] = sinos
+
+            tasks = [(sinos_memory.name, sinos.shape, out_memory.name, out.shape, slices[start:start+chunk_size], settings) for start in range(0, len(slices), chunk_size)]
+            slices_done = 0
+            pool = self.create_process_pool() if executor is None else executor
+            futures = [pool.submit(reconstruct_shared_slices, task) for task in tasks]
+
+            try:
+                for future in as_completed(futures):
+                    
+                    slices_done += future.result()
+                    yield slices_done
+            
+            finally:
+                # If the generator is closed early, tasks not started yet are dropped
+                for future in futures:
+                    future.cancel()
+
+                if executor is None:
+                    pool.shutdown()
+
+            out[:, :, slices] = shared_out[:, :, slices]
         
-        reconstruction = self.iradon_function(sinogram) 
+        finally:
+            # Views must be released before closing the shared blocks, also when the generator is closed early or a task 
+            # fails, otherwise close raises BufferError and the blocks are never unlinked
+            shared_sinos = shared_out = None
+            sinos_memory.close()
+            sinos_memory.unlink()
+            out_memory.close()
+            out_memory.unlink()
+
+    def load_modl(self, tomodl_dictionary, map_location):
+        '''
+        Returns the MoDL model for the current mode, number of angles and size from the model registry. model.ckpt is 
+        loaded only when the model is not registered yet.
+        Params:
+            - tomodl_dictionary (dict): ToMoDL keyword dictionary
+            - map_location (torch.device): Device the model runs on
+        '''
+        def build_model():
+            
+            __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+            artifact_path = os.path.join(__location__, 'model.ckpt')
+            model = load_tomodl_checkpoint(artifact_path, tomodl_dictionary, map_location = map_location)
+            
+            # Inference only: no autograd graph, batch normalisation folded into the denoiser convolutions
+            return model.freeze()
 
-        return reconstruction
+        model = get_registered_model((self.rec_process, self.theta, self.resize_val, str(map_location)), build_model)
+        # Precision can change between calls without reloading
+        model.denoiser_precision = self.denoiser_precision
+
+        return model
+
+    def load_onnx_session(self, number_projections, image_size = 100):
+        '''
+        Returns an onnxruntime session running the whole MoDL network for the given number of projections.
+        The ONNX graph is exported from model.ckpt the first time and cached on disk.
+        Params:
+            - number_projections (int): Number of projection angles of the sinograms
+            - image_size (int): Reconstructed image size, in pixels
+        '''
+        return get_registered_model((self.rec_process, number_projections, self.resize_val, 'cpu'), lambda: self.build_onnx_session(number_projections, image_size))
+
+    def build_onnx_session(self, number_projections, image_size):
+        '''
+        Creates the onnxruntime session, exporting the ONNX graph if it is not cached on disk. Cached graphs are named
+        after the checkpoint contents and the geometry, so a new model.ckpt or size never reuses a stale export.
+        Params:
+            - number_projections (int): Number of projection angles of the sinograms
+            - image_size (int): Reconstructed image size, in pixels
+        '''
+        __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+        artifact_path = os.path.join(__location__, 'model.ckpt')
+        onnx_path = os.path.join(cache_folder, 'tomodl_{}_{}_{}.onnx'.format(checkpoint_hash(artifact_path), number_projections, image_size))
+
+        if not os.path.isfile(onnx_path):
+            
+            tomodl_dictionary = {'use_torch_radon': False,
+                                'number_projections_total': number_projections,
+                                'image_size': image_size,
+                                'normal_operator': 'toeplitz',
+                                'cg_warm_start': True,
+                                'use_shared_weights': True}
+            
+            model = load_tomodl_checkpoint(artifact_path, tomodl_dictionary).eval()
+            os.makedirs(cache_folder, exist_ok = True)
+            temporary_path = onnx_path+'.{}.tmp'.format(os.getpid())
+            export_tomodl_onnx(model, temporary_path)
+            os.replace(temporary_path, onnx_path)
+
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = os.cpu_count()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        return ort.InferenceSession(onnx_path, session_options, providers = ['CPUExecutionProvider'])
         
     
@@ -4,33 +4,39 @@ This code creates the model described in MoDL: Model-Based Deep Learning Archite
 @author: obanmarcos
 """
 
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+import hashlib
+import inspect
+import os
+import pickle
+import types
+
 try:
     from torch_radon import Radon as thrad
     from torch_radon.solvers import cg
-    
-    import torch
-    import torch.nn as nn
-    import torch.nn.functional as F
 
     use_torch_radon = True
     use_tomopy = False
     use_scikit = False
 
-except:
-    
-    import torch
-    import torch.nn as nn
-    import torch.nn.functional as F
+except ModuleNotFoundError:
     
-    print('Torch-Radon not available!')
+    from .radon import Radon as thrad
+
+    print('Torch-Radon not available! Using torch-native Radon operator')
     use_torch_radon = False
     use_tomopy = False
-    use_scikit = True
+    use_scikit = False
 
-from skimage.transform import radon, iradon
 import matplotlib.pyplot as plt 
 import numpy as np
 from . import unet
+from .radon import SparseRadon, ToeplitzNormal, RampPreconditioner, undersampled_indexes, cache_folder
+from .normalization import normalize_images, normalize_01
 
 try:
     # Modify for multi-gpu
@@ -61,6 +67,9 @@ class dwLayer(nn.Module):
         
         if self.use_batch_norm == True:
             self.batch_norm = nn.BatchNorm2d(self.weights_size[1])
+        else:
+            # Parameterless placeholder, so TorchScript resolves the attribute in forward
+            self.batch_norm = nn.Identity()
     
     def forward(self, x):
         """
@@ -76,9 +85,23 @@ class dwLayer(nn.Module):
         
         if self.is_last_layer != True:
             
-            output = F.relu(output)
+            output = F.relu(output, inplace = self.frozen)
         
         return output
+
+    def freeze(self):
+        '''
+        Folds batch normalisation statistics into the convolution weights and bias, for inference.
+        Once frozen, the layer can not be trained and its state dictionary has no batch normalisation entries.
+        '''
+        if self.use_batch_norm == True:
+            
+            self.conv = fuse_conv_bn_eval(self.conv.eval(), self.batch_norm.eval())
+            self.use_batch_norm = False
+            self.batch_norm = nn.Identity()
+        
+        # The convolution output is not needed anymore, so ReLU can run in place
+        self.frozen = True
     
     def process_kwdictionary(self, kw_dictionary):
         '''
@@ -91,6 +114,7 @@ class dwLayer(nn.Module):
         self.is_last_layer = kw_dictionary['is_last_layer']
         self.init_method = kw_dictionary['init_method']
         self.use_batch_norm = kw_dictionary['use_batch_norm']
+        self.frozen = False
 
     def initialize_layer(self, method):
         '''
@@ -135,13 +159,38 @@ class dw(nn.Module):
         """
         residual = torch.clone(x)    
         
+        if self.channels_last == True:
+            
+            x = x.contiguous(memory_format = torch.channels_last)
+
         for layer in self.nw.values():
 
             x = layer(x)
         
         output = x + residual
         
-        return output
+        return output.contiguous()
+
+    def freeze(self, channels_last = True):
+        '''
+        Prepares the denoiser for inference: folds batch normalisation into the convolutions, runs ReLU in place and
+        optionally switches weights and activations to channels-last memory format, faster for CPU convolutions.
+        Params:
+            - channels_last (bool): If True, convolutions run in channels-last format
+        '''
+        self.eval()
+
+        for layer in self.nw.values():
+
+            layer.freeze()
+
+        self.channels_last = channels_last
+
+        if channels_last == True:
+
+            self.to(memory_format = torch.channels_last)
+
+        return self
 
     def process_kwdictionary(self, kw_dictionary):
         '''
@@ -152,6 +201,7 @@ class dw(nn.Module):
         
         self.number_layers = kw_dictionary['number_layers']
         self.nw = {}
+        self.channels_last = False
         self.kernel_size = kw_dictionary['kernel_size']
         self.features = kw_dictionary['features']
         self.in_channels = kw_dictionary['in_channels']
@@ -169,6 +219,44 @@ class dw(nn.Module):
         'is_last_layer': False,
         'init_method':self.init_method}
 
+class ConjugateGradientsFunction(torch.autograd.Function):
+    """
+    Data-consistency solve x = (A^H A + lam*I)^-1 rhs with implicit differentiation.
+    CG iterations are not recorded by autograd. The backward pass solves the adjoint system (A^H A + lam*I) g = grad
+    with the same operator and preconditioner (the operator is symmetric), so activation memory does not grow with the
+    number of CG iterations. Gradients are usually far smaller than the absolute forward tolerance, so the adjoint solve
+    always runs cg_iterations iterations instead. Then:
+        - dL/drhs = g
+        - dL/dlam = -<g, x>
+    The initial estimate x0 only changes the number of iterations needed, so it receives no gradient.
+    """
+    @staticmethod
+    def forward(ctx, rhs, lam, aclass, x0 = None):
+        
+        x = aclass.solve(rhs, x0)
+
+        ctx.aclass = aclass
+        ctx.save_for_backward(x)
+
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_x):
+
+        x, = ctx.saved_tensors
+        aclass = ctx.aclass
+
+        # aclass.iterations keeps reporting the forward solve
+        with torch.no_grad():
+            g, _ = aclass.conjugate_gradients(aclass.forward, grad_x, aclass.cg_iterations, 0, aclass.preconditioner)
+
+        grad_lam = None
+
+        if ctx.needs_input_grad[1]:
+            grad_lam = -torch.sum(g*x).reshape(aclass.lam.shape)
+
+        return g, grad_lam, None, None
+
 class Aclass:
     """
     This class is created to do the data-consistency (DC) step as described in paper.
@@ -181,37 +269,45 @@ class Aclass:
         '''
         
         self.img_size = kw_dictionary['image_size']
-        self.number_projections = kw_dictionary['number_projections']
+        # Projection angles, equispaced over the full circle unless the acquired angle set is given
+        self.angles = kw_dictionary.get('angles', np.linspace(0, 2*np.pi, kw_dictionary['number_projections'], endpoint = False))
+        self.number_projections = len(self.angles)
         self.lam = kw_dictionary['lambda']
+        self.cg_iterations = kw_dictionary.get('cg_iterations', 10)
+        self.cg_tolerance = kw_dictionary.get('cg_tolerance', 1e-5)
+        self.cg_backward = kw_dictionary.get('cg_backward', 'unrolled')
         self.use_torch_radon = kw_dictionary['use_torch_radon']
         self.use_scikit = kw_dictionary['use_scikit']
-        self.angles = np.linspace(0, 2*np.pi, self.number_projections,endpoint = False)
         self.det_count = int(np.ceil(np.sqrt(2)*self.img_size))
         
-        if self.use_torch_radon == True:
+        self.radon_backend = kw_dictionary.get('radon_backend', 'default')
+
+        if self.radon_backend == 'sparse':
+            # Cached sparse system matrix, shared by every operator with the same geometry
+            self.radon = SparseRadon(self.img_size, self.angles, clip_to_circle = False, det_count = self.det_count)
+        else:
+            # Torch Radon on GPU, torch-native operator (batched and differentiable) otherwise
             self.radon = thrad(self.img_size, self.angles, clip_to_circle = False, det_count = self.det_count)
-        
-        elif self.use_scikit == True:
-            class Radon:
-                def __init__(self, num_angles, circle=True):
-                    self.num_angles = num_angles
-                    self.circle = circle
-
-                def forward(self, image):
-                    # Compute the Radon transform of the image
-                    image = image.detach().numpy()
-                    sinogram = radon(image, theta=np.linspace(0, 2*180, self.num_angles), circle=self.circle)
-                    sinogram = torch.tensor(sinogram).to(device)
-                    return sinogram
-                
-                def backprojection(self, sinogram):
-                    # Compute the backprojection of the sinogram
-                    sinogram = sinogram.detach().numpy()
-                    reconstruction = iradon(sinogram, theta=np.linspace(0, 2*180, self.num_angles), circle=self.circle, filter_name=None)
-                    reconstruction = torch.tensor(reconstruction).to(device)
-                    return reconstruction
 
-            self.radon = Radon(self.number_projections, circle=False)
+        # A^T A applied with projector and backprojector ('radon') or as an FFT convolution ('toeplitz')
+        self.normal_operator = kw_dictionary.get('normal_operator', 'radon')
+
+        # DC solver: plain CG ('cg'), CG preconditioned with the ramp filter approximate inverse ('pcg') or
+        # closed-form division by the Toeplitz kernel in the Fourier domain ('fourier')
+        self.dc_method = kw_dictionary.get('dc_method', 'cg')
+
+        if self.normal_operator == 'toeplitz' or self.dc_method == 'fourier':
+            self.toeplitz = ToeplitzNormal(self.img_size, self.angles, det_count = self.det_count)
+            # Scaling of the Toeplitz kernel matching the projector/backprojector scaling below
+            self.toeplitz_scale = np.pi/(self.number_projections*self.img_size)
+
+        self.preconditioner = None
+        # Number of iterations taken by each sample in the last solve
+        self.iterations = None
+
+        if self.dc_method == 'pcg':
+            ramp_preconditioner = RampPreconditioner(self.img_size)
+            self.preconditioner = lambda r: ramp_preconditioner.forward(r, self.lam)
 
     def forward(self, img):
         """
@@ -220,9 +316,13 @@ class Aclass:
             - img (torch.Tensor): Input tensor
         """
 
-        sinogram = self.radon.forward(img)/self.img_size 
-        iradon = self.radon.backprojection(sinogram)*np.pi/self.number_projections
-        del sinogram
+        if self.normal_operator == 'toeplitz':
+            iradon = self.toeplitz.forward(img)*self.toeplitz_scale
+        else:
+            sinogram = self.radon.forward(img)/self.img_size 
+            iradon = self.radon.backprojection(sinogram)*np.pi/self.number_projections
+            del sinogram
+        
         output = iradon+self.lam*img
         # print('output forward: {} {}'.format(output.max(), output.min()))
         # print('Term z max {}, min {}'.format((iradon/self.lam).max(), (iradon/self.lam).min()))
@@ -230,48 +330,96 @@ class Aclass:
         # print('Term output max {}, min {}'.format(output.max(), output.min()))
         return output
     
-    def inverse(self, rhs):
+    def inverse(self, rhs, x0 = None):
         """
-        Applies CG on each image on the batch
+        Applies batched CG on the whole batch at once
         Params: 
             - rhs (torch.Tensor): Right-hand side tensor for applying inversion of (A^H A + lam*I) operator
+            - x0 (torch.Tensor): Initial estimate (warm start), None starts from zeros
         """
 
-        y = torch.zeros_like(rhs)
+        # The Fourier solve is a few differentiable FFT operations, autograd goes straight through it
+        if self.cg_backward == 'implicit' and self.dc_method != 'fourier' and torch.is_grad_enabled():
+            return ConjugateGradientsFunction.apply(rhs, self.lam, self, x0)
 
-        for i in range(rhs.shape[0]):
-                
-            y[i,0,:,:] = self.conjugate_gradients(self.forward, rhs[i,0,:,:]) # This indexing may fail
-        
-        return y
+        return self.solve(rhs, x0)
+
+    def solve(self, rhs, x0 = None):
+        """
+        Runs the configured DC solver on rhs and keeps the number of CG iterations used by each sample.
+        Params: 
+            - rhs (torch.Tensor): Right-hand side tensor
+            - x0 (torch.Tensor): Initial estimate, None starts from zeros (ignored by the Fourier solve)
+        """
+
+        if self.dc_method == 'fourier':
+            self.iterations = torch.zeros(rhs.shape[0], dtype = torch.int64, device = rhs.device)
+            return self.toeplitz.inverse(rhs, self.lam, self.toeplitz_scale)
+
+        x, self.iterations = self.conjugate_gradients(self.forward, rhs, self.cg_iterations, self.cg_tolerance, self.preconditioner, x0)
+
+        return x
     
     @staticmethod
-    def conjugate_gradients(A, rhs):
+    def conjugate_gradients(A, rhs, max_iterations = 10, tolerance = 1e-5, preconditioner = None, x0 = None):
         
         """
-        My implementation of conjugate gradients in PyTorch
+        Batched (preconditioned) conjugate gradients in PyTorch. Every sample in the batch (first dimension) has its own
+        alpha, beta and stopping criterion: once its squared residual norm is no longer above tolerance, its updates are masked out.
+        On GPU the number of iterations is fixed, so no host synchronisation is needed to check convergence. On CPU,
+        where checking is free, the loop stops as soon as every sample has converged.
+        Params:
+            - A (callable): Symmetric positive definite operator, applied to the whole batch
+            - rhs (torch.Tensor): Right-hand side batch, shape (B, ...)
+            - max_iterations (int): Maximum number of CG iterations
+            - tolerance (float): Squared residual norm at or below which a sample is considered converged, 0 runs
+            max_iterations unless the residual vanishes
+            - preconditioner (callable): Symmetric positive definite approximation of A^-1, None for plain CG
+            - x0 (torch.Tensor): Initial estimate, None starts from zeros
+        Returns:
+            - x (torch.Tensor): Solution batch
+            - iterations (torch.Tensor): Number of iterations run by each sample before converging, shape (B,)
         """
 
-        i = 0
-        x = torch.zeros_like(rhs)
-        r = rhs 
-        p = rhs 
-        rTr = torch.sum(r*r)
+        def batch_dot(u, v):
+            return torch.sum(u*v, dim = tuple(range(1, u.dim())), keepdim = True)
+
+        if x0 is None:
+            x = torch.zeros_like(rhs)
+            r = rhs 
+        else:
+            x = x0
+            r = rhs - A(x0)
+        z = r if preconditioner is None else preconditioner(r)
+        p = z 
+        rTr = batch_dot(r, r)
+        rTz = rTr if preconditioner is None else batch_dot(r, z)
+        iterations = torch.zeros(rhs.shape[0], dtype = torch.int64, device = rhs.device)
         
-        while((i<10) and torch.ge(rTr, 1e-5)):
+        for _ in range(max_iterations):
             
+            active = rTr > tolerance
+
+            if rhs.device.type == 'cpu' and not bool(active.any()):
+                break
+
+            iterations = iterations + active.reshape(-1)
             Ap = A(p)
-            alpha = rTr/torch.sum(p*Ap)
+            pAp = batch_dot(p, Ap)
+            # Converged samples take alpha = 0, guarding the division so gradients stay finite
+            alpha = torch.where(active, rTz/torch.where(active, pAp, torch.ones_like(pAp)), torch.zeros_like(pAp))
             x = x + alpha*p
             r = r - alpha*Ap
-            rTrNew = torch.sum(r*r)
-            beta = rTrNew/rTr
-            p = r + beta * p
-            i += 1
-            rTr = rTrNew
+            z = r if preconditioner is None else preconditioner(r)
+            rTrNew = batch_dot(r, r)
+            rTzNew = rTrNew if preconditioner is None else batch_dot(r, z)
+            beta = torch.where(active, rTzNew/torch.where(active, rTz, torch.ones_like(rTz)), torch.zeros_like(rTz))
+            p = z + beta * p
+            rTr = torch.where(active, rTrNew, rTr)
+            rTz = torch.where(active, rTzNew, rTz)
 
         # print('output CG: {} {}'.format(x.max(), x.min()))
-        return x
+        return x, iterations
 
 class ToMoDL(nn.Module):
   
@@ -295,26 +443,195 @@ class ToMoDL(nn.Module):
     
   def forward(self, x):
     """
-    Forward pass through network
+    Forward pass through network. Only the current iterate is kept, unless keep_intermediates is set.
+    With early_exit_tolerance set (inference only, gradients disabled), a sample stops iterating once the relative change
+    between consecutive DC outputs falls below the tolerance, and is dropped from the batch. The number of iterations
+    run by each sample is kept in self.depths.
     Params:
         - x (torch.Tensor) : Backprojected sinogram, in image space    
+    Returns:
+        - out (dict): Final reconstruction under 'dc<K>'. With keep_intermediates, also every 'dc<i>' and 'dw<i>' iterate,
+        and the dictionary is kept in self.out. Once every sample has exited early, the remaining iterates repeat the
+        final one and self.iterations reports no CG iterations for them
     """
     
-    self.out['dc0'] = x
+    out = {}
+    self.iterations = {}
+    dc = x
+    # Unnormalised DC solution of the previous iteration, used as initial estimate for CG
+    dc_solution = None
+    
+    batch_size = x.shape[0]
+    self.depths = torch.full((batch_size,), self.K, dtype = torch.int64, device = x.device)
+    early_exit = self.early_exit_tolerance is not None and torch.is_grad_enabled() == False
+
+    if early_exit == True:
+        # Batch indexes of the samples still iterating, and latest DC output of every sample
+        active = torch.arange(batch_size, device = x.device)
+        reconstruction = x.clone()
+
+    if self.keep_intermediates == True:
+        out['dc0'] = x
 
     for i in range(1,self.K+1):
     
         j = str(i)
+        previous_dc = dc
         
-        self.out['dw'+j] = normalize_images(self.dw.forward(self.out['dc'+str(i-1)]))
-        rhs = x/self.lam+self.out['dw'+j]
+        if self.use_checkpointing == True and torch.is_grad_enabled():
+            dw, dc, dc_solution = checkpoint(self.unrolled_iteration, x, dc, dc_solution, use_reentrant = False)
+        else:
+            dw, dc, dc_solution = self.unrolled_iteration(x, dc, dc_solution)
+        
+        if early_exit == False:
+            
+            self.iterations['dc'+j] = self.AtA.iterations
+
+            if self.keep_intermediates == True:
+                out['dw'+j] = dw
+                out['dc'+j] = dc
+        
+        else:
+            
+            self.iterations['dc'+j] = self.AtA.iterations.new_zeros(batch_size).index_copy_(0, active, self.AtA.iterations)
+            reconstruction.index_copy_(0, active, dc)
+
+            if self.keep_intermediates == True:
+                out['dw'+j] = dw if i == 1 else out['dw'+str(i-1)].index_copy(0, active, dw)
+                out['dc'+j] = reconstruction.clone()
+            
+            # The first iterate is compared against the backprojection, which has another scale, so it never exits
+            if 1 < i < self.K:
+                
+                change = torch.linalg.vector_norm((dc-previous_dc).flatten(1), dim = 1)/torch.linalg.vector_norm(previous_dc.flatten(1), dim = 1)
+                running = change >= self.early_exit_tolerance
+
+                if running.all() == False:
+                    
+                    self.depths[active[~running]] = i
+                    active, x, dc, dc_solution = active[running], x[running], dc[running], dc_solution[running]
+
+                    if active.numel() == 0:
+                        break
+
+        del dw
 
-        self.out['dc'+j] = normalize_images(self.AtA.inverse(rhs))
+    # Unrolled iterations skipped because the whole batch exited early
+    for k in range(i+1, self.K+1):
         
-        del rhs
+        self.iterations['dc'+str(k)] = self.iterations['dc'+str(i)].new_zeros(batch_size)
+
+        if self.keep_intermediates == True:
+            out['dw'+str(k)] = out['dw'+str(i)]
+            out['dc'+str(k)] = reconstruction
+
+    out['dc'+str(self.K)] = reconstruction if early_exit == True else dc
+
+    if self.keep_intermediates == True:
+        self.out = out
+
+    return out
+
+  def freeze(self, channels_last = True):
+    '''
+    Prepares the model for inference: evaluation mode, no parameter gradients and a folded denoiser 
+    (batch normalisation folded into the convolutions, see dw.freeze).
+    Params:
+        - channels_last (bool): If True, denoiser convolutions run in channels-last format
+    '''
+    self.eval()
+    self.dw.freeze(channels_last = channels_last)
+    # After folding, which creates new convolution parameters
+    self.requires_grad_(False)
+
+    return self
+
+  def reconstruct_volume(self, sinograms = None, batch_size = 16, out = None, angles = None, denoiser_precision = None, backprojections = None):
+    '''
+    Reconstructs a volume slab by slab. Each slab of sinograms is backprojected in a single batch, run through the
+    unrolled network and written into out, so memory is bounded by the slab size and sinograms and out can be 
+    memory-mapped. Inputs are prepared as in DatasetProcessor: sinograms and backprojections are normalised between 0 and 1.
+    Params:
+        - sinograms (array-like): Sinograms of shape (number_slices, number_angles, det_count), as numpy array, 
+        np.memmap or torch.Tensor
+        - batch_size (int): Number of slices per slab
+        - out (array-like): Preallocated output of shape (number_slices, image_size, image_size), for example an np.memmap.
+        Allocated in memory if None
+        - angles (array-like): Projection angles in radians. Defaults to the angles of the DC operator
+        - denoiser_precision (string): 'float32' or 'bfloat16' for this volume. Defaults to the model setting
+        - backprojections (array-like): Normalised unfiltered backprojections of shape (number_slices, image_size, image_size),
+        as stored by DatasetProcessor, used instead of sinograms
+    Returns:
+        - out (array-like): Reconstructed volume
+    '''
+    number_slices = sinograms.shape[0] if backprojections is None else backprojections.shape[0]
+    angles = self.AtA.angles if angles is None else angles
+
+    if out is None:
+        out = np.empty((number_slices, self.image_size, self.image_size), dtype = np.float32)
+
+    if backprojections is None:
+        radon = thrad(self.image_size, angles, clip_to_circle = False, det_count = sinograms.shape[-1])
+    
+    model_precision = self.denoiser_precision
+    self.denoiser_precision = model_precision if denoiser_precision is None else denoiser_precision
+
+    try:
+
+        with torch.no_grad():
+            
+            for start in range(0, number_slices, batch_size):
 
-    return self.out
+                end = min(start+batch_size, number_slices)
+
+                if backprojections is None:
+                    sinogram_slab = torch.as_tensor(np.array(sinograms[start:end], dtype = np.float32), device = self.lam.device)
+                    backprojection = normalize_01(radon.backward(normalize_01(sinogram_slab))).unsqueeze(1)
+                else:
+                    backprojection = torch.as_tensor(np.array(backprojections[start:end], dtype = np.float32), device = self.lam.device).unsqueeze(1)
+
+                out[start:end] = self(backprojection)['dc'+str(self.K)][:, 0].cpu().numpy()
+
+    finally:
+        # The model setting is restored even if a slab fails or the caller interrupts
+        self.denoiser_precision = model_precision
+
+    return out
+
+  def unrolled_iteration(self, x, dc, dc_solution):
+    """
+    One unrolled iteration: denoiser followed by the data-consistency solve.
+    Params:
+        - x (torch.Tensor): Backprojected sinogram, in image space
+        - dc (torch.Tensor): Output of the previous iteration
+        - dc_solution (torch.Tensor): Unnormalised DC solution of the previous iteration (None on the first one)
+    Returns:
+        - dw, dc, dc_solution (torch.Tensor): Denoiser output, normalised and unnormalised DC solution
+    """
+
+    dw = normalize_images(self.denoise(dc))
+    rhs = x/self.lam+dw
+
+    dc_solution = self.AtA.inverse(rhs, dc_solution if self.cg_warm_start else None)
+
+    return dw, normalize_images(dc_solution), dc_solution
   
+  def denoise(self, dc):
+    """
+    Applies the denoiser. With denoiser_precision = 'bfloat16', it runs under bfloat16 autocast and its output is cast
+    back to float32, so normalisation and the DC solve stay in float32.
+    Params:
+        - dc (torch.Tensor): Output of the previous iteration
+    """
+    if self.denoiser_precision == 'bfloat16':
+        
+        with torch.autocast(device_type = dc.device.type, dtype = torch.bfloat16):
+            dw = self.dw.forward(dc)
+
+        return dw.float()
+
+    return self.dw.forward(dc)
+
   def process_kwdictionary(self, kw_dictionary):
     '''
     Process keyword dictionary.
@@ -323,6 +640,10 @@ class ToMoDL(nn.Module):
     '''
 
     self.out = {}
+    # CG iterations used by each sample on every DC step of the last forward pass
+    self.iterations = {}
+    # Unrolled iterations run by each sample in the last forward pass
+    self.depths = None
     self.use_torch_radon = use_torch_radon
     self.use_scikit = use_scikit
     self.use_tomopy = use_tomopy  
@@ -346,9 +667,58 @@ class ToMoDL(nn.Module):
     elif self.denoiser_method == 'resnet':
         self.resnet_options = kw_dictionary['resnet_options']
     
-    self.AtA_dictionary = {'image_size': self.image_size, 'number_projections': self.number_projections_total, 'lambda':self.lam, 'use_torch_radon': self.use_torch_radon, "use_scikit": self.use_scikit, "use_tomopy": self.use_tomopy}
+    # Radon operator backend: 'default' (Torch Radon if available, torch-native otherwise) or 'sparse' (cached system matrix)
+    self.radon_backend = kw_dictionary.get('radon_backend', 'default')
+    # Normal operator: 'radon' (project and backproject) or 'toeplitz' (precomputed FFT convolution kernel)
+    self.normal_operator = kw_dictionary.get('normal_operator', 'radon')
+    # Data-consistency CG: iteration cap and squared residual tolerance, per sample
+    self.cg_iterations = kw_dictionary.get('cg_iterations', 10)
+    self.cg_tolerance = kw_dictionary.get('cg_tolerance', 1e-5)
+    # DC gradients: 'unrolled' (autograd records every CG iteration) or 'implicit' (adjoint CG solve in backward)
+    self.cg_backward = kw_dictionary.get('cg_backward', 'unrolled')
+    # DC solver: 'cg', 'pcg' (ramp filter preconditioner) or 'fourier' (closed-form Toeplitz solve)
+    self.dc_method = kw_dictionary.get('dc_method', 'cg')
+    # Start each DC solve from the previous DC solution instead of zeros
+    self.cg_warm_start = kw_dictionary.get('cg_warm_start', False)
+    # Keep every unrolled iterate in the output (and self.out), for plotting. Otherwise only 'dc<K>' is returned
+    self.keep_intermediates = kw_dictionary.get('keep_intermediates', False)
+    # Recompute each unrolled iteration (denoiser and DC) in the backward pass instead of storing its activations
+    self.use_checkpointing = kw_dictionary.get('use_checkpointing', False)
+    # Inference only: relative change between consecutive DC outputs below which a sample stops iterating (None disables)
+    self.early_exit_tolerance = kw_dictionary.get('early_exit_tolerance', None)
+    # Denoiser precision: 'float32' or 'bfloat16' (autocast, for inference on CPUs with bfloat16 support). DC stays in float32
+    self.denoiser_precision = kw_dictionary.get('denoiser_precision', 'float32')
+    # DC operator built only at the acquired angles (number_projections_total//acceleration_factor, from angle_offset)
+    self.undersampled_operator = kw_dictionary.get('undersampled_operator', False)
+    self.angle_offset = kw_dictionary.get('angle_offset', 0)
+
+    self.AtA_dictionary = {'image_size': self.image_size, 'number_projections': self.number_projections_total, 'lambda':self.lam, 'use_torch_radon': self.use_torch_radon, "use_scikit": self.use_scikit, "use_tomopy": self.use_tomopy, 'radon_backend': self.radon_backend, 'normal_operator': self.normal_operator, 'cg_iterations': self.cg_iterations, 'cg_tolerance': self.cg_tolerance, 'cg_backward': self.cg_backward, 'dc_method': self.dc_method}
+
+    if self.undersampled_operator == True:
+        # Undersampled DC operators, keyed by (acceleration factor, angle offset)
+        self.AtA_cache = {}
+        self.set_angle_offset(self.angle_offset)
+    else:
+        self.AtA = Aclass(self.AtA_dictionary)
+
+  def set_angle_offset(self, angle_offset):
+    '''
+    Selects the undersampled DC operator for the projections acquired from angle_offset, as sampled by
+    DatasetProcessor.subsample_sinogram. Operators are built once per (acceleration factor, angle offset).
+    Params:
+        - angle_offset (int): Index of the seed projection
+    '''
+
+    self.angle_offset = angle_offset%self.number_projections_total
+    key = (self.acceleration_factor, self.angle_offset)
+
+    if key not in self.AtA_cache:
+        
+        indexes = undersampled_indexes(self.number_projections_total, self.number_projections_undersampled, self.angle_offset)
+        angles = np.linspace(0, 2*np.pi, self.number_projections_total, endpoint = False)[indexes]
+        self.AtA_cache[key] = Aclass(dict(self.AtA_dictionary, angles = angles))
 
-    self.AtA = Aclass(self.AtA_dictionary)
+    self.AtA = self.AtA_cache[key]
 
   def define_denoiser(self):
     '''
@@ -370,20 +740,317 @@ class ToMoDL(nn.Module):
         else:
             self.dw = nn.ModuleList([dw(self.resnet_options) for _ in range(self.K)])
 
-def normalize_images(images):
+class ToMoDLGraph(nn.Module):
+  """
+  Compile-friendly inference graph of a ToMoDL model, for torch.compile and torch.jit.script.
+
+  Every data-dependent branch of ToMoDL.forward is removed. The DC step applies the Toeplitz normal operator with a
+  fixed number of (preconditioned) CG iterations, or the closed-form Fourier solve. Operator kernels and lambda are
+  buffers, batch normalisation runs in inference mode, and the output is a one-element tuple.
+
+  ONNX has no 2D FFT operator, so with exportable = True every Fourier filter is applied as products with real DFT
+  matrices instead (O(N^3) per image instead of O(N^2 log N), which is still small next to the denoiser).
+  """
+  def __init__(self, tomodl, exportable = False):
+    '''
+    Builds graph from a ToMoDL model, sharing its denoiser weights.
+    Params:
+        - tomodl (ToMoDL): Model to export, with shared denoiser weights
+        - exportable (bool): If True, replaces FFTs by DFT matrix products, for ONNX export
+    '''
+    super(ToMoDLGraph, self).__init__()
+
+    if isinstance(tomodl.dw, nn.ModuleList):
+      raise ValueError('ToMoDLGraph needs a single denoiser shared by every iteration (use_shared_weights = True), got {} per-iteration denoisers'.format(len(tomodl.dw)))
+
+    self.dw = tomodl.dw
+    self.K = tomodl.K
+    self.image_size = tomodl.image_size
+    self.padded_size = 2*tomodl.image_size
+    self.cg_iterations = tomodl.cg_iterations
+    self.cg_warm_start = tomodl.cg_warm_start == True
+    self.dc_method = tomodl.dc_method
+    self.exportable = exportable
+    
+    AtA = tomodl.AtA
+    toeplitz = AtA.toeplitz if hasattr(AtA, 'toeplitz') else ToeplitzNormal(AtA.img_size, AtA.angles, det_count = AtA.det_count)
+    self.toeplitz_scale = float(np.pi/(AtA.number_projections*AtA.img_size))
+    self.geometry_hash = toeplitz.geometry_hash
+
+    self.register_buffer('lam', tomodl.lam.detach().clone())
+    self.register_buffer('kernel_fft', toeplitz.kernel_fft.clone())
+    self.register_buffer('ramp', RampPreconditioner(self.image_size).ramp.clone())
+
+    # Real DFT matrices and full (non-halved) spectra of the filters, for the exportable graph
+    frequencies = torch.arange(self.padded_size, dtype = torch.float64)
+    phase = 2*np.pi*torch.outer(frequencies, frequencies)/self.padded_size
+    self.register_buffer('dft_cos', torch.cos(phase).float())
+    self.register_buffer('dft_sin', torch.sin(phase).float())
+    self.register_buffer('kernel_full', self.full_spectrum(self.kernel_fft))
+    self.register_buffer('ramp_full', self.full_spectrum(self.ramp))
+
+  def full_spectrum(self, half_spectrum):
+    '''
+    Returns the full padded_size x padded_size spectrum of a real, even filter given on the rfft2 grid.
+    '''
+    padded_shape = (self.padded_size, self.padded_size)
+    
+    return torch.fft.fft2(torch.fft.irfft2(half_spectrum.double(), s = padded_shape)).real.float()
+
+  def forward(self, x):
+    """
+    Forward pass through network
+    Params:
+        - x (torch.Tensor) : Backprojected sinogram, in image space, shape (B, 1, image_size, image_size)
+    Returns:
+        - (dc,) (tuple): Final reconstruction
+    """
+    dc = x
+    dc_solution = torch.zeros_like(x)
+
+    for _ in range(self.K):
+
+        dw = normalize_images(self.dw(dc))
+        rhs = x/self.lam+dw
+
+        if self.dc_method == 'fourier':
+            dc_solution = self.fourier_solve(rhs)
+        else:
+            dc_solution = self.conjugate_gradients(rhs, dc_solution)
+
+        dc = normalize_images(dc_solution)
+
+    return (dc,)
+
+  def dft_filter(self, images, filter_full, input_cos, input_sin, output_cos, output_sin):
+    '''
+    Applies a filter given on the full padded frequency grid with real DFT matrix products.
+    Params:
+        - images (torch.Tensor): Batch of images, shape (B, C, M, M)
+        - filter_full (torch.Tensor): Real filter, shape (padded_size, padded_size)
+        - input_cos, input_sin (torch.Tensor): DFT matrix columns of the input pixels, shape (padded_size, M)
+        - output_cos, output_sin (torch.Tensor): DFT matrix columns of the output pixels, shape (padded_size, N)
+    '''
+    real = input_cos@images@input_cos.t()-input_sin@images@input_sin.t()
+    imaginary = -(input_sin@images@input_cos.t()+input_cos@images@input_sin.t())
+    real = real*filter_full
+    imaginary = imaginary*filter_full
+
+    output = output_cos.t()@real@output_cos-output_sin.t()@real@output_sin-output_cos.t()@imaginary@output_sin-output_sin.t()@imaginary@output_cos
+
+    return output/(self.padded_size**2)
+
+  def fft_filter(self, images, filter_fft, filter_full):
+    '''
+    Applies a filter to a zero-padded batch of images, cropped back to image size.
+    Params:
+        - images (torch.Tensor): Batch of images
+        - filter_fft (torch.Tensor): Filter on the padded rfft2 grid
+        - filter_full (torch.Tensor): Same filter on the full padded grid, used by the exportable graph
+    '''
+    if self.exportable:
+        dft_cos = self.dft_cos[:, :self.image_size]
+        dft_sin = self.dft_sin[:, :self.image_size]
+        return self.dft_filter(images, filter_full, dft_cos, dft_sin, dft_cos, dft_sin)
+
+    images_fft = torch.fft.rfft2(images, s = [self.padded_size, self.padded_size])
+    output = torch.fft.irfft2(images_fft*filter_fft, s = [self.padded_size, self.padded_size])
+
+    return output[..., :self.image_size, :self.image_size]
+
+  def normal_operator(self, images):
+    '''
+    Applies (A^H A + lam*I), with A^H A as a Toeplitz convolution.
+    '''
+    return self.fft_filter(images, self.kernel_fft, self.kernel_full)*self.toeplitz_scale+self.lam*images
+
+  def fourier_solve(self, rhs):
     '''
-    Normalizes tensor of images 1-channel images between 0 and 1.
+    Closed-form approximate DC solve, see ToeplitzNormal.inverse.
+    '''
+    pad_before = (self.padded_size-self.image_size)//2
+    pad_after = self.padded_size-self.image_size-pad_before
+    padded_rhs = F.pad(rhs, [pad_before, pad_after, pad_before, pad_after], mode = 'replicate')
+
+    if self.exportable:
+        inverse_filter = 1/(self.toeplitz_scale*torch.clamp(self.kernel_full, min = 0.0)+self.lam)
+        output_cos = self.dft_cos[:, pad_before:pad_before+self.image_size]
+        output_sin = self.dft_sin[:, pad_before:pad_before+self.image_size]
+        return self.dft_filter(padded_rhs, inverse_filter, self.dft_cos, self.dft_sin, output_cos, output_sin)
+
+    kernel = torch.clamp(self.kernel_fft, min = 0.0)
+    output = torch.fft.irfft2(torch.fft.rfft2(padded_rhs)/(self.toeplitz_scale*kernel+self.lam), s = [self.padded_size, self.padded_size])
+
+    return output[..., pad_before:pad_before+self.image_size, pad_before:pad_before+self.image_size]
+
+  def conjugate_gradients(self, rhs, x0):
+    '''
+    Batched (preconditioned) CG with a fixed number of iterations, see Aclass.conjugate_gradients.
     Params:
-     - images (torch.Tensor): Tensor of 1-channel images
+        - rhs (torch.Tensor): Right-hand side batch
+        - x0 (torch.Tensor): Initial estimate, used only with warm start
+    '''
+    if self.cg_warm_start:
+        x = x0
+        r = rhs-self.normal_operator(x0)
+    else:
+        x = torch.zeros_like(rhs)
+        r = rhs
+
+    preconditioner = self.ramp/(1+self.lam*self.ramp)
+    preconditioner_full = self.ramp_full/(1+self.lam*self.ramp_full)
+    z = self.fft_filter(r, preconditioner, preconditioner_full) if self.dc_method == 'pcg' else r
+    p = z
+    rTz = torch.sum(r*z, dim = [1, 2, 3], keepdim = True)
+
+    for _ in range(self.cg_iterations):
+
+        Ap = self.normal_operator(p)
+        pAp = torch.sum(p*Ap, dim = [1, 2, 3], keepdim = True)
+        # Converged samples (rTz = 0) take alpha = beta = 0 instead of dividing by zero
+        active = rTz > 0
+        alpha = torch.where(active, rTz/torch.where(active, pAp, torch.ones_like(pAp)), torch.zeros_like(pAp))
+        x = x+alpha*p
+        r = r-alpha*Ap
+        z = self.fft_filter(r, preconditioner, preconditioner_full) if self.dc_method == 'pcg' else r
+        rTzNew = torch.sum(r*z, dim = [1, 2, 3], keepdim = True)
+        beta = torch.where(active, rTzNew/torch.where(active, rTz, torch.ones_like(rTz)), torch.zeros_like(rTz))
+        p = z+beta*p
+        rTz = rTzNew
+
+    return x
+
+  def hash_graph(self):
     '''
+    Returns a hash of the weights and settings of the graph, used to cache compiled artifacts.
+    '''
+    graph_hash = hashlib.sha1()
+    graph_hash.update(str((self.K, self.image_size, self.cg_iterations, self.cg_warm_start, self.dc_method, self.exportable, self.geometry_hash, torch.__version__)).encode())
+
+    for name, tensor in self.state_dict().items():
+        graph_hash.update(name.encode())
+        graph_hash.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    return graph_hash.hexdigest()
+
+def compile_tomodl(tomodl, method = 'script', use_cache = True):
+  '''
+  Builds the compile-friendly inference graph of a ToMoDL model and compiles it.
+  Params:
+    - tomodl (ToMoDL): Model to compile
+    - method (string): 'script' (TorchScript, frozen, saved to cache_folder and loaded from there on later calls),
+    'compile' (torch.compile, from PyTorch 2.0, with the inductor cache in cache_folder) or 'eager' (graph only)
+    - use_cache (bool): If True, loads/saves the TorchScript artifact from/to cache_folder
+  Returns:
+    - graph (callable): Compiled graph, returning a one-element tuple
+  '''
+  graph = ToMoDLGraph(tomodl).eval()
+
+  if method == 'script':
     
-    image_norm = torch.zeros_like(images)
+    artifact_path = os.path.join(cache_folder, 'tomodl_graph_{}.pt'.format(graph.hash_graph()))
+
+    if use_cache == True and os.path.isfile(artifact_path):
+        return torch.jit.load(artifact_path, map_location = graph.lam.device)
+
+    scripted_graph = torch.jit.freeze(torch.jit.script(graph))
+
+    if use_cache == True:
+        os.makedirs(cache_folder, exist_ok = True)
+        temporary_path = artifact_path+'.{}.tmp'.format(os.getpid())
+        torch.jit.save(scripted_graph, temporary_path)
+        os.replace(temporary_path, artifact_path)
+
+    return scripted_graph
+
+  elif method == 'compile':
+
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_folder, 'inductor'))
+    return torch.compile(graph)
+
+  return graph
+
+class _MissingObject:
+  '''
+  Placeholder for objects pickled in a checkpoint whose module is not installed (losses, metrics).
+  '''
+  def __init__(self, *args, **kwargs):
+    pass
+
+  def __setstate__(self, state):
+    pass
+
+class _CheckpointUnpickler(pickle.Unpickler):
+  '''
+  Unpickler that replaces classes from missing modules by placeholders, so weights can be read without the training
+  dependencies (pytorch_msssim, torchmetrics, ...).
+  '''
+  def find_class(self, module, name):
+    try:
+        return super().find_class(module, name)
+    except (ModuleNotFoundError, AttributeError):
+        return _MissingObject
+
+_checkpoint_pickle_module = types.SimpleNamespace(__name__ = 'pickle', Unpickler = _CheckpointUnpickler, load = pickle.load)
+
+def load_tomodl_checkpoint(checkpoint_path, kw_dictionary = None, map_location = 'cpu'):
+  '''
+  Builds a ToMoDL model from a Lightning checkpoint, without importing Lightning or the training dependencies.
+  Params:
+    - checkpoint_path (string): Path to the .ckpt file
+    - kw_dictionary (dict): Keys overriding the model dictionary stored in the checkpoint hyperparameters
+    - map_location (string or torch.device): Device where weights are loaded
+  Missing or unexpected weights (e.g. a dictionary that does not match the checkpoint) raise a RuntimeError.
+  '''
+  # Checkpoints pickle their hyperparameters. weights_only only exists from PyTorch 1.13 and defaults to True from 2.6
+  load_options = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+  checkpoint = torch.load(checkpoint_path, map_location = map_location, pickle_module = _checkpoint_pickle_module, **load_options)
+
+  hyper_parameters = checkpoint.get('hyper_parameters', {})
+  hyper_parameters = hyper_parameters.get('kw_dictionary_model_system', hyper_parameters)
+  model_dictionary = dict(hyper_parameters.get('kw_dictionary_modl', {}))
+  model_dictionary.update(kw_dictionary or {})
+
+  model = ToMoDL(model_dictionary)
+  state_dict = {key.replace('model.', '', 1): value for key, value in checkpoint['state_dict'].items() if 'num_batches' not in key}
+  model.load_state_dict(state_dict, strict = True)
+
+  return model
+
+def export_tomodl_onnx(tomodl, onnx_path, opset_version = 17):
+  '''
+  Exports the whole unrolled ToMoDL network (denoiser and DC steps) to ONNX, for onnxruntime inference.
+  The DC operator is the Toeplitz normal operator applied with DFT matrix products (see ToMoDLGraph), and the geometry
+  is stored as model metadata (image_size, number_projections, angles, det_count, K_iterations, lambda, dc_method,
+  cg_iterations, geometry_hash). The batch dimension of the input 'x' and the output 'dc' is dynamic.
+  Params:
+    - tomodl (ToMoDL): Model to export
+    - onnx_path (string): Output path
+    - opset_version (int): ONNX opset
+  '''
+  import onnx
+
+  graph = ToMoDLGraph(tomodl, exportable = True).eval()
+  images = torch.zeros(1, 1, graph.image_size, graph.image_size, device = graph.lam.device)
+  # Newer PyTorch versions default to the dynamo exporter, the TorchScript one handles the unrolled loops directly
+  export_options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
 
+  with torch.no_grad():
+    torch.onnx.export(graph, (images,), onnx_path, input_names = ['x'], output_names = ['dc'], 
+                      dynamic_axes = {'x': {0: 'batch'}, 'dc': {0: 'batch'}}, opset_version = opset_version, **export_options)
 
-    for i, image in enumerate(images):
+  metadata = {'image_size': graph.image_size,
+              'number_projections': tomodl.AtA.number_projections,
+              'angles': ','.join(str(angle) for angle in np.asarray(tomodl.AtA.angles)),
+              'det_count': tomodl.AtA.det_count,
+              'K_iterations': graph.K,
+              'lambda': graph.lam.item(),
+              'dc_method': graph.dc_method,
+              'cg_iterations': graph.cg_iterations,
+              'geometry_hash': graph.geometry_hash}
 
-        # print(image.max())
-        image = (image-image.mean())/image.std()
-        image_norm[i,...] = ((image - image.min())/(image.max()-image.min()))
+  onnx_model = onnx.load(onnx_path)
+  onnx.helper.set_model_props(onnx_model, {key: str(value) for key, value in metadata.items()})
+  onnx.save(onnx_model, onnx_path)
 
-    return image_norm
+  return metadata
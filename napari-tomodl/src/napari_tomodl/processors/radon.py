@@ -0,0 +1,590 @@
+"""
+Parallel-beam Radon transform written with native PyTorch operations, used when Torch Radon is not available.
+
+Operators available:
+    * Radon: ray-driven projector and pixel-driven backprojector built on F.grid_sample. They are differentiable,
+    batched and multi-threaded on CPU through the PyTorch intra-op thread pool.
+    * SparseRadon: the same projector stored as a sparse system matrix, built once per geometry and cached on disk.
+    * ToeplitzNormal: the normal operator A^T A applied as a convolution with a precomputed kernel, via padded FFTs.
+    * RampPreconditioner: FBP-style ramp filter approximating the inverse of the regularised normal operator.
+
+undersampled_indexes gives the projections kept when undersampling equispaced from a seed angle.
+
+Radon and SparseRadon follow the Torch Radon geometry (detector count, clip to circle, angles in radians) and keep
+the same interface (forward, backprojection, backward and filter_sinogram), so they can be swapped in wherever
+Torch Radon is used.
+
+author: obanmarcos
+"""
+
+import torch
+import torch.nn.functional as F
+import numpy as np
+import hashlib
+import os
+
+# Folder where system matrices and kernels are stored, shared between processes
+cache_folder = os.environ.get('TOMODL_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'tomodl'))
+# System matrices already loaded in this process, keyed by geometry hash
+system_matrices = {}
+
+def undersampled_indexes(number_projections_total, number_projections_undersampled, offset = 0):
+    '''
+    Indexes of the projections kept by equispaced undersampling, starting from the projection offset.
+    Params:
+        - number_projections_total (int): Number of projections of the fully sampled acquisition
+        - number_projections_undersampled (int): Number of projections kept
+        - offset (int): Seed projection
+    '''
+    indexes = np.linspace(0, number_projections_total, number_projections_undersampled, endpoint = False).astype(int)
+
+    return (indexes+offset)%number_projections_total
+
+class Radon:
+    """
+    Torch-native parallel-beam projector/backprojector pair.
+    """
+    def __init__(self, resolution, angles, det_count = -1, det_spacing = 1.0, clip_to_circle = False, max_samples = 2**22, max_cached_samples = 2**26):
+        '''
+        Initializes Radon operator geometry.
+        Params:
+            - resolution (int): Image size in pixels (images are resolution x resolution)
+            - angles (array-like): Projection angles in radians
+            - det_count (int): Number of detector bins. Defaults to resolution if -1
+            - det_spacing (float): Detector bin spacing, in pixels
+            - clip_to_circle (bool): If True, only the disk inscribed in the image is projected
+            - max_samples (int): Maximum number of interpolated samples per image and chunk of angles, bounds memory usage
+            - max_cached_samples (int): Sampling grids are cached if they hold less samples than this, otherwise rebuilt on each call
+        '''
+
+        self.resolution = resolution
+        self.angles = torch.as_tensor(np.asarray(angles), dtype = torch.float64)
+        self.number_angles = self.angles.shape[0]
+        self.det_count = int(det_count) if det_count > 0 else resolution
+        self.det_spacing = det_spacing
+        self.clip_to_circle = clip_to_circle
+        self.max_samples = max_samples
+        self.max_cached_samples = max_cached_samples
+        self.grids = {}
+
+        # Pixel centers in physical units (pixels), origin at the image center
+        self.pixel_coordinates = torch.arange(self.resolution, dtype = torch.float64)-(self.resolution-1)/2
+        # Detector bin centers and samples along each ray
+        self.det_coordinates = (torch.arange(self.det_count, dtype = torch.float64)-(self.det_count-1)/2)*self.det_spacing
+        self.ray_coordinates = torch.arange(self.det_count, dtype = torch.float64)-(self.det_count-1)/2
+
+        if self.clip_to_circle == True:
+            y, x = self.pixel_coordinates[:, None], self.pixel_coordinates[None, :]
+            self.circle_mask = ((x**2+y**2) <= (self.resolution/2)**2)
+        else:
+            self.circle_mask = None
+
+    def _angle_chunks(self, samples_per_angle):
+        '''
+        Splits angles in chunks so that each grid_sample call interpolates at most max_samples values per image.
+        Params:
+            - samples_per_angle (int): Number of interpolated samples per angle and image
+        '''
+        chunk = max(1, int(self.max_samples//samples_per_angle))
+
+        return [(start, min(start+chunk, self.number_angles)) for start in range(0, self.number_angles, chunk)]
+
+    def _forward_grid(self, start, end):
+        '''
+        Builds grid_sample coordinates of the ray samples for angles[start:end].
+        Sample points are t*(cos, sin) + s*(-sin, cos), for detector position t and position s along the ray.
+        '''
+        cos = torch.cos(self.angles[start:end])[:, None, None]
+        sin = torch.sin(self.angles[start:end])[:, None, None]
+        x = self.det_coordinates[None, :, None]*cos-self.ray_coordinates[None, None, :]*sin
+        y = self.det_coordinates[None, :, None]*sin+self.ray_coordinates[None, None, :]*cos
+
+        return (torch.stack((x, y), -1)*2/self.resolution).reshape(1, -1, self.det_count, 2)
+
+    def _backprojection_grid(self, start, end):
+        '''
+        Builds grid_sample coordinates on the sinogram for angles[start:end].
+        Each pixel samples the detector position it projects onto, on the sinogram row of each angle.
+        '''
+        y, x = self.pixel_coordinates[:, None], self.pixel_coordinates[None, :]
+        cos = torch.cos(self.angles[start:end])[:, None, None]
+        sin = torch.sin(self.angles[start:end])[:, None, None]
+        t = (x[None, ...]*cos+y[None, ...]*sin)*2/(self.det_spacing*self.det_count)
+        a = ((2*torch.arange(start, end, dtype = torch.float64)+1)/self.number_angles-1)[:, None, None].expand_as(t)
+
+        return torch.stack((t, a), -1).reshape(1, end-start, self.resolution**2, 2)
+
+    def _grids(self, kind, device, dtype):
+        '''
+        Returns the list of (start, end, grid) chunks for the projector (kind = 'forward') or backprojector (kind = 'backprojection').
+        Grids are cached per device and dtype, so that autograd references the same tensors across calls.
+        '''
+        key = (kind, device, dtype)
+
+        if key in self.grids:
+            return self.grids[key]
+
+        if kind == 'forward':
+            samples_per_angle, grid_function = self.det_count**2, self._forward_grid
+        else:
+            samples_per_angle, grid_function = self.resolution**2, self._backprojection_grid
+
+        grids = [(start, end, grid_function(start, end).to(device = device, dtype = dtype)) for start, end in self._angle_chunks(samples_per_angle)]
+
+        if samples_per_angle*self.number_angles <= self.max_cached_samples:
+            self.grids[key] = grids
+
+        return grids
+
+    def hash_geometry(self):
+        '''
+        Hashes every parameter that defines the projector geometry.
+        '''
+        geometry = hashlib.sha1()
+        geometry.update(np.array([self.resolution, self.det_count], dtype = np.int64).tobytes())
+        geometry.update(np.array([self.det_spacing], dtype = np.float64).tobytes())
+        geometry.update(self.angles.numpy().astype(np.float64).tobytes())
+
+        return geometry.hexdigest()
+
+    def _clip(self, images):
+        '''
+        Zeroes pixels outside the inscribed circle when clip_to_circle is enabled.
+        Params:
+            - images (torch.Tensor): Tensor of images, shape (..., resolution, resolution)
+        '''
+        if self.circle_mask is None:
+            return images
+
+        return images*self.circle_mask.to(device = images.device, dtype = images.dtype)
+
+    def forward(self, images):
+        '''
+        Computes the line integrals of images for every angle (ray-driven, bilinear interpolation).
+        Params:
+            - images (torch.Tensor): Tensor of shape (..., resolution, resolution)
+        Returns:
+            - sinogram (torch.Tensor): Tensor of shape (..., number_angles, det_count)
+        '''
+        leading_shape = images.shape[:-2]
+        images = self._clip(images).reshape(1, -1, self.resolution, self.resolution)
+        batch_size = images.shape[1]
+
+        sinogram = []
+
+        for start, end, grid in self._grids('forward', images.device, images.dtype):
+
+            samples = F.grid_sample(images, grid, mode = 'bilinear', padding_mode = 'zeros', align_corners = False)
+            sinogram.append(samples.reshape(batch_size, end-start, self.det_count, self.det_count).sum(-1))
+
+        sinogram = torch.cat(sinogram, 1)
+
+        return sinogram.reshape(*leading_shape, self.number_angles, self.det_count)
+
+    def backprojection(self, sinogram):
+        '''
+        Smears back every projection over the image grid (pixel-driven, linear interpolation on the detector).
+        Params:
+            - sinogram (torch.Tensor): Tensor of shape (..., number_angles, det_count)
+        Returns:
+            - images (torch.Tensor): Tensor of shape (..., resolution, resolution)
+        '''
+        leading_shape = sinogram.shape[:-2]
+        sinogram = sinogram.reshape(1, -1, self.number_angles, self.det_count)
+        batch_size = sinogram.shape[1]
+
+        images = torch.zeros(batch_size, self.resolution**2, device = sinogram.device, dtype = sinogram.dtype)
+
+        for start, end, grid in self._grids('backprojection', sinogram.device, sinogram.dtype):
+
+            samples = F.grid_sample(sinogram, grid, mode = 'bilinear', padding_mode = 'zeros', align_corners = False)
+            images = images+samples[0].sum(1)
+
+        images = self._clip(images.reshape(batch_size, self.resolution, self.resolution))
+
+        return images.reshape(*leading_shape, self.resolution, self.resolution)
+
+    def backward(self, sinogram):
+        '''
+        Alias of backprojection, kept for compatibility with Torch Radon.
+        Params:
+            - sinogram (torch.Tensor): Tensor of shape (..., number_angles, det_count)
+        '''
+        return self.backprojection(sinogram)
+
+    def filter_sinogram(self, sinogram, filter_name = 'ramp'):
+        '''
+        Applies ramp filter along the detector axis in Fourier space, as done before filtered backprojection.
+        Params:
+            - sinogram (torch.Tensor): Tensor of shape (..., number_angles, det_count)
+            - filter_name (string): Only 'ramp' is available
+        '''
+        assert(filter_name == 'ramp')
+
+        padded_size = max(64, int(2**np.ceil(np.log2(2*self.det_count))))
+        ramp = self.ramp_filter(padded_size).to(device = sinogram.device, dtype = sinogram.dtype)
+
+        sinogram_fft = torch.fft.rfft(sinogram, n = padded_size, dim = -1)
+        filtered_sinogram = torch.fft.irfft(sinogram_fft*ramp, n = padded_size, dim = -1)
+
+        return filtered_sinogram[..., :self.det_count]
+
+    @staticmethod
+    def ramp_filter(size):
+        '''
+        Builds the Ram-Lak filter from its spatial-domain definition, which avoids the zero-frequency bias of |f|.
+        Params:
+            - size (int): Padded detector size (even)
+        Returns:
+            - ramp (torch.Tensor): Real filter of shape (size//2+1,), to multiply an rfft along the detector axis
+        '''
+        n = np.concatenate((np.arange(1, size/2+1, 2, dtype = int), np.arange(size/2-1, 0, -2, dtype = int)))
+        f = np.zeros(size)
+        f[0] = 0.25
+        f[1::2] = -1/(np.pi*n)**2
+
+        ramp = 2*np.real(np.fft.rfft(f))
+
+        return torch.as_tensor(ramp)
+
+class SparseMatmul(torch.autograd.Function):
+    """
+    Sparse-dense product whose backward pass reuses the precomputed transpose instead of transposing the matrix on every call.
+    """
+    @staticmethod
+    def forward(ctx, matrix, matrix_t, dense):
+        ctx.matrix_t = matrix_t
+
+        return matrix @ dense
+
+    @staticmethod
+    def backward(ctx, grad_output):
+
+        return None, None, ctx.matrix_t @ grad_output
+
+class SparseRadon(Radon):
+    """
+    Parallel-beam projector stored as a sparse system matrix A, of shape (number_angles*det_count, resolution**2).
+    Forward projection and backprojection are batched sparse matmuls with A and A^T, so the backprojection is the exact adjoint.
+    The matrix is built once per geometry, cached on disk under the geometry hash and reused across processes.
+    It holds about 2*resolution non-zeros per ray and is stored twice (A and A^T), so memory grows as
+    number_angles*resolution**2: roughly 400 MB for 100 px and 720 angles.
+    """
+    def __init__(self, resolution, angles, det_count = -1, det_spacing = 1.0, clip_to_circle = False, max_samples = 2**22, use_cache = True):
+        '''
+        Initializes sparse Radon operator.
+        Params:
+            - resolution (int): Image size in pixels (images are resolution x resolution)
+            - angles (array-like): Projection angles in radians
+            - det_count (int): Number of detector bins. Defaults to resolution if -1
+            - det_spacing (float): Detector bin spacing, in pixels
+            - clip_to_circle (bool): If True, only the disk inscribed in the image is projected
+            - max_samples (int): Maximum number of ray samples traced at once while building the matrix
+            - use_cache (bool): If True, loads/saves the system matrix from/to cache_folder
+        '''
+        super().__init__(resolution, angles, det_count = det_count, det_spacing = det_spacing, clip_to_circle = clip_to_circle, max_samples = max_samples, max_cached_samples = 0)
+
+        self.use_cache = use_cache
+        self.geometry_hash = self.hash_geometry()
+        self.system_matrix, self.system_matrix_t = self.load_system_matrix()
+        self.devices = {}
+
+    def load_system_matrix(self):
+        '''
+        Returns system matrix and its transpose, from memory, from disk or by ray tracing, in that order.
+        '''
+        if self.geometry_hash in system_matrices:
+            return system_matrices[self.geometry_hash]
+
+        matrix_path = os.path.join(cache_folder, 'radon_{}.pt'.format(self.geometry_hash))
+
+        if self.use_cache == True and os.path.isfile(matrix_path):
+
+            compressed_matrices = torch.load(matrix_path)
+
+        else:
+
+            system_matrix = self.build_system_matrix()
+            compressed_matrices = {'A': self.compress(system_matrix), 'AT': self.compress(system_matrix.t().coalesce())}
+
+            if self.use_cache == True:
+                # Write to a temporary file first, so that concurrent processes never read a partial matrix
+                os.makedirs(cache_folder, exist_ok = True)
+                temporary_path = matrix_path+'.{}.tmp'.format(os.getpid())
+                torch.save(compressed_matrices, temporary_path)
+                os.replace(temporary_path, matrix_path)
+
+        system_matrices[self.geometry_hash] = (self.decompress(*compressed_matrices['A']), self.decompress(*compressed_matrices['AT']))
+
+        return system_matrices[self.geometry_hash]
+
+    @staticmethod
+    def compress(matrix):
+        '''
+        Converts a coalesced COO matrix to CSR components (crow_indices, col_indices, values, shape).
+        '''
+        rows, cols = matrix.indices()
+        crow_indices = torch.zeros(matrix.shape[0]+1, dtype = torch.int64)
+        crow_indices[1:] = torch.cumsum(torch.bincount(rows, minlength = matrix.shape[0]), 0)
+
+        return (crow_indices, cols.clone(), matrix.values().clone(), tuple(matrix.shape))
+
+    @staticmethod
+    def decompress(crow_indices, col_indices, values, shape):
+        '''
+        Builds sparse matrix from CSR components. CSR matmuls are multi-threaded, COO is used on PyTorch versions without CSR support.
+        '''
+        if hasattr(torch, 'sparse_csr_tensor'):
+            return torch.sparse_csr_tensor(crow_indices, col_indices, values, shape)
+
+        rows = torch.repeat_interleave(torch.arange(shape[0]), crow_indices[1:]-crow_indices[:-1])
+
+        return torch.sparse_coo_tensor(torch.stack((rows, col_indices)), values, shape).coalesce()
+
+    def build_system_matrix(self):
+        '''
+        Traces rays with the same samples as Radon.forward, accumulating bilinear interpolation weights of each sample in A.
+        '''
+        rows, cols, weights = [], [], []
+
+        for start, end in self._angle_chunks(self.det_count**2):
+
+            grid = self._forward_grid(start, end).reshape(-1, 2)
+            # grid_sample coordinates to pixel indexes (align_corners = False)
+            ix = ((grid[:, 0]+1)*self.resolution-1)/2
+            iy = ((grid[:, 1]+1)*self.resolution-1)/2
+            ray = torch.arange(start*self.det_count, end*self.det_count).repeat_interleave(self.det_count)
+
+            ix0, iy0 = torch.floor(ix), torch.floor(iy)
+            wx1, wy1 = ix-ix0, iy-iy0
+
+            for dx, wx in ((0, 1-wx1), (1, wx1)):
+                for dy, wy in ((0, 1-wy1), (1, wy1)):
+
+                    px, py = (ix0+dx).long(), (iy0+dy).long()
+                    valid = (px >= 0) & (px < self.resolution) & (py >= 0) & (py < self.resolution) & (wx*wy > 0)
+
+                    rows.append(ray[valid])
+                    cols.append(py[valid]*self.resolution+px[valid])
+                    weights.append((wx*wy)[valid].float())
+
+        indices = torch.stack((torch.cat(rows), torch.cat(cols)))
+        shape = (self.number_angles*self.det_count, self.resolution**2)
+
+        return torch.sparse_coo_tensor(indices, torch.cat(weights), shape).coalesce()
+
+    def _matrices(self, device):
+        '''
+        Returns system matrix and transpose on device, moving them only once.
+        '''
+        if device not in self.devices:
+            self.devices[device] = (self.system_matrix.to(device), self.system_matrix_t.to(device))
+
+        return self.devices[device]
+
+    def forward(self, images):
+        '''
+        Computes sinograms as A x for the whole batch.
+        Params:
+            - images (torch.Tensor): Tensor of shape (..., resolution, resolution)
+        Returns:
+            - sinogram (torch.Tensor): Tensor of shape (..., number_angles, det_count)
+        '''
+        leading_shape = images.shape[:-2]
+        system_matrix, system_matrix_t = self._matrices(images.device)
+
+        images = self._clip(images).reshape(-1, self.resolution**2)
+        sinogram = SparseMatmul.apply(system_matrix, system_matrix_t, images.t().float()).t().to(images.dtype)
+
+        return sinogram.reshape(*leading_shape, self.number_angles, self.det_count)
+
+    def backprojection(self, sinogram):
+        '''
+        Computes backprojections as A^T y for the whole batch.
+        Params:
+            - sinogram (torch.Tensor): Tensor of shape (..., number_angles, det_count)
+        Returns:
+            - images (torch.Tensor): Tensor of shape (..., resolution, resolution)
+        '''
+        leading_shape = sinogram.shape[:-2]
+        system_matrix, system_matrix_t = self._matrices(sinogram.device)
+
+        sinogram = sinogram.reshape(-1, self.number_angles*self.det_count)
+        images = SparseMatmul.apply(system_matrix_t, system_matrix, sinogram.t().float()).t().to(sinogram.dtype)
+        images = self._clip(images.reshape(-1, self.resolution, self.resolution))
+
+        return images.reshape(*leading_shape, self.resolution, self.resolution)
+
+class ToeplitzNormal:
+    """
+    Normal operator A^T A of the parallel-beam projector, applied as a 2D convolution.
+
+    For full-circle parallel-beam geometry A^T A is shift invariant, so it is fully described by its point spread
+    function. The kernel is computed once per geometry by projecting and backprojecting a centered impulse on a
+    grid twice as large, and cached on disk. Applying A^T A then costs one zero-padded FFT multiply for the whole
+    batch, O(N^2 log N) instead of O(N^3).
+    """
+    def __init__(self, resolution, angles, det_count = -1, det_spacing = 1.0, use_cache = True):
+        '''
+        Initializes Toeplitz normal operator.
+        Params:
+            - resolution (int): Image size in pixels (images are resolution x resolution)
+            - angles (array-like): Projection angles in radians
+            - det_count (int): Number of detector bins of the projector. Defaults to resolution if -1
+            - det_spacing (float): Detector bin spacing, in pixels
+            - use_cache (bool): If True, loads/saves the kernel from/to cache_folder
+        '''
+        self.resolution = resolution
+        self.padded_size = 2*resolution
+        self.radon = Radon(resolution, angles, det_count = det_count, det_spacing = det_spacing)
+        self.use_cache = use_cache
+        self.geometry_hash = self.radon.hash_geometry()
+
+        self.kernel_fft = self.load_kernel()
+        self.devices = {}
+
+    def load_kernel(self):
+        '''
+        Returns the Fourier transform of the kernel, from memory, from disk or by computing it, in that order.
+        '''
+        kernel_key = 'toeplitz_{}'.format(self.geometry_hash)
+
+        if kernel_key in system_matrices:
+            return system_matrices[kernel_key]
+
+        kernel_path = os.path.join(cache_folder, kernel_key+'.pt')
+
+        if self.use_cache == True and os.path.isfile(kernel_path):
+
+            kernel_fft = torch.load(kernel_path)
+
+        else:
+
+            kernel_fft = self.build_kernel()
+
+            if self.use_cache == True:
+                os.makedirs(cache_folder, exist_ok = True)
+                temporary_path = kernel_path+'.{}.tmp'.format(os.getpid())
+                torch.save(kernel_fft, temporary_path)
+                os.replace(temporary_path, kernel_path)
+
+        system_matrices[kernel_key] = kernel_fft
+
+        return kernel_fft
+
+    def build_kernel(self):
+        '''
+        Computes the point spread function of A^T A with an impulse at the center of a padded_size grid.
+        The padded grid covers every offset between two pixels of the image, so the circular convolution of
+        size padded_size equals the linear one on the image support.
+        '''
+        padded_radon = Radon(self.padded_size, self.radon.angles.numpy(),
+                            det_count = int(np.ceil(self.padded_size*self.radon.det_count/self.resolution)),
+                            det_spacing = self.radon.det_spacing)
+
+        impulse = torch.zeros(self.padded_size, self.padded_size, dtype = torch.float64)
+        impulse[self.resolution, self.resolution] = 1
+
+        with torch.no_grad():
+            kernel = padded_radon.backprojection(padded_radon.forward(impulse))
+
+        # Move the impulse response center to the origin
+        kernel = torch.roll(kernel, shifts = (-self.resolution, -self.resolution), dims = (0, 1))
+
+        # Keeping the real part symmetrizes the kernel, so the operator stays self-adjoint as CG requires
+        return torch.fft.rfft2(kernel).real.float()
+
+    def _kernel(self, device):
+        '''
+        Returns kernel on device, moving it only once.
+        '''
+        if device not in self.devices:
+            self.devices[device] = self.kernel_fft.to(device)
+
+        return self.devices[device]
+
+    def forward(self, images):
+        '''
+        Applies A^T A to a batch of images.
+        Params:
+            - images (torch.Tensor): Tensor of shape (..., resolution, resolution)
+        Returns:
+            - images (torch.Tensor): A^T A images, same shape as input
+        '''
+        padded_shape = (self.padded_size, self.padded_size)
+
+        images_fft = torch.fft.rfft2(images.float(), s = padded_shape)
+        output = torch.fft.irfft2(images_fft*self._kernel(images.device), s = padded_shape)
+
+        return output[..., :self.resolution, :self.resolution].to(images.dtype)
+
+    def inverse(self, images, lam, scale = 1.0):
+        '''
+        Closed-form approximate solve of (scale*A^T A + lam*I) x = images: one padded FFT, a division by
+        (scale*kernel + lam) and one inverse FFT, so the cost does not depend on any convergence criterion.
+        The padded operator is treated as circulant. A^T A spreads an image well outside its support, so the right-hand
+        side is centered and extended by edge replication instead of zeros, which approximates those tails far better.
+        Params:
+            - images (torch.Tensor): Right-hand side, tensor of shape (..., resolution, resolution)
+            - lam (float or torch.Tensor): Regularisation weight
+            - scale (float): Scaling of A^T A
+        Returns:
+            - images (torch.Tensor): Solution, same shape as input
+        '''
+        padded_shape = (self.padded_size, self.padded_size)
+        pad_before = (self.padded_size-self.resolution)//2
+        pad_after = self.padded_size-self.resolution-pad_before
+        # Clamped so that small negative values of the symmetrized kernel do not cancel lam
+        kernel = torch.clamp(self._kernel(images.device), min = 0)
+
+        padded_images = F.pad(images.float().reshape(-1, 1, self.resolution, self.resolution), (pad_before, pad_after, pad_before, pad_after), mode = 'replicate')
+        images_fft = torch.fft.rfft2(padded_images)
+        output = torch.fft.irfft2(images_fft/(scale*kernel+lam), s = padded_shape)
+        output = output[..., pad_before:pad_before+self.resolution, pad_before:pad_before+self.resolution]
+
+        return output.reshape(images.shape).to(images.dtype)
+
+class RampPreconditioner:
+    """
+    Approximate inverse of (c A^T A + lam*I), with c = pi/(number_angles*resolution) the scaling used in the DC step.
+
+    For dense parallel-beam full-circle sampling, c A^T A is a convolution with Fourier response 1/(resolution*|rho|)
+    (rho in cycles per pixel), so its inverse is the FBP ramp filter. The preconditioner applies
+        resolution*|rho|/(1+lam*resolution*|rho|)
+    with zero-padded FFTs, which keeps it symmetric positive definite.
+    """
+    def __init__(self, resolution):
+        '''
+        Precomputes the ramp on the padded frequency grid.
+        Params:
+            - resolution (int): Image size in pixels
+        '''
+        self.resolution = resolution
+        self.padded_size = 2*resolution
+
+        rho_y = torch.fft.fftfreq(self.padded_size)[:, None]
+        rho_x = torch.fft.rfftfreq(self.padded_size)[None, :]
+        rho = torch.sqrt(rho_x**2+rho_y**2)
+        # Zero frequency takes a quarter bin, as in the spatial-domain Ram-Lak construction
+        rho[0, 0] = 1/(4*self.padded_size)
+
+        self.ramp = resolution*rho
+        self.devices = {}
+
+    def forward(self, images, lam):
+        '''
+        Applies the preconditioner to a batch of images.
+        Params:
+            - images (torch.Tensor): Tensor of shape (..., resolution, resolution)
+            - lam (float or torch.Tensor): Regularisation weight of the DC step
+        '''
+        if images.device not in self.devices:
+            self.devices[images.device] = self.ramp.to(images.device)
+
+        ramp = self.devices[images.device]
+        padded_shape = (self.padded_size, self.padded_size)
+
+        images_fft = torch.fft.rfft2(images.float(), s = padded_shape)
+        output = torch.fft.irfft2(images_fft*(ramp/(1+lam*ramp)), s = padded_shape)
+
+        return output[..., :self.resolution, :self.resolution].to(images.dtype)
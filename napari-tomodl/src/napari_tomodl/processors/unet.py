@@ -16,6 +16,7 @@ except:
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import numpy as np
 import matplotlib.pyplot as plt 
 
@@ -29,6 +30,26 @@ except:
     
 # U-Net
 
+def fold_batch_norm(layers):
+    '''
+    Returns an inference copy of a sequence of layers, where each convolution followed by batch normalisation is
+    replaced by a single convolution, dropout is removed and ReLU runs in place. Layers must be in evaluation mode.
+    Params:
+        - layers (nn.Sequential): Layers to fold
+    '''
+    folded_layers = []
+
+    for layer in layers:
+
+        if isinstance(layer, nn.BatchNorm2d) and len(folded_layers) > 0 and isinstance(folded_layers[-1], nn.Conv2d):
+            folded_layers[-1] = fuse_conv_bn_eval(folded_layers[-1], layer)
+        elif isinstance(layer, nn.ReLU):
+            folded_layers.append(nn.ReLU(inplace = True))
+        elif not isinstance(layer, nn.Dropout2d):
+            folded_layers.append(layer)
+
+    return nn.Sequential(*folded_layers)
+
 class double_conv(nn.Module):
     '''(conv => BN => ReLU) * 2'''
     def __init__(self, in_ch, out_ch, batch_norm = False):
@@ -60,6 +81,12 @@ class double_conv(nn.Module):
         x = self.conv(x)
         return x
 
+    def freeze(self):
+        '''
+        Folds batch normalisation into the convolutions, for inference
+        '''
+        self.conv = fold_batch_norm(self.conv)
+
 
 class inconv(nn.Module):
     def __init__(self, in_ch, out_ch, batch_norm):
@@ -144,9 +171,13 @@ class UNet(nn.Module):
         self.up3 = up(256, 64, bilinear = up_conv, batch_norm = batch_norm)
         self.up4 = up(128, 64 , bilinear = up_conv, batch_norm = batch_norm)
         self.outc = outconv(64, n_classes)
+        self.channels_last = False
     
     def forward(self, x0):
         
+        if self.channels_last == True:
+            x0 = x0.contiguous(memory_format = torch.channels_last)
+
         x1 = self.inc(x0)
         x2 = self.down1(x1)
         x3 = self.down2(x2)
@@ -160,4 +191,29 @@ class UNet(nn.Module):
         if self.residual is True:        
             x = x+self.lam*x0
 
-        return x#F.sigmoid(x)
\ No newline at end of file
+        return x.contiguous()#F.sigmoid(x)
+    
+    def freeze(self, channels_last = True):
+        '''
+        Prepares the U-Net for inference: evaluation mode, batch normalisation folded into the preceding convolutions,
+        dropout removed and, optionally, channels-last weights and activations (faster CPU convolutions).
+        Batch normalisation applied directly to the input (batch_norm_inconv) is kept, since zero padding prevents
+        folding it into the next convolution.
+        Params:
+            - channels_last (bool): If True, convolutions run in channels-last format
+        '''
+        self.eval()
+
+        for module in list(self.modules()):
+            if isinstance(module, double_conv):
+                module.freeze()
+
+        # After folding, which creates new convolution parameters
+        self.requires_grad_(False)
+
+        self.channels_last = channels_last
+
+        if channels_last == True:
+            self.to(memory_format = torch.channels_last)
+
+        return self
\ No newline at end of file
@@ -0,0 +1,12 @@
+'''
+Shared pytest setup: ToMoDL packages importable from the repository root and operator caches kept out of the home folder.
+
+author: obanmarcos
+'''
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ToMoDL'))
+# Read by models.radon when it is first imported
+os.environ.setdefault('TOMODL_CACHE', tempfile.mkdtemp(prefix = 'tomodl_cache_'))
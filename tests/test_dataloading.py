@@ -0,0 +1,76 @@
+'''
+Testing the undersampling angle offset from dataset writing to the MoDL operator
+
+author: obanmarcos
+'''
+import numpy as np
+import torch
+
+from models.modl import ToMoDL
+from models.radon import Radon
+from utilities import dataloading_utilities as dlutils
+
+number_projections_total = 40
+acceleration_factor = 4
+image_size = 16
+
+def subsampling_processor():
+    '''
+    DatasetProcessor with only the sampling attributes, without any volume on disk.
+    '''
+    processor = dlutils.DatasetProcessor.__new__(dlutils.DatasetProcessor)
+    processor.number_projections_total = number_projections_total
+    processor.number_projections_undersampled = number_projections_total//acceleration_factor
+
+    return processor
+
+def test_undersampled_operator_matches_data():
+    '''
+    Checks that the operator selected with the dataset angle offset backprojects the masked sinogram exactly as the
+    full operator does, for a nonzero offset.
+    '''
+    processor = subsampling_processor()
+    det_count = int(np.ceil(np.sqrt(2)*image_size))
+    sinogram = np.random.default_rng(0).random((number_projections_total, det_count, 1))
+    # Seed drawing offset 37
+    np.random.seed(1)
+    undersampled_sinogram = processor.subsample_sinogram(sinogram)
+    assert processor.angle_offset % acceleration_factor != 0
+
+    resnet_options = {'number_layers': 2, 'kernel_size': 3, 'features': 4, 'in_channels': 1, 'out_channels': 1,
+                      'stride': 1, 'use_batch_norm': False, 'init_method': 'xavier'}
+    model = ToMoDL({'K_iterations': 1, 'number_projections_total': number_projections_total,
+                    'acceleration_factor': acceleration_factor, 'image_size': image_size, 'lambda': 0.05,
+                    'use_shared_weights': True, 'denoiser_method': 'resnet', 'resnet_options': resnet_options,
+                    'in_channels': 1, 'out_channels': 1, 'undersampled_operator': True})
+    model.set_angle_offset(processor.angle_offset)
+
+    angles = np.linspace(0, 2*np.pi, number_projections_total, endpoint = False)
+    acquired = np.flatnonzero(np.any(undersampled_sinogram != 0, axis = (1, 2)))
+    operator_angles = model.AtA.radon.angles.numpy()
+    assert np.allclose(np.sort(operator_angles), angles[acquired])
+
+    # Acquired projections, in the order of the operator angles
+    order = np.round(operator_angles/(2*np.pi)*number_projections_total).astype(int)
+    acquired_sinogram = torch.from_numpy(undersampled_sinogram[order, :, 0]).float()
+    full_backprojection = Radon(image_size, angles, det_count = det_count).backprojection(torch.from_numpy(undersampled_sinogram[..., 0]).float())
+
+    assert torch.allclose(model.AtA.radon.backprojection(acquired_sinogram), full_backprojection, rtol = 1e-4, atol = 1e-4)
+
+def test_dataset_returns_angle_offset(tmp_path):
+    '''
+    Checks that ReconstructionDataset reads back the angle offset written with the dataset.
+    '''
+    for folder in ['fs_filtered', 'us_4_filtered', 'us_4_unfiltered']:
+
+        (tmp_path/folder).mkdir()
+
+        for index in range(2):
+            torch.save(torch.rand(1, image_size, image_size), str(tmp_path/folder/'{}.pt'.format(index)))
+
+    (tmp_path/'angle_offset.txt').write_text('7')
+
+    dataset = dlutils.ReconstructionDataset(str(tmp_path), acceleration_factor, return_angle_offset = True)
+
+    assert dataset[1][3] == 7
+    assert len(dlutils.ReconstructionDataset(str(tmp_path), acceleration_factor)[1]) == 3
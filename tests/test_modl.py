@@ -0,0 +1,383 @@
+'''
+Testing the data-consistency step of ToMoDL
+
+author: obanmarcos
+'''
+import numpy as np
+import pytest
+import torch
+
+from models import unet
+from models.modl import Aclass, ToMoDL, ToMoDLGraph, compile_tomodl, load_tomodl_checkpoint
+
+def aclass_dictionary(**options):
+    '''
+    Small DC problem, float64 friendly.
+    '''
+    kw_dictionary = {'image_size': 24,
+                    'number_projections': 40,
+                    'lambda': 0.05,
+                    'use_torch_radon': False,
+                    'use_scikit': False}
+    kw_dictionary.update(options)
+
+    return kw_dictionary
+
+def tomodl_dictionary(**options):
+    '''
+    Small ToMoDL model with a shared ResNet denoiser.
+    '''
+    resnet_options = {'number_layers': 2, 'kernel_size': 3, 'features': 4, 'in_channels': 1, 'out_channels': 1,
+                      'stride': 1, 'use_batch_norm': False, 'init_method': 'xavier'}
+    kw_dictionary = {'K_iterations': 3, 'number_projections_total': 40, 'acceleration_factor': 4, 'image_size': 16,
+                     'lambda': 0.05, 'use_shared_weights': True, 'denoiser_method': 'resnet',
+                     'resnet_options': resnet_options, 'in_channels': 1, 'out_channels': 1}
+    kw_dictionary.update(options)
+
+    return kw_dictionary
+
+def right_hand_sides():
+    '''
+    Batch whose samples converge after different numbers of iterations.
+    '''
+    generator = torch.Generator().manual_seed(0)
+    scales = torch.tensor([1, 1e-2, 1e-3, 3], dtype = torch.float64).reshape(4, 1, 1, 1)
+
+    return torch.rand(4, 1, 24, 24, generator = generator, dtype = torch.float64)*scales
+
+def test_batched_cg_matches_per_sample():
+    '''
+    Checks that the batched CG gives every sample the solution and iteration count of its own solve.
+    '''
+    aclass = Aclass(aclass_dictionary())
+    rhs = right_hand_sides()
+
+    x = aclass.solve(rhs)
+    iterations = aclass.iterations.clone()
+
+    for index in range(rhs.shape[0]):
+
+        x_sample = aclass.solve(rhs[index:index+1])
+
+        assert torch.allclose(x[index:index+1], x_sample, rtol = 1e-10, atol = 1e-12)
+        assert iterations[index] == aclass.iterations[0]
+
+    # The small sample converges early and is masked out while the others keep iterating
+    assert iterations.min() < iterations.max()
+
+@pytest.mark.parametrize('cg_tolerance, rtol', [(1e-5, 1e-2), (1e-20, 1e-5)])
+def test_implicit_gradients_match_unrolled(cg_tolerance, rtol):
+    '''
+    Checks that implicit differentiation of the DC solve gives the gradients of backpropagating through CG, for a loss
+    whose gradients are far below the CG tolerance. The sparse backend makes the normal operator exactly symmetric.
+    '''
+    generator = torch.Generator().manual_seed(0)
+    rhs_base = torch.rand(2, 1, 24, 24, generator = generator, dtype = torch.float64)
+    weights = torch.rand(2, 1, 24, 24, generator = generator, dtype = torch.float64)
+    gradients = {}
+
+    for cg_backward in ['implicit', 'unrolled']:
+
+        lam = torch.tensor(0.05, dtype = torch.float64, requires_grad = True)
+        aclass = Aclass(aclass_dictionary(**{'lambda': lam, 'radon_backend': 'sparse', 'cg_backward': cg_backward, 'cg_iterations': 100, 'cg_tolerance': cg_tolerance}))
+        rhs = rhs_base.clone().requires_grad_(True)
+
+        x = aclass.inverse(rhs)
+        forward_iterations = aclass.iterations.clone()
+        grad_rhs, grad_lam = torch.autograd.grad(1e-4*torch.sum(x*weights), (rhs, lam))
+
+        # The adjoint solve does not overwrite the iterations of the forward solve
+        assert torch.equal(aclass.iterations, forward_iterations)
+        gradients[cg_backward] = (grad_rhs, grad_lam)
+
+    assert torch.linalg.norm(gradients['implicit'][0]-gradients['unrolled'][0]) <= rtol*torch.linalg.norm(gradients['unrolled'][0])
+    assert torch.isclose(gradients['implicit'][1], gradients['unrolled'][1], rtol = rtol)
+
+def test_preconditioned_cg_converges_faster():
+    '''
+    Checks that the ramp preconditioner reaches the plain CG solution in fewer iterations.
+    '''
+    rhs = right_hand_sides()
+    solutions = {}
+    iterations = {}
+
+    for dc_method in ['cg', 'pcg']:
+
+        aclass = Aclass(aclass_dictionary(dc_method = dc_method, cg_iterations = 100, cg_tolerance = 1e-10))
+        solutions[dc_method] = aclass.solve(rhs)
+        iterations[dc_method] = aclass.iterations
+
+    assert torch.linalg.norm(solutions['pcg']-solutions['cg']) <= 1e-5*torch.linalg.norm(solutions['cg'])
+    # Measured about half the iterations on this geometry
+    assert torch.all(iterations['pcg'] < 0.75*iterations['cg'])
+
+def test_warm_start_needs_fewer_iterations():
+    '''
+    Checks that starting the DC solve from a nearby estimate, as the previous unrolled iteration provides with 
+    cg_warm_start, reaches the same solution as starting from zeros in fewer iterations.
+    '''
+    aclass = Aclass(aclass_dictionary(cg_iterations = 200, cg_tolerance = 1e-12))
+    rhs = right_hand_sides()
+
+    x = aclass.inverse(rhs)
+    iterations = aclass.iterations.clone()
+
+    generator = torch.Generator().manual_seed(1)
+    x0 = x+1e-3*x.abs().amax(dim = (1, 2, 3), keepdim = True)*torch.randn(x.shape, generator = generator, dtype = x.dtype)
+    x_warm = aclass.inverse(rhs, x0)
+
+    assert torch.linalg.norm(x_warm-x) <= 1e-6*torch.linalg.norm(x)
+    # Measured about a third fewer iterations for every sample
+    assert torch.all(aclass.iterations < iterations)
+
+def test_fourier_solve():
+    '''
+    Checks the closed-form Fourier DC solve against a converged CG solve, for the right-hand side of an object inside 
+    the field of view, that it runs no CG iterations and that gradients flow through it to rhs and lambda.
+    '''
+    yy, xx = np.mgrid[:24, :24]-11.5
+    image = ((xx**2+yy**2 < 49)+0.5*((xx-3)**2+yy**2 < 9)).astype(np.float64)
+    cg_aclass = Aclass(aclass_dictionary(cg_iterations = 300, cg_tolerance = 1e-20))
+    rhs = cg_aclass.forward(torch.from_numpy(image)[None, None])
+
+    lam = torch.tensor(0.05, dtype = torch.float64, requires_grad = True)
+    aclass = Aclass(aclass_dictionary(**{'lambda': lam, 'dc_method': 'fourier'}))
+    rhs = rhs.clone().requires_grad_(True)
+    x = aclass.inverse(rhs)
+    x_cg = cg_aclass.solve(rhs.detach())
+
+    assert torch.equal(aclass.iterations, torch.zeros(1, dtype = torch.int64))
+    # The padded operator is inverted as a circulant, so the tails of A^T A cut at the image border are only 
+    # approximated. Measured 12% residual and 17% distance to the CG solution, against 1e-9 residual for CG
+    with torch.no_grad():
+        assert torch.linalg.norm(cg_aclass.forward(x)-rhs) <= 0.15*torch.linalg.norm(rhs)
+        assert torch.linalg.norm(cg_aclass.forward(x_cg)-rhs) <= 1e-6*torch.linalg.norm(rhs)
+        assert torch.linalg.norm(x-x_cg) <= 0.25*torch.linalg.norm(x_cg)
+
+    # The solve is linear in rhs, so the gradient of <x, w> is its adjoint applied to w
+    generator = torch.Generator().manual_seed(0)
+    weights = torch.randn(x.shape, generator = generator, dtype = torch.float64)
+    direction = torch.randn(x.shape, generator = generator, dtype = torch.float64)
+    grad_rhs, grad_lam = torch.autograd.grad(torch.sum(x*weights), (rhs, lam))
+
+    with torch.no_grad():
+        assert torch.isclose(torch.sum(grad_rhs*direction), torch.sum(weights*aclass.solve(direction)), rtol = 1e-4)
+        
+        lam_step = 1e-4
+        aclass.lam = lam+lam_step
+        finite_difference = (torch.sum(aclass.solve(rhs)*weights)-torch.sum(x*weights))/lam_step
+        assert torch.isclose(grad_lam, finite_difference, rtol = 1e-2)
+
+def test_graph_rejects_per_iteration_denoisers():
+    '''
+    Checks that ToMoDLGraph refuses models with one denoiser per unrolled iteration.
+    '''
+    resnet_options = {'number_layers': 2, 'kernel_size': 3, 'features': 4, 'in_channels': 1, 'out_channels': 1,
+                      'stride': 1, 'use_batch_norm': False, 'init_method': 'xavier'}
+    model = ToMoDL({'K_iterations': 2, 'number_projections_total': 40, 'acceleration_factor': 4, 'image_size': 16,
+                    'lambda': 0.05, 'use_shared_weights': False, 'denoiser_method': 'resnet',
+                    'resnet_options': resnet_options, 'in_channels': 1, 'out_channels': 1})
+
+    with pytest.raises(ValueError, match = 'use_shared_weights'):
+        ToMoDLGraph(model)
+
+def test_scripted_graph_matches_eager():
+    '''
+    Checks the TorchScript inference graph against ToMoDL with the same Toeplitz DC operator and number of CG 
+    iterations, with the normalisation of normalization.py in both.
+    '''
+    torch.manual_seed(0)
+    model = ToMoDL(tomodl_dictionary(normal_operator = 'toeplitz', cg_tolerance = 0)).eval()
+    x = torch.rand(3, 1, 16, 16)
+
+    with torch.no_grad():
+        assert torch.allclose(compile_tomodl(model, use_cache = False)(x)[0], model(x)['dc3'], atol = 1e-5)
+
+def test_quantized_denoiser(tmp_path):
+    '''
+    Checks that quantize_denoiser converts the denoiser convolutions to INT8, that the saved denoiser loads back with 
+    the same output, that the INT8 model stays close to the float one and that per-iteration denoisers are refused.
+    '''
+    quantization = pytest.importorskip('models.quantization')
+    resnet_options = {'number_layers': 3, 'kernel_size': 3, 'features': 8, 'in_channels': 1, 'out_channels': 1,
+                      'stride': 1, 'use_batch_norm': True, 'init_method': 'xavier'}
+    torch.manual_seed(0)
+    model = ToMoDL(tomodl_dictionary(resnet_options = resnet_options)).eval()
+    generator = torch.Generator().manual_seed(0)
+    calibration_batches = [(torch.rand(4, 1, 16, 16, generator = generator), None, None) for _ in range(4)]
+    x = torch.rand(3, 1, 16, 16, generator = generator)
+
+    quantized_model = quantization.quantize_denoiser(model, calibration_batches)
+
+    assert any(isinstance(module, torch.ao.nn.quantized.Conv2d) for module in quantized_model.dw.modules())
+
+    quantization.save_quantized_denoiser(quantized_model, str(tmp_path/'denoiser.pt'))
+    loaded_model = quantization.load_quantized_denoiser(ToMoDL(tomodl_dictionary(resnet_options = resnet_options)), str(tmp_path/'denoiser.pt'))
+
+    with torch.no_grad():
+        output = quantized_model(x)['dc3']
+        
+        assert torch.equal(loaded_model(x)['dc3'], output)
+        # Measured 0.2% relative error on the denoiser output and 0.01% on the reconstruction
+        assert torch.linalg.norm(quantized_model.dw(x)-model.dw(x)) <= 2e-2*torch.linalg.norm(model.dw(x))
+        assert torch.linalg.norm(output-model(x)['dc3']) <= 1e-2*torch.linalg.norm(model(x)['dc3'])
+
+    with pytest.raises(ValueError, match = 'use_shared_weights'):
+        quantization.quantize_denoiser(ToMoDL(tomodl_dictionary(use_shared_weights = False)), calibration_batches)
+
+def test_checkpoint_loading_is_strict(tmp_path):
+    '''
+    Checks that load_tomodl_checkpoint restores every weight and raises when one is missing.
+    '''
+    resnet_options = {'number_layers': 2, 'kernel_size': 3, 'features': 4, 'in_channels': 1, 'out_channels': 1,
+                      'stride': 1, 'use_batch_norm': True, 'init_method': 'xavier'}
+    kw_dictionary = {'K_iterations': 2, 'number_projections_total': 40, 'acceleration_factor': 4, 'image_size': 16,
+                     'lambda': 0.05, 'use_shared_weights': True, 'denoiser_method': 'resnet',
+                     'resnet_options': resnet_options, 'in_channels': 1, 'out_channels': 1}
+    model = ToMoDL(kw_dictionary)
+    state_dict = {'model.'+key: value for key, value in model.state_dict().items()}
+    torch.save({'hyper_parameters': {'kw_dictionary_modl': kw_dictionary}, 'state_dict': state_dict}, str(tmp_path/'model.ckpt'))
+
+    loaded_model = load_tomodl_checkpoint(str(tmp_path/'model.ckpt'))
+    assert all(torch.equal(value, loaded_model.state_dict()[key]) for key, value in model.state_dict().items())
+
+    del state_dict['model.lam']
+    torch.save({'hyper_parameters': {'kw_dictionary_modl': kw_dictionary}, 'state_dict': state_dict}, str(tmp_path/'model.ckpt'))
+
+    with pytest.raises(RuntimeError, match = 'lam'):
+        load_tomodl_checkpoint(str(tmp_path/'model.ckpt'))
+
+def test_early_exit_fills_skipped_iterations():
+    '''
+    Checks that iterations skipped after the whole batch exits early repeat the final iterate, with no CG iterations.
+    '''
+    resnet_options = {'number_layers': 2, 'kernel_size': 3, 'features': 4, 'in_channels': 1, 'out_channels': 1,
+                      'stride': 1, 'use_batch_norm': False, 'init_method': 'xavier'}
+    model = ToMoDL({'K_iterations': 5, 'number_projections_total': 40, 'acceleration_factor': 4, 'image_size': 16,
+                    'lambda': 0.05, 'use_shared_weights': True, 'denoiser_method': 'resnet',
+                    'resnet_options': resnet_options, 'in_channels': 1, 'out_channels': 1,
+                    'keep_intermediates': True, 'early_exit_tolerance': 1e3})
+    x = torch.rand(3, 1, 16, 16)
+
+    with torch.no_grad():
+        out = model(x)
+
+    # Every sample exits after the second iteration
+    assert torch.equal(model.depths, torch.full((3,), 2))
+    assert sorted(model.iterations) == ['dc{}'.format(i) for i in range(1, 6)]
+
+    for i in range(3, 6):
+        assert torch.equal(out['dc{}'.format(i)], out['dc2'])
+        assert torch.equal(out['dw{}'.format(i)], out['dw2'])
+        assert torch.equal(model.iterations['dc{}'.format(i)], torch.zeros(3, dtype = torch.int64))
+
+def test_checkpointing_keeps_loss_and_gradients():
+    '''
+    Checks that recomputing the unrolled iterations in the backward pass gives the loss and parameter gradients of 
+    storing their activations.
+    '''
+    x = torch.rand(2, 1, 16, 16, generator = torch.Generator().manual_seed(0))
+    target = torch.rand(2, 1, 16, 16, generator = torch.Generator().manual_seed(1))
+    results = {}
+
+    for use_checkpointing in [False, True]:
+
+        torch.manual_seed(0)
+        model = ToMoDL(tomodl_dictionary(use_checkpointing = use_checkpointing))
+        loss = torch.mean((model(x)['dc3']-target)**2)
+        loss.backward()
+
+        results[use_checkpointing] = (loss.detach(), {name: parameter.grad for name, parameter in model.named_parameters()})
+
+    assert torch.equal(results[True][0], results[False][0])
+    assert results[True][1].keys() == results[False][1].keys()
+    
+    for name, grad in results[False][1].items():
+        assert torch.equal(results[True][1][name], grad), name
+
+def test_intermediates_kept_only_on_request():
+    '''
+    Checks that by default only the final iterate is returned and none is kept on the module, and that 
+    keep_intermediates returns and keeps every iterate.
+    '''
+    x = torch.rand(2, 1, 16, 16)
+    model = ToMoDL(tomodl_dictionary())
+
+    out = model(x)
+
+    assert list(out) == ['dc3']
+    assert model.out == {}
+    assert not any(torch.is_tensor(value) and value.shape == x.shape for value in vars(model).values())
+
+    model = ToMoDL(tomodl_dictionary(keep_intermediates = True))
+
+    out = model(x)
+
+    assert sorted(out) == sorted(['dc0', 'dc1', 'dc2', 'dc3', 'dw1', 'dw2', 'dw3'])
+    assert model.out is out
+    assert torch.equal(out['dc0'], x)
+
+def test_freeze_disables_gradients_of_folded_weights():
+    '''
+    Checks that no parameter requires gradients after batch normalisation is folded into the convolutions.
+    '''
+    resnet_options = {'number_layers': 3, 'kernel_size': 3, 'features': 4, 'in_channels': 1, 'out_channels': 1,
+                      'stride': 1, 'use_batch_norm': True, 'init_method': 'xavier'}
+    model = ToMoDL({'K_iterations': 2, 'number_projections_total': 40, 'acceleration_factor': 4, 'image_size': 16,
+                    'lambda': 0.05, 'use_shared_weights': True, 'denoiser_method': 'resnet',
+                    'resnet_options': resnet_options, 'in_channels': 1, 'out_channels': 1}).freeze()
+    unet_model = unet.unet({'n_channels': 1, 'n_classes': 1, 'bilinear': True, 'batch_norm': True, 'batch_norm_inconv': True,
+                       'residual': True, 'up_conv': False}).freeze()
+
+    assert not any(parameter.requires_grad for parameter in model.parameters())
+    assert not any(parameter.requires_grad for parameter in unet_model.parameters())
+
+def test_bfloat16_denoiser():
+    '''
+    Checks that the bfloat16 denoiser stays close to the float32 one, that its output and the DC iterates are float32, 
+    and that reconstruct_volume restores the model precision after a failing slab.
+    '''
+    torch.manual_seed(0)
+    model = ToMoDL(tomodl_dictionary(keep_intermediates = True)).eval()
+    x = torch.rand(3, 1, 16, 16, generator = torch.Generator().manual_seed(0))
+
+    with torch.no_grad():
+        reference = model(x)
+        model.denoiser_precision = 'bfloat16'
+        out = model(x)
+
+    # bfloat16 keeps 8 bits of mantissa, measured 0.2% relative error on the denoiser output
+    for key in ['dw1', 'dc1', 'dc3']:
+        assert out[key].dtype == torch.float32
+        assert torch.linalg.norm(out[key]-reference[key]) <= 1e-2*torch.linalg.norm(reference[key])
+
+    model.denoiser_precision = 'float32'
+
+    with pytest.raises(ValueError):
+        model.reconstruct_volume(backprojections = x[:, 0], out = np.empty((3, 8, 8)), denoiser_precision = 'bfloat16')
+
+    assert model.denoiser_precision == 'float32'
+
+def test_reconstruct_volume():
+    '''
+    Checks slab-wise reconstruction against a single batched call, and that the denoiser precision is restored when a
+    slab fails.
+    '''
+    resnet_options = {'number_layers': 2, 'kernel_size': 3, 'features': 4, 'in_channels': 1, 'out_channels': 1,
+                      'stride': 1, 'use_batch_norm': False, 'init_method': 'xavier'}
+    model = ToMoDL({'K_iterations': 2, 'number_projections_total': 40, 'acceleration_factor': 4, 'image_size': 16,
+                    'lambda': 0.05, 'use_shared_weights': True, 'denoiser_method': 'resnet',
+                    'resnet_options': resnet_options, 'in_channels': 1, 'out_channels': 1}).eval()
+    backprojections = torch.rand(5, 16, 16, generator = torch.Generator().manual_seed(0))
+
+    volume = model.reconstruct_volume(backprojections = backprojections, batch_size = 2)
+
+    # Convolutions round differently with the batch size, which can move a sample across the CG tolerance and change 
+    # its iteration count by one, measured up to 3e-5
+    with torch.no_grad():
+        assert np.allclose(volume, model(backprojections.unsqueeze(1))['dc2'][:, 0].numpy(), atol = 1e-4)
+
+    with pytest.raises(ValueError):
+        model.reconstruct_volume(backprojections = backprojections, batch_size = 2, out = np.empty((5, 8, 8)), denoiser_precision = 'bfloat16')
+
+    assert model.denoiser_precision == 'float32'
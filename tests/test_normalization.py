@@ -0,0 +1,91 @@
+'''
+Testing the batched normalisation ops against the per-image loops they replaced
+
+author: obanmarcos
+'''
+import pytest
+import torch
+
+from models.normalization import normalize_01, normalize_std, normalize_images
+from utilities import dataloading_utilities as dlutils
+
+def normalize_01_loop(images):
+
+    image_norm = torch.zeros_like(images)
+
+    for i, image in enumerate(images):
+        image_norm[i,...] = ((image - image.min())/(image.max()-image.min()))
+
+    return image_norm
+
+def normalize_std_loop(images):
+
+    image_norm = torch.zeros_like(images)
+
+    for i, image in enumerate(images):
+        image_norm[i,...] = ((image - image.mean())/(image.std()))
+
+    return image_norm
+
+def normalize_images_loop(images):
+
+    image_norm = torch.zeros_like(images)
+
+    for i, image in enumerate(images):
+        image = (image-image.mean())/image.std()
+        image_norm[i,...] = ((image - image.min())/(image.max()-image.min()))
+
+    return image_norm
+
+def normalize_mean_range_loop(images):
+
+    image_norm = torch.zeros_like(images)
+
+    for i, image in enumerate(images):
+        image_norm[i,...] = ((image - image.mean())/(image.max()-image.min()))
+
+    return image_norm
+
+@pytest.mark.parametrize('operation, loop', [(normalize_01, normalize_01_loop), (normalize_std, normalize_std_loop), (normalize_images, normalize_images_loop)])
+def test_batched_ops_match_loops(operation, loop):
+
+    images = 5*torch.rand(6, 1, 20, 20)+torch.arange(6).reshape(6, 1, 1, 1)
+
+    assert torch.allclose(operation(images), loop(images), atol = 1e-5)
+    assert torch.allclose(operation(images.clone(), inplace = True), loop(images), atol = 1e-5)
+
+def test_unet_normalize_image_01_keeps_semantics():
+
+    modsys = pytest.importorskip('models.models_system')
+    images = 5*torch.rand(6, 1, 20, 20)+torch.arange(6).reshape(6, 1, 1, 1)
+
+    assert torch.allclose(modsys.UNetReconstructor.normalize_image_01(images), normalize_mean_range_loop(images), atol = 1e-6)
+    assert torch.allclose(modsys.MoDLReconstructor.normalize_image_01(images), normalize_01_loop(images), atol = 1e-6)
+
+def test_dataset_matches_per_access_normalisation(tmp_path):
+    '''
+    Checks ReconstructionDataset items against the previous per-access normalisation, and that modifying an item in
+    place does not change the dataset.
+    '''
+    slices = {}
+
+    for folder in ['fs_filtered', 'us_4_filtered', 'us_4_unfiltered']:
+
+        (tmp_path/folder).mkdir()
+        slices[folder] = [3*torch.rand(1, 16, 16)+index for index in range(3)]
+
+        for index, image in enumerate(slices[folder]):
+            torch.save(image, str(tmp_path/folder/'{}.pt'.format(index)))
+
+    dataset = dlutils.ReconstructionDataset(str(tmp_path), 4)
+
+    for index in range(3):
+
+        item = dataset[index]
+
+        for image, folder in zip(item, ['us_4_unfiltered', 'us_4_filtered', 'fs_filtered']):
+            reference = slices[folder][index]
+            assert torch.allclose(image, (reference-reference.min())/(reference.max()-reference.min()), atol = 1e-6)
+
+        item[0].mul_(0)
+        assert torch.isclose(dataset[index][0].max(), torch.tensor(1.0))
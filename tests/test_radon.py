@@ -0,0 +1,83 @@
+'''
+Testing the torch-native Radon operators against the torch_radon geometry
+
+author: obanmarcos
+'''
+import numpy as np
+import pytest
+import torch
+
+from models.radon import Radon, SparseRadon, ToeplitzNormal
+
+resolution = 32
+det_count = int(np.ceil(np.sqrt(2)*resolution))
+angles = np.linspace(0, 2*np.pi, 60, endpoint = False)
+
+# Mismatch relative to the Cauchy-Schwarz bound of each inner product. The ray-driven projector (bilinear interpolation 
+# along the rays) and the pixel-driven backprojector (linear interpolation on the detector) are separate discretisations, 
+# so Radon is adjoint only up to interpolation error, measured below 2e-3. SparseRadon stores A and uses its transpose, 
+# so it is adjoint up to float32 rounding
+@pytest.mark.parametrize('operator_class, tolerance', [(Radon, 5e-3), (SparseRadon, 1e-6)])
+@pytest.mark.parametrize('seed', range(5))
+def test_adjointness(operator_class, tolerance, seed):
+    '''
+    Checks <A x, y> = <x, A^T y>, and the symmetry <A^T A x, z> = <x, A^T A z> CG relies on, for zero-mean random 
+    images and sinograms.
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    radon = operator_class(resolution, angles, det_count = det_count)
+    images = torch.randn(3, 1, resolution, resolution, generator = generator, dtype = torch.float64)
+    other_images = torch.randn(3, 1, resolution, resolution, generator = generator, dtype = torch.float64)
+    sinograms = torch.randn(3, 1, len(angles), det_count, generator = generator, dtype = torch.float64)
+    normal_operator = lambda x: radon.backprojection(radon.forward(x))
+
+    forward_product = torch.sum(radon.forward(images)*sinograms)
+    adjoint_product = torch.sum(images*radon.backprojection(sinograms))
+    bound = torch.linalg.norm(radon.forward(images))*torch.linalg.norm(sinograms)
+
+    assert torch.abs(forward_product-adjoint_product) <= tolerance*bound
+
+    normal_product = torch.sum(normal_operator(images)*other_images)
+    transposed_product = torch.sum(images*normal_operator(other_images))
+    bound = torch.linalg.norm(normal_operator(images))*torch.linalg.norm(other_images)
+
+    assert torch.abs(normal_product-transposed_product) <= tolerance*bound
+
+def test_geometry():
+    '''
+    Checks the sinogram shape for det_count = ceil(sqrt(2)*N) and that every angle sees the whole image mass.
+    '''
+    radon = Radon(resolution, angles, det_count = det_count)
+    images = torch.rand(2, 1, resolution, resolution, dtype = torch.float64)
+
+    sinograms = radon.forward(images)
+
+    assert sinograms.shape == (2, 1, len(angles), det_count)
+    # Rays of length ceil(sqrt(2)*N) cover the image diagonal, so no mass is lost at any angle
+    mass = images.sum(dim = (-2, -1), keepdim = True)
+    assert torch.allclose(sinograms.sum(dim = -1, keepdim = True), mass.expand(-1, -1, len(angles), 1), rtol = 1e-2)
+
+def test_clip_to_circle():
+    '''
+    Checks that only the inscribed disk is projected when clip_to_circle is set.
+    '''
+    radon = Radon(resolution, angles, det_count = det_count, clip_to_circle = True)
+    corners = torch.zeros(1, 1, resolution, resolution, dtype = torch.float64)
+    corners[..., 0, 0] = corners[..., 0, -1] = corners[..., -1, 0] = corners[..., -1, -1] = 1
+
+    assert torch.allclose(radon.forward(corners), torch.zeros(1, dtype = torch.float64), atol = 1e-10)
+
+def test_toeplitz_normal():
+    '''
+    Checks that the FFT convolution matches A^T A applied with the projector and backprojector.
+    '''
+    radon = Radon(resolution, angles, det_count = det_count)
+    toeplitz = ToeplitzNormal(resolution, angles, det_count = det_count)
+    images = torch.rand(3, 1, resolution, resolution, dtype = torch.float64)
+
+    reference = radon.backprojection(radon.forward(images))
+    output = toeplitz.forward(images)
+
+    # Bilinear interpolation makes the projector only approximately shift invariant, measured error is below 3%
+    assert output.shape == reference.shape
+    assert torch.linalg.norm(output-reference)/torch.linalg.norm(reference) < 5e-2